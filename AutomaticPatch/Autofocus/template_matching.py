@@ -4,6 +4,7 @@ Not scale nor rotation invariant
 """
 
 import cv2
+from vision.templatematch import match_template
 
 __all__ = ['templatematching']
 
@@ -16,14 +17,13 @@ def templatematching(img, template):
     :param template: image to look for
     :return: is_in: 1 if the template has been detected, 0 otherwise
              maxval: maximum value corresponding to the best matching ratio
-             maxloc: location (x,y) in the image of maxval
+             maxloc: location (x,y) in the image of maxval, with sub-pixel precision
     """
 
-    # Searching for a template match using cv2.TM_COEFF_NORMED detection
-    res = cv2.matchTemplate(img, template, cv2.TM_CCOEFF_NORMED)
-
-    # Getting maxval and maxloc
-    _, maxval, _, maxloc = cv2.minMaxLoc(res)
+    # Searching for a template match using cv2.TM_COEFF_NORMED detection,
+    # coarse-to-fine (downsampled image, then full resolution around the best candidate)
+    x, y, maxval = match_template(img, template)
+    maxloc = (x, y)
 
     # Threshold for maxval to assure a good template matching
     threshold = 0.75
@@ -40,7 +40,7 @@ if __name__ == '__main__':
     img = cv2.imread('pipette.jpg', 0)
     template = cv2.imread('template.jpg', 0)
     res, val, loc = templatematching(img, template)
-    x, y = loc[:2]
+    x, y = int(round(loc[0])), int(round(loc[1]))
     if res:
         h = template.shape[1]
         w = template.shape[0]
@@ -34,6 +34,9 @@ class Camera(Thread):
         # OnMouse function when clicking on the window
         self.mouse_callback = mouse_fun
         self.img_fun = img_func
+
+        # Functions called with each new frame, in this thread (e.g. FocusCurve.add_frame)
+        self.listeners = []
         self.start()
 
     def run(self):
@@ -66,6 +69,8 @@ class Camera(Thread):
 
                 # Update attributes
                 self.frame = img
+                for listener in self.listeners:
+                    listener(img)
 
                 # Display the image with a cross at the center
                 img_to_display = disp_centered_cross(img)
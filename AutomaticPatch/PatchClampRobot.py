@@ -3,6 +3,11 @@ from Autofocus import *
 from Camera import *
 from Amplifier import *
 from Pressure_controller import *
+from devices import AsyncUnit, gather, wait_motion, LinearTrajectory
+from vision.templatematch import TemplateStack, TemplateTracker
+from vision.focusmetrics import FocusCurve
+from vision.autofocus import autofocus
+from geometry import AffineTransform, TransformGraph, Workspace, WorkspaceError, FocusMap, Objective, Plane
 import numpy as np
 import cv2
 from math import fabs
@@ -27,9 +32,17 @@ class PatchClampRobot(Thread):
         # Devices
         self.dev, self.microscope, self.arm = init_device(controller, arm)
         self.controller = controller
+        # Parallel access to the arm and the microscope
+        self.async_arm, self.async_microscope = AsyncUnit(self.arm), AsyncUnit(self.microscope)
+        # Straight-line moves of the arm
+        self.trajectory = LinearTrajectory(self.arm)
 
-        # Tab for template images
+        # Tab for template images, and the same images matched in one pass (see focus)
         self.template = []
+        self.template_stack = None
+
+        # Tracker of the tip in the image, searching around the position predicted from the moves
+        self.tracker = None
 
         # Boolean for calibrated state
         self.calibrated = 0
@@ -49,6 +62,20 @@ class PatchClampRobot(Thread):
         self.mat = np.matrix([[0., 0., 0.], [0., 0., 0.], [0., 0., 0.]])
         self.inv_mat = np.matrix([[0., 0., 0.], [0., 0., 0.], [0., 0., 0.]])
 
+        # Transforms between the arm, stage, view and pixel frames - set after calibration (see update_transforms)
+        self.frames = TransformGraph()
+        self.view_position = None
+
+        # Allowed positions of the arm, checked before moves: motor range (after calibration),
+        # objective (if configured, see load_objective) and chamber bottom (from the focus map)
+        self.workspace = Workspace()
+        self.objective = None
+        self.load_objective()
+
+        # Focus height of the microscope on the preparation as a function of the stage XY position,
+        # sampled by focusing on the preparation (see record_focus), not on the tip
+        self.focus_map = FocusMap('thin-plate')
+
         # Initial position of the tip in the image, before calibration
         self.x_init, self.y_init = 0, 0
 
@@ -156,12 +183,10 @@ class PatchClampRobot(Thread):
                         if ((cx - self.lastX) ** 2 + (cy - self.lastY) ** 2) ** 0.5 < 30:
                             self.lastX = cx
                             self.lastY = cy
-                            target = self.rot_inv * np.array([[(width / 2 - cx * ratio) * self.um_px * 0.35],
-                                                              [(height / 2 - cy * ratio) * self.um_px * 0.35],
-                                                              [0]])
-                            self.microscope.absolute_move_group(
-                                np.transpose(self.microscope.position()) + target,
-                                [0, 1, 2])
+                            target = 0.35 * self.frames.get('pixel', 'view').linear([cx * ratio - width / 2,
+                                                                                     cy * ratio - height / 2,
+                                                                                     0.])
+                            self.move_stage(self.microscope.position().ravel() + target)
                             break
             except cv2.error:
                 pass
@@ -171,19 +196,23 @@ class PatchClampRobot(Thread):
         self.following = False
         self.update_message('Moving...')
 
-        # Getting the position of the tip and the micriscope
-        pos = np.transpose(self.microscope.position())
-
-        # Computing the desired position
-        offset = self.rot_inv * np.array([[(self.x_init - (self.event['x'] - self.template_loc[0])) * self.um_px],
-                                          [(self.y_init - (self.event['y'] - self.template_loc[1])) * self.um_px],
-                                          [0]])
-        pos += offset
+        # Computing the desired position of the arm
+        self.update_view()
+        target = self.frames.convert([self.event['x'], self.event['y'], 0.], 'pixel', 'arm')
 
         # Moving the tip after a withdraw for security
         self.arm.relative_move(self.withdraw_sign * 10, 0)
         self.arm.wait_motor_stop(0)
-        self.arm.absolute_move_group(self.inv_mat * pos, [0, 1, 2])
+        try:
+            # Straight move, or around the objective if necessary
+            path = self.workspace.plan(self.arm.position().ravel(), target)
+        except WorkspaceError as e:
+            self.update_message('ERROR: {}'.format(e))
+            path = []
+        for i, position in enumerate(path):
+            if i > 0:
+                self.arm.wait_motor_stop([0, 1, 2])
+            self.arm.absolute_move_group(list(position), [0, 1, 2])
 
         # Event is finished
         self.event['event'] = None
@@ -196,18 +225,15 @@ class PatchClampRobot(Thread):
         self.update_message('Moving...')
 
         # Getting desired position
-        mic_pos = np.transpose(self.microscope.position())
-
-        offset = self.rot_inv * np.array([[(self.x_init - (self.event['x'] - self.template_loc[0])) * self.um_px],
-                                          [(self.y_init - (self.event['y'] - self.template_loc[1])) * self.um_px],
-                                          [0]])
-        mic_pos += offset
-        tip_pos = self.mat * np.transpose(self.arm.position())
+        self.update_view()
+        mic_pos = self.frames.convert([self.event['x'], self.event['y'], 0.], 'pixel', 'stage')
+        arm_to_stage = self.frames.get('arm', 'stage')
+        tip_pos = arm_to_stage(self.arm.position().ravel())
 
         # Withdraw the pipette for security
-        if self.withdraw_sign * np.sign(self.mat[2, 0]) * (tip_pos[2, 0] - mic_pos[2, 0]) < 0:
+        if self.withdraw_sign * np.sign(self.mat[2, 0]) * (tip_pos[2] - mic_pos[2]) < 0:
             # tip is lower than the desired position, withdraw to the desired heigth
-            move = self.withdraw_sign * (abs(mic_pos[2, 0] - tip_pos[2, 0]) + 15) / abs(self.mat[2, 0])
+            move = self.withdraw_sign * (abs(mic_pos[2] - tip_pos[2]) + 15) / abs(self.mat[2, 0])
         else:
             # tip is higher than, or at, desired height
             move = self.withdraw_sign * 15 / abs(self.mat[2, 0])
@@ -218,19 +244,19 @@ class PatchClampRobot(Thread):
 
         # From now, use theoretical position rather than true position to compensate for unreachable position
         # Computing supposed position of the tip.
-        theorical_tip_pos = tip_pos + self.mat * np.array([[move], [0], [0]])
+        theorical_tip_pos = tip_pos + arm_to_stage.linear([move, 0., 0.])
 
         # Computing intermediate position in the same horizontal plan as the supposed tip position
         # Only x axis should have an offset compared to the desired position
-        intermediate_x_pos = self.withdraw_sign * abs(theorical_tip_pos[2, 0] - mic_pos[2, 0]) / abs(self.mat[2, 0])
-        intermediate_pos = mic_pos + self.mat * np.array([[intermediate_x_pos], [0], [0]])
+        intermediate_x_pos = self.withdraw_sign * abs(theorical_tip_pos[2] - mic_pos[2]) / abs(self.mat[2, 0])
+        intermediate_pos = mic_pos + arm_to_stage.linear([intermediate_x_pos, 0., 0.])
 
         # Applying moves to intermediate position
-        self.arm.absolute_move_group(self.inv_mat * intermediate_pos, [0, 1, 2])
+        self.arm.absolute_move_group(list(arm_to_stage.inverse()(intermediate_pos)), [0, 1, 2])
         self.arm.wait_motor_stop([0, 1, 2])
 
         # Getting close to the desired postion (offset 10um on x axis)
-        self.linear_move(intermediate_pos, mic_pos + self.mat * np.array([[self.withdraw_sign * 10.], [0.], [0.]]))
+        self.linear_move(intermediate_pos, mic_pos + arm_to_stage.linear([self.withdraw_sign * 10., 0., 0.]))
         self.arm.wait_motor_stop([0, 1, 2])
 
         if abs(self.pipette_resistance - self.get_resistance()) < 1e6:
@@ -255,14 +281,16 @@ class PatchClampRobot(Thread):
     def pipette_follows_camera(self):
         # The tip follows the camera
         # Same as poistionning, but without updating events at the end
-        pos = np.transpose(self.microscope.position())
-        # tip_pos = self.mat * np.transpose(self.arm.position())
-
-        offset = self.rot_inv * np.array([[(self.x_init - (self.event['x'] - self.template_loc[0])) * self.um_px],
-                                          [(self.y_init - (self.event['y'] - self.template_loc[1])) * self.um_px],
-                                          [self.withdraw_sign * np.sign(self.mat[2, 0]) * self.offset]])
-        pos = pos + offset
-        self.arm.absolute_move_group(self.inv_mat * pos, [0, 1, 2])
+        # The composed pixel -> arm transform is only recomputed when the microscope has moved
+        self.update_view()
+        target = self.frames.convert([self.event['x'], self.event['y'],
+                                      self.withdraw_sign * np.sign(self.mat[2, 0]) * self.offset], 'pixel', 'arm')
+        try:
+            # Closest allowed position
+            target = self.workspace.clip(target)
+        except WorkspaceError:
+            return
+        self.arm.absolute_move_group(list(target), [0, 1, 2])
         pass
 
     def img_func(self, img):
@@ -274,10 +302,10 @@ class PatchClampRobot(Thread):
         Make the arm and platform go to the origin: state before the calibration
         """
 
-        self.arm.go_to_zero([0, 1, 2])
-        self.microscope.go_to_zero([0, 1, 2])
-        self.arm.wait_motor_stop([0, 1, 2])
-        self.microscope.wait_motor_stop([0, 1, 2])
+        # Both units move and are waited for in parallel
+        for unit in (self.async_arm, self.async_microscope):
+            unit.go_to_zero([0, 1, 2])
+        gather(self.async_arm.wait_still([0, 1, 2]), self.async_microscope.wait_still([0, 1, 2])).result()
         time.sleep(.2)
         pass
 
@@ -330,6 +358,9 @@ class PatchClampRobot(Thread):
         :return: 0 if calibration failed, 1 otherwise
         """
 
+        # The tip starts at its initial position in the image
+        self.tracker.reset([self.x_init, self.y_init])
+
         while self.arm.position(axis) < self.maxdist:
 
             # calibrate arm axis using exponential moves:
@@ -368,9 +399,11 @@ class PatchClampRobot(Thread):
         for i in range(3):
             self.microscope.step_move(self.mat[i, axis] * self.step, i)
 
-        # Waiting for motors to stop
-        self.arm.wait_motor_stop(axis)
-        self.microscope.wait_motor_stop([0, 1, 2])
+        # Expected position of the tip in the image, with the current estimate of the matrix
+        self.tracker.predict(self.pixel_shift(self.mat[:, axis] * self.step, self.mat[:, axis] * self.step))
+
+        # Waiting for motors to stop (arm and microscope are queried together)
+        wait_motion([(self.arm, [axis]), (self.microscope, [0, 1, 2])])
 
         # Focus around the estimated focus height
         try:
@@ -383,6 +416,7 @@ class PatchClampRobot(Thread):
         move = self.rot_inv * delta
         for i in range(2):
             self.microscope.step_move(move[i, 0], i)
+        self.tracker.predict(self.pixel_shift(np.zeros(3), [move[0, 0], move[1, 0], 0.]))
 
         self.microscope.wait_motor_stop([0, 1])
 
@@ -412,6 +446,10 @@ class PatchClampRobot(Thread):
         :return: 0 if calibration failed, 1 otherwise
         """
 
+        # Stage coordinates are reset by the calibration
+        self.focus_map.clear()
+        self.update_chamber()
+
         self.update_message('Calibrating platform...')
 
         self.calibrate_platform()
@@ -453,6 +491,7 @@ class PatchClampRobot(Thread):
         # Getting the direction to withdraw pipette along x axis
         self.get_withdraw_sign()
         self.inv_mat = np.linalg.inv(self.mat)
+        self.update_transforms()
         self.calibrated = 1
         self.cam.click_on_window = True
         self.save_calibration()
@@ -523,8 +562,11 @@ class PatchClampRobot(Thread):
                 self.template_loc[1] = float(f.readline())
 
             self.get_withdraw_sign()
+            self.update_transforms()
             self.arm.set_to_zero([0, 1, 2])
             self.microscope.set_to_zero([0, 1, 2])
+            self.focus_map.clear()
+            self.update_chamber()
             self.calibrated = 1
             self.cam.click_on_window = True
             self.update_message('Calibration loaded.')
@@ -557,6 +599,62 @@ class PatchClampRobot(Thread):
                 self.event = {'event': 'PatchClamp', 'x': x, 'y': y}
         pass
 
+    def update_transforms(self):
+        """
+        Sets the transforms between frames from the calibration:
+        arm (arm axes) -> stage (position of the tip in microscope coordinates),
+        pixel (x, y in the camera image and z in um) -> view (shift from the microscope position)
+        """
+        self.frames.set('arm', 'stage', AffineTransform(self.mat))
+        center = np.array([(self.x_init + self.template_loc[0]) * self.um_px,
+                           (self.y_init + self.template_loc[1]) * self.um_px,
+                           0.])
+        rot_inv = np.array(self.rot_inv)
+        self.frames.set('pixel', 'view', AffineTransform(np.dot(rot_inv, np.diag([-self.um_px, -self.um_px, 1.])),
+                                                         np.dot(rot_inv, center)))
+        self.view_position = None
+        self.workspace.transform = self.frames.get('arm', 'stage')
+        if 'min' in self.arm.memory and 'max' in self.arm.memory:
+            self.workspace.lower = np.array(self.arm.memory['min'], dtype=float).ravel()
+            self.workspace.upper = np.array(self.arm.memory['max'], dtype=float).ravel()
+
+    def update_view(self):
+        """
+        Sets the view -> stage transform, and the objective in the workspace, to the current microscope position.
+        """
+        position = self.microscope.position().ravel()
+        if self.view_position is None or any(position != self.view_position):
+            self.view_position = position
+            self.frames.set('view', 'stage', AffineTransform.translation(position))
+            if self.objective is not None:
+                # The focal plane is at the microscope position, the objective above it
+                working_distance, radius = self.objective
+                self.workspace.objective = Objective(position[:2], position[2] + working_distance, radius)
+
+    def load_objective(self):
+        """
+        Loads the dimensions of the objective from ./<controller>/objective.txt:
+        working distance and radius (including a safety margin) in um, one per line.
+        Without this file, the objective is not checked.
+        """
+        try:
+            with open('./{i}/objective.txt'.format(i=self.controller), 'rt') as f:
+                self.objective = (float(f.readline()), float(f.readline()))
+        except IOError:
+            self.objective = None
+        self.workspace.objective = None
+        self.view_position = None
+
+    def update_chamber(self):
+        """
+        Sets the bottom of the chamber in the workspace to the plane fitted to the focus map on the preparation
+        (at least 3 samples), which the tip must stay above.
+        """
+        if len(self.focus_map) >= 3:
+            self.workspace.chamber = Plane.fit(self.focus_map.samples)
+        else:
+            self.workspace.chamber = None
+
     def linear_move(self, initial_position, final_position):
         """
         Goes to an absolute position in straight line.
@@ -567,24 +665,9 @@ class PatchClampRobot(Thread):
         """
         if any(initial_position - final_position):
             # The desired position is not the actual position (would make a 'divide by zero' error otherwise)
-
-            # Compute directional vector
-            dir_vector = final_position - initial_position
-
-            # Divide directional vector as a series of vector of norm 10um
-            step_vector = 15 * dir_vector/np.linalg.norm(dir_vector)
-
-            # Number of sub-directional vector to make
-            nb_step = np.linalg.norm(dir_vector) / 15.
-
-            # Moving the arm
-            for step in range(1, int(nb_step)+1):
-                intermediate_position = step * self.inv_mat * step_vector
-                self.arm.absolute_move_group(self.inv_mat*initial_position + intermediate_position, [0, 1, 2])
-                time.sleep(0.1)
-
-            # make final move to desired position
-            self.arm.absolute_move_group(self.inv_mat*final_position, [0, 1, 2])
+            # Coordinated move of the arm axes, all arriving together
+            start, end = self.frames.convert(np.array([initial_position, final_position]), 'stage', 'arm')
+            self.trajectory.move(start, end)
         pass
 
     def get_image_series(self, nb_img=51):
@@ -652,6 +735,10 @@ class PatchClampRobot(Thread):
             img = img[i * height / 4:height / 2 + i * height / 4, j * width / 4:width / 2 + j * width / 4]
             self.template += [img]
 
+        # Spectra of the templates are computed once, for focus
+        self.template_stack = TemplateStack(self.template)
+        self.tracker = TemplateTracker(self.template_stack)
+
         # reset position at the end
         self.go_to_zero()
         pass
@@ -667,30 +754,17 @@ class PatchClampRobot(Thread):
         # Getting the microscope height
         current_z = self.microscope.position(2)
 
-        # Tabs of maximum match value and their location during the process
-        vals = []
-        locs = []
-
-        # Getting the maxvals and their locations
-        for i in self.template:
+        # Matching all templates in one snapshot of the frame, around the expected position of the tip
+        if self.tracker is None:
+            self.template_stack = TemplateStack(self.template)
+            self.tracker = TemplateTracker(self.template_stack)
+        index, loc, scores = self.tracker.match(self.cam.frame)
 
-            res, val, loc = templatematching(self.cam.frame, i)
-            locs += [loc]
+        # The highest value indicates which template image match the best the current image
+        maxval = scores[index]
 
-            if res:
-                # Template has been detected
-                vals += [val]
-            else:
-                # Template has not been detected, val set at 0
-                vals += [0]
-
-        # Search of the highest value, indicating which template image match the best the current image
-        maxval = max(vals)
-
-        if maxval != 0:
+        if maxval >= 0.75: # same threshold as templatematching
             # At least one template has been detected, setting the microscope at corresponding height
-            index = vals.index(maxval)
-            loc = locs[index]
             focus_height = current_z + len(self.template) // 2 - index
             self.microscope.absolute_move(focus_height, 2)
             self.microscope.wait_motor_stop(2)
@@ -701,6 +775,54 @@ class PatchClampRobot(Thread):
 
         return maxval, dep, loc
 
+    def pixel_shift(self, tip_move, microscope_move):
+        """
+        Displacement of the tip in the image, in pixels, for moves of the tip and of the microscope
+        in stage coordinates (um).
+        """
+        move = np.array(microscope_move, dtype=float).ravel() - np.array(tip_move, dtype=float).ravel()
+        return np.dot(np.array(self.rot), move)[:2] / self.um_px
+
+    def record_focus(self):
+        """
+        Adds the current microscope position to the focus map, the preparation being in focus.
+        """
+        position = self.microscope.position().ravel()
+        self.focus_map.add(position[0], position[1], position[2])
+        self.update_chamber()
+
+    def autofocus_preparation(self, span=10.):
+        """
+        Focuses on the preparation (normalized variance of the image, golden-section search
+        within span um of the current height) and adds the position to the focus map.
+        :return: the focus height
+        """
+        def move(z):
+            self.microscope.absolute_move(z, 2)
+            self.microscope.wait_motor_stop(2)
+
+        z0 = self.microscope.position(2)
+        # Frames are measured in the camera thread; the first one may have been exposed during the move
+        curve = FocusCurve('variance', skip=1)
+        self.cam.listeners.append(curve.add_frame)
+        try:
+            z = autofocus(move, curve, z0 - span, z0 + span)
+        finally:
+            self.cam.listeners.remove(curve.add_frame)
+        self.record_focus()
+        return z
+
+    def move_stage(self, position):
+        """
+        Moves the microscope to position (x, y, z), with z replaced by the focus height predicted
+        by the focus map at (x, y) once the preparation has been focused on (z is kept otherwise).
+        """
+        position = np.array(position, dtype=float).ravel()
+        z = self.focus_map.predict(position[0], position[1])
+        if z is not None:
+            position[2] = z
+        self.microscope.absolute_move_group(list(position), [0, 1, 2])
+
     def matrix_accuracy(self):
         """
         Compute the accuracy of the transform matrix
@@ -876,11 +998,11 @@ class PatchClampRobot(Thread):
         :return: 
         """
         # Get the corresponding position in the pipette referential
-        tip_position = self.inv_mat * position
+        tip_position = self.frames.convert(position, 'stage', 'arm')
 
         # Approaching cell 1um by 1um
         self.update_message('Approaching cell...')
-        while self.withdraw_sign * (self.arm.position(0) - tip_position[0, 0]) + 3 > 0:
+        while self.withdraw_sign * (self.arm.position(0) - tip_position[0]) + 3 > 0:
             # Arm is not beyond the desired position, moving
             self.arm.step_move(-self.withdraw_sign, 0)
             self.arm.wait_motor_stop([0])
@@ -977,13 +1099,17 @@ if __name__ == '__main__':
 
         if key & 0xFF == ord('t'):
             if robot.template:
-                for i in robot.template:
-                    _, val, _ = templatematching(robot.cam.frame, i)
+                if robot.template_stack is None:
+                    robot.template_stack = TemplateStack(robot.template)
+                for val in robot.template_stack.match(robot.cam.frame)[2]:
                     print val
 
         if key & 0xFF == ord('z'):
             robot.go_to_zero()
 
+        if key & 0xFF == ord('f'):
+            print 'Focus at', robot.autofocus_preparation()
+
         if key & 0xFF == ord('b'):
             calibrated = robot.calibrate()
             if not calibrated:
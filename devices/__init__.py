@@ -7,4 +7,11 @@ from virtualxyzunit import *
 from fakedevice import *
 from xymicunit import *
 from leica import *
-from multiclamp import *
\ No newline at end of file
+from multiclamp import *
+from asyncunit import *
+from motion import *
+from positioncache import *
+from trajectory import *
+from coordinator import *
+from jog import *
+from recording import *
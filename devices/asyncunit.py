@@ -0,0 +1,141 @@
+"""
+Asynchronous access to units (XYZUnit, XYMicUnit, VirtualXYZUnit or any Device).
+
+Each AsyncUnit has a worker thread that executes the calls on the unit in order,
+and every call returns immediately with a Future. Calls on different units run in
+parallel, so motion on independent devices can overlap:
+
+    stage, arm = AsyncUnit(microscope), AsyncUnit(manipulator)
+    gather(stage.move_to(x), arm.move_to(y)).result()
+    gather(stage.wait_still(), arm.wait_still()).result()
+
+Any other method of the unit can be called on the AsyncUnit, eg unit.go_to_zero([0, 1, 2]).
+"""
+from threading import Thread, Lock
+import Queue
+from commandqueue import Future
+
+__all__ = ['AsyncUnit', 'gather']
+
+
+def gather(*futures):
+    '''
+    Combines futures.
+
+    Returns
+    -------
+    A Future for the list of results, which fails with the first exception.
+    '''
+    combined = Future()
+    results = [None] * len(futures)
+    remaining = [len(futures)]
+    lock = Lock()
+
+    def done(i, future):
+        exception = future.exception()
+        with lock:
+            if combined.done():
+                return
+            if exception is not None:
+                combined.set_exception(exception)
+                return
+            results[i] = future.result()
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                combined.set_result(results)
+
+    if not futures:
+        combined.set_result(results)
+    for i, future in enumerate(futures):
+        future.add_done_callback(lambda future, i = i: done(i, future))
+    return combined
+
+
+class AsyncUnit(object):
+    '''
+    Runs the methods of a unit in a worker thread.
+    '''
+    def __init__(self, unit):
+        '''
+        Parameters
+        ----------
+        unit : the underlying unit or device
+        '''
+        self.unit = unit
+        self.calls = Queue.Queue()
+        self.worker = Thread(target = self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def call(self, method, *args, **kwds):
+        '''
+        Queues a call to a method of the unit.
+
+        Parameters
+        ----------
+        method : a method name, or a function called with the unit as first argument
+
+        Returns
+        -------
+        A Future for the value returned by the method.
+        '''
+        future = Future()
+        self.calls.put((method, args, kwds, future))
+        return future
+
+    def __getattr__(self, name):
+        unit = self.__dict__.get('unit')
+        if name.startswith('_') or not callable(getattr(unit, name, None)):
+            raise AttributeError(name)
+        return lambda *args, **kwds: self.call(name, *args, **kwds)
+
+    def move_to(self, x, axis = None):
+        '''
+        Moves the unit to position x (absolute move).
+        The Future is done when the command is sent, not when the move is finished.
+        '''
+        return self.call('absolute_move', x, axis)
+
+    def move_by(self, x, axis = None):
+        '''
+        Moves the unit by x (relative move).
+        '''
+        return self.call('relative_move', x, axis)
+
+    def wait_still(self, axis = None):
+        '''
+        Waits until the motors have stopped.
+
+        Parameters
+        ----------
+        axis : axis number or list of axis numbers; if None, all axes
+
+        Returns
+        -------
+        A Future that is done when the unit is still.
+        '''
+        if axis is None:
+            return self.call('wait_until_still')
+        return self.call('wait_motor_stop', axis)
+
+    def close(self):
+        '''
+        Stops the worker thread once the queued calls are done.
+        '''
+        self.calls.put(None)
+
+    def run(self):
+        while True:
+            item = self.calls.get()
+            if item is None:
+                return
+            method, args, kwds, future = item
+            try:
+                if callable(method):
+                    result = method(self.unit, *args, **kwds)
+                else:
+                    result = getattr(self.unit, method)(*args, **kwds)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
@@ -0,0 +1,252 @@
+"""
+Pipelined command queue for serial controllers.
+
+A thread owns the serial port: it writes frames as soon as they are submitted,
+without waiting for the answers to previous frames, and matches the answers
+(<ACK><ID>...) to the waiting commands.
+"""
+from threading import Thread, Event, Lock
+from collections import deque
+import Queue
+import time
+import binascii
+import serial
+from luigsneumann_protocol import FrameParser
+
+__all__ = ['CommandQueue', 'Future', 'wait_all']
+
+
+class Future(object):
+    '''
+    The result of a command, available once the controller has answered.
+    '''
+    def __init__(self):
+        self._event = Event()
+        self._lock = Lock()
+        self._callbacks = []
+        self._result = None
+        self._exception = None
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        '''
+        Calls callback(future) when the future is done (immediately if it is already done).
+        The callback runs in the thread that completes the future.
+        '''
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def done(self):
+        return self._event.is_set()
+
+    def exception(self):
+        self._event.wait()
+        return self._exception
+
+    def result(self):
+        '''
+        Waits for the answer and returns it, or raises the command error.
+        '''
+        self._event.wait()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+def wait_all(futures):
+    '''
+    Waits for a list of futures and returns their results.
+    '''
+    return [future.result() for future in futures]
+
+
+class CommandQueue(Thread):
+    '''
+    A thread that sends command frames on a serial port and dispatches the answers.
+
+    The controller answers commands in order, so when the answer to a command arrives,
+    commands sent before it that are still waiting were lost (or their answer was).
+    A lost query or an answer with a wrong CRC is retransmitted once, then fails.
+    Other commands (answered by a bare acknowledgement, e.g. steps) fail at once:
+    the controller may have executed them with only the acknowledgement lost,
+    so sending them again could execute them twice.
+    An answer with a wrong CRC is only matched to the oldest waiting command,
+    since its ID may be corrupted too.
+    '''
+    def __init__(self, port, timeout = None, poll_interval = 0.002, retries = 1, repeatable = ()):
+        '''
+        Parameters
+        ----------
+        port : an open serial port
+        timeout : time to wait for an answer in s (default: port timeout)
+        poll_interval : read timeout of the port while answers are expected
+        retries : number of retransmissions of a command
+        repeatable : IDs (bytes) of commands without data in the answer that are safe to send twice;
+                     queries are always retransmitted
+        '''
+        Thread.__init__(self)
+        self.daemon = True
+        self.port = port
+        if timeout is None:
+            timeout = port.timeout
+        self.timeout = timeout
+        self.retries = retries
+        self.repeatable = set(repeatable)
+        self.port.timeout = poll_interval
+        self.outgoing = Queue.Queue()
+        self.pending = deque() # commands waiting for an answer, in sending order
+        self.held = deque() # queries waiting to be sent
+        self.parser = FrameParser()
+        self.retransmissions = 0
+        self.running = True
+        self.start()
+
+    def submit(self, frame, nbytes_answer):
+        '''
+        Queues a frame to be sent.
+
+        Parameters
+        ----------
+        frame : the complete frame (bytes)
+        nbytes_answer : number of data bytes in the answer; -1 if there is no answer
+
+        Returns
+        -------
+        A Future for the data of the answer (None if there is no answer).
+        '''
+        future = Future()
+        if not self.running:
+            future.set_exception(serial.SerialException('Command queue is stopped'))
+        else:
+            self.outgoing.put((frame, nbytes_answer, future))
+        return future
+
+    def stop(self):
+        self.running = False
+        self.outgoing.put(None)
+
+    def run(self):
+        try:
+            while self.running:
+                # Wait for commands only if no answer is expected
+                self.send(block = not (self.pending or self.held))
+                if self.pending:
+                    self.receive()
+                    self.check_timeouts()
+        except (serial.SerialException, OSError, ValueError) as e: # e.g. port closed
+            self.running = False
+            self.fail_all(serial.SerialException(str(e)))
+        else:
+            self.fail_all(serial.SerialException('Command queue is stopped'))
+
+    def send(self, block):
+        '''
+        Writes all queued frames.
+        '''
+        # Queries held back by a previous query with the same ID
+        held, self.held = self.held, deque()
+        for item in held:
+            self.write(item)
+        while True:
+            try:
+                item = self.outgoing.get(block)
+            except Queue.Empty:
+                return
+            block = False
+            if item is None: # stop
+                return
+            self.write(item)
+
+    def write(self, item):
+        '''
+        Writes a frame, unless it is a query with the same ID as a query waiting for its answer.
+        Answers only identify the command ID, so such queries are sent one at a time.
+        '''
+        frame, nbytes_answer, future = item
+        key = frame[1:3]
+        if nbytes_answer > 0 and (any(command[1] == key for command in self.pending) or
+                                  any(held[0][1:3] == key for held in self.held)):
+            self.held.append(item)
+            return
+        self.port.write(frame)
+        if nbytes_answer < 0:
+            future.set_result(None)
+        else:
+            # [future, ID, number of bytes, deadline, frame, remaining retries]
+            self.pending.append([future, key, nbytes_answer,
+                                 time.time() + self.timeout, frame, self.retries])
+
+    def receive(self):
+        '''
+        Reads available bytes and dispatches complete answers.
+        '''
+        for key, data, valid in self.parser.feed(self.port.read(max(1, self.port.in_waiting))):
+            if not valid and (not self.pending or self.pending[0][1] != key):
+                # The ID of a frame with a wrong CRC may be corrupted too: only trust it
+                # for the oldest waiting command
+                continue
+            # First waiting command with this ID
+            for i, command in enumerate(self.pending):
+                if command[1] == key:
+                    break
+            else: # unexpected answer
+                continue
+            # Commands sent before were not answered
+            for _ in range(i):
+                self.retransmit(self.pending.popleft(), "No answer to command '%s'")
+            command = self.pending.popleft()
+            if valid or command[2] == 0:
+                # An acknowledgement with a wrong CRC still means that the command was executed
+                command[0].set_result(data[:command[2]])
+            else:
+                self.retransmit(command, "Wrong CRC in answer to command '%s'")
+
+    def retransmit(self, command, message):
+        '''
+        Sends a command again, or fails it if it has no retries left
+        or is not safe to repeat.
+        '''
+        future, key, nbytes_answer, _, frame, retries = command
+        if retries > 0 and (nbytes_answer > 0 or key in self.repeatable):
+            self.retransmissions += 1
+            self.port.write(frame)
+            command[3] = time.time() + self.timeout
+            command[5] -= 1
+            self.pending.append(command)
+        else:
+            future.set_exception(serial.SerialException(message % binascii.hexlify(key)))
+
+    def check_timeouts(self):
+        now = time.time()
+        while self.pending and self.pending[0][3] < now:
+            self.retransmit(self.pending.popleft(), "No answer to command '%s'")
+
+    def fail_all(self, exception):
+        while self.pending:
+            self.pending.popleft()[0].set_exception(exception)
+        while self.held:
+            self.held.popleft()[2].set_exception(exception)
+        while True:
+            try:
+                item = self.outgoing.get(False)
+            except Queue.Empty:
+                return
+            if item is not None:
+                item[2].set_exception(exception)
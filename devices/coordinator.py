@@ -0,0 +1,82 @@
+"""
+Coordinated moves of several units.
+
+The moves of all units are resolved to device axes and merged per device,
+so that each device receives as few group commands as possible (the SM-10
+moves up to 4 axes per frame), and all commands are dispatched back-to-back:
+
+    coordinated_move([(left, array([5., 0, 0])), (right, array([-5., 0, 0]))])
+
+Units define `group_moves(x, axis, relative)`, which returns a list of
+(device, axes, values); an axis of None means a device without axes (e.g. a focus drive).
+"""
+from numpy import array
+
+__all__ = ['coordinated_move', 'merge_moves']
+
+
+def merge_moves(moves, relative = True):
+    '''
+    Resolves the moves of units to device moves, merged per device.
+
+    Parameters
+    ----------
+    moves : list of (unit, x) or (unit, x, axis); x is a vector, or a value if axis is given
+    relative : True for relative moves
+
+    Returns
+    -------
+    A list of (device, axes, values), with each device once.
+    '''
+    devices = []
+    merged = dict()
+    for move in moves:
+        unit, x = move[:2]
+        axis = move[2] if len(move) > 2 else None
+        if hasattr(unit, 'group_moves'):
+            device_moves = unit.group_moves(x, axis, relative)
+        elif axis is None:
+            device_moves = [(unit, [None], [x])]
+        else:
+            device_moves = [(unit, [axis], [x])]
+        for dev, axes, values in device_moves:
+            if id(dev) not in merged:
+                devices.append(dev)
+                merged[id(dev)] = ([], [])
+            for axis, value in zip(axes, values):
+                if relative and value == 0: # nothing to do
+                    continue
+                merged_axes, merged_values = merged[id(dev)]
+                if axis in merged_axes: # several moves of the same axis
+                    i = merged_axes.index(axis)
+                    merged_values[i] = merged_values[i] + value if relative else value
+                else:
+                    merged_axes.append(axis)
+                    merged_values.append(value)
+    return [(dev,) + merged[id(dev)] for dev in devices if merged[id(dev)][0]]
+
+
+def coordinated_move(moves, relative = True):
+    '''
+    Moves several units together: one group command per device (or per 4 axes on the SM-10),
+    sent back-to-back.
+
+    Parameters
+    ----------
+    moves : list of (unit, x) or (unit, x, axis); x is a vector, or a value if axis is given
+    relative : True for relative moves
+    '''
+    for dev, axes, values in merge_moves(moves, relative):
+        if None in axes: # device without axes
+            if relative:
+                dev.relative_move(values[axes.index(None)])
+            else:
+                dev.absolute_move(values[axes.index(None)])
+            values = [value for axis, value in zip(axes, values) if axis is not None]
+            axes = [axis for axis in axes if axis is not None]
+            if not axes:
+                continue
+        if relative:
+            dev.relative_move_group(array(values), axes)
+        else:
+            dev.absolute_move_group(array(values), axes)
@@ -6,11 +6,15 @@ To make a new device, one must implement at least:
 * absolute_move
 """
 from numpy import array
-import time
+from motion import wait_motion, monitor
 
 __all__ = ['Device']
 
 class Device(object):
+    # If True, fixed delays are inserted after commands, as in earlier versions,
+    # for controllers that need them
+    compatible_timing = False
+
     def __init__(self):
         pass
 
@@ -85,7 +89,7 @@ class Device(object):
         axes : list of axis numbers
         x : position shift in um (vector or list).
         '''
-        self.absolute_move_group(array(self.position_group(axes))+array(x), axes)
+        self.absolute_move_group(array(self.position_group(axes)).ravel()+array(x), axes)
 
     def stop(self, axis):
         """
@@ -93,17 +97,34 @@ class Device(object):
         """
         pass
 
+    def is_moving(self, axes):
+        """
+        Tells whether axes are moving.
+        By default, an axis is moving if its position has changed since the previous
+        query of the current wait.
+
+        Parameters
+        ----------
+        axes : list of axis numbers
+
+        Returns
+        -------
+        A list of booleans.
+        """
+        previous = monitor(self).previous
+        moving = []
+        for axis in axes:
+            x = self.position(axis)
+            moving.append(axis not in previous or array(previous[axis] != x).any())
+            previous[axis] = x
+        return moving
+
     def wait_until_still(self, axis = None):
         """
         Waits until motors have stopped.
 
         Parameters
         ----------
-        axes : list of axis numbers
+        axis : axis number
         """
-        previous_position = self.position(axis)
-        new_position = None
-        while array(previous_position != new_position).any():
-            previous_position = new_position
-            new_position = self.position(axis)
-            time.sleep(0.1) # 100 us
\ No newline at end of file
+        wait_motion([(self, [axis])])
\ No newline at end of file
@@ -36,3 +36,9 @@ class FakeDevice(Device):
         x : target position in um.
         '''
         self.x[axis-1] = x
+
+    def is_moving(self, axes):
+        '''
+        Moves are instantaneous.
+        '''
+        return [False] * len(axes)
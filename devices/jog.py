@@ -0,0 +1,127 @@
+"""
+Continuous-velocity jogging (e.g. with a joystick).
+
+A JogEngine runs on its own thread at a fixed rate. The latest velocity set
+with `set_velocity` is used at each tick; intermediate values are dropped.
+The motion is made of absolute moves streamed ahead of the current position:
+at each tick, the target of each moving axis is placed `lookahead` seconds ahead
+along the requested velocity, and the fast velocity of the axis is set to the
+requested speed, so that the axes move continuously as long as ticks arrive.
+
+The velocity procedure moves of L&N controllers (0x0012-0x0015) are not used:
+no command other than stop is allowed while they run, so their speed cannot follow the stick.
+"""
+from threading import Thread, Lock, Event
+import time
+from numpy import array, zeros, absolute
+
+__all__ = ['JogEngine']
+
+
+class JogEngine(Thread):
+    '''
+    Moves axes of a device at a velocity that can change at any time.
+    '''
+    def __init__(self, dev, axes, rate = 20., lookahead = .15, min_velocity = .1, tolerance = .05):
+        '''
+        Parameters
+        ----------
+        dev : the device
+        axes : list of axis numbers
+        rate : number of ticks per second
+        lookahead : time ahead of the current position at which targets are placed, in s
+        min_velocity : velocities below this are 0, in um/s
+        tolerance : relative velocity change below which the velocity of an axis is not set again
+        '''
+        Thread.__init__(self)
+        self.daemon = True
+        self.dev = dev
+        self.axes = list(axes)
+        self.interval = 1. / rate
+        self.lookahead = lookahead
+        self.min_velocity = min_velocity
+        self.tolerance = tolerance
+        self.lock = Lock()
+        self.requested = zeros(len(self.axes)) # latest requested velocity
+        self.updates = 0 # number of velocity updates, including the dropped ones
+        self.ticks = 0
+        self.stopped = Event()
+        self.velocity = zeros(len(self.axes)) # velocity of the current jog
+        self.target = None # jog position of the axes, None when still
+        self.stages = None # fast speed stages to restore
+
+    def set_velocity(self, velocity):
+        '''
+        Sets the velocity of the axes in um/s (a vector), used at the next tick.
+        '''
+        with self.lock:
+            self.requested = array(velocity, dtype = float)
+            self.updates += 1
+
+    def stop(self):
+        '''
+        Stops the axes and the thread.
+        '''
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        next_tick = time.time()
+        try:
+            while not self.stopped.is_set():
+                with self.lock:
+                    velocity = self.requested.copy()
+                velocity[absolute(velocity) < self.min_velocity] = 0.
+                self.tick(velocity, self.interval)
+                self.ticks += 1
+                # Fixed rate; late ticks are skipped rather than queued
+                next_tick += self.interval
+                delay = next_tick - time.time()
+                if delay > 0:
+                    self.stopped.wait(delay)
+                else:
+                    next_tick = time.time()
+        finally:
+            self.tick(zeros(len(self.axes)), 0.)
+            self.restore_speeds()
+
+    def tick(self, velocity, dt):
+        '''
+        Sends the commands for the velocity during the next interval dt.
+        '''
+        moving = velocity != 0
+        # Axes that stop, or change direction (they restart from standstill)
+        stopping = [i for i in range(len(self.axes))
+                    if self.velocity[i] != 0 and velocity[i] * self.velocity[i] <= 0]
+        for i in stopping:
+            self.dev.stop(self.axes[i])
+            self.velocity[i] = 0.
+        if self.target is not None and stopping:
+            self.target[stopping] = float('nan') # unknown until read again
+        if not any(moving):
+            self.target = None
+            return
+
+        if self.target is None or any(self.target[moving] != self.target[moving]):
+            self.target = array(self.dev.position_group(self.axes), dtype = float).ravel()
+        if hasattr(self.dev, 'set_fast_velocity'):
+            if self.stages is None:
+                self.stages = [self.dev.fast_speed(axis) for axis in self.axes]
+            for i in moving.nonzero()[0]:
+                if abs(absolute(velocity[i]) - absolute(self.velocity[i])) > self.tolerance * abs(velocity[i]):
+                    self.dev.set_fast_velocity(self.axes[i], abs(velocity[i]))
+                    self.velocity[i] = velocity[i]
+        else:
+            self.velocity[moving] = velocity[moving]
+
+        # Jog position at the end of the interval, and target ahead of it
+        self.target[moving] += velocity[moving] * dt
+        axes = [self.axes[i] for i in moving.nonzero()[0]]
+        self.dev.absolute_move_group(self.target[moving] + velocity[moving] * self.lookahead, axes)
+
+    def restore_speeds(self):
+        if self.stages is not None:
+            for axis, stage in zip(self.axes, self.stages):
+                self.dev.set_fast_speed(axis, stage)
+            self.stages = None
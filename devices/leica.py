@@ -4,6 +4,7 @@ Communication through serial COM port.
 """
 import warnings
 from .device import *
+from .motion import MotionMonitor, wait_motion
 import sys
 import time
 sys.path.append('C:\\Program Files\\Micro-Manager-1.4') # This is not good!
@@ -28,6 +29,9 @@ class Leica(Device):
         self.zero_position = 0
         self.step_distance = 0
 
+        # The position is read at least twice, 50 ms apart, after the drive is ready
+        self.motion = MotionMonitor(min_interval = .05, max_interval = .2)
+
         self.port_name = name
         mmc = MMCorePy.CMMCore()
         self.mmc = mmc
@@ -76,6 +80,7 @@ class Leica(Device):
         x : target position in um.
         '''
         self.mmc.setPosition(self.zero_position + x)
+        self.motion.moved([None], [x])
 
     def relative_move(self, x, axis = None):
         '''
@@ -87,6 +92,7 @@ class Leica(Device):
         x : position shift in um.
         '''
         self.mmc.setRelativePosition(x)
+        self.motion.moved([None], [x], relative = True)
 
     def save(self, name):
         self.memory[name] = self.position()
@@ -94,9 +100,16 @@ class Leica(Device):
     def load(self, name):
         self.absolute_move(self.memory[name])
 
-    def wait_motor_stop(self):
-        self.mmc.waitForSystem()
-        time.sleep(.7)
+    def is_moving(self, axes):
+        '''
+        Tells whether the focus drive is moving: either busy,
+        or with a position that changed since the previous query.
+        '''
+        busy = self.mmc.deviceBusy('FocusDrive')
+        return [busy or moving for moving in Device.is_moving(self, axes)]
+
+    def wait_motor_stop(self, axis = None):
+        wait_motion([(self, [None])])
 
     def set_to_zero(self):
         self.zero_position = self.mmc.getPosition()
@@ -6,6 +6,11 @@ Adapted from Michael Graupner's LandNSM5 class.
 TODO: group commands
 """
 from serialdevice import SerialDevice
+from luigsneumann_protocol import FrameEncoder
+from commandqueue import CommandQueue, wait_all
+from motion import MotionMonitor, wait_motion, is_busy, ramp_duration
+from positioncache import PositionCache
+from threading import Lock
 import serial
 import binascii
 import time
@@ -14,6 +19,47 @@ import numpy as np
 
 __all__ = ['LuigsNeumann_SM10']
 
+# Format of the data field of each command (see FrameEncoder)
+frame_formats = {'0101': 'B', # position
+                 '0131': 'B', # position_second_counter
+                 '0190': 'B', # slow_speed
+                 '0143': 'B', # fast_speed
+                 '018F': 'BB', # set_slow_speed
+                 '0144': 'BB', # set_fast_speed
+                 '003D': 'BH', # set_fast_velocity
+                 '014D': 'B', # pitch
+                 'A048': '5B4f', # group moves
+                 'A049': '5B4f',
+                 'A04A': '5B4f',
+                 'A04B': '5B4f',
+                 'A101': '5B', # position_group
+                 'A120': '5B', # wait_motor_stop
+                 '01E8': 'Bb', # single_step_trackball
+                 '019F': 'Bb', # set_single_step_factor_trackball
+                 '0140': 'B', # single_step
+                 '0141': 'B',
+                 '044F': 'Bf', # set_single_step_distance
+                 '0158': 'BB', # set_single_step_velocity
+                 '00FF': 'B', # stop
+                 '00F0': 'B', # set_to_zero
+                 '0132': 'BB', # set_to_zero_second_counter
+                 '0024': 'B', # go_to_zero
+                 '003A': 'BB'} # set_ramp_length
+
+# Velocities in revolutions per second for stages 1-16 (motors with 200 full steps)
+fast_velocities = [.66, 1.73, 2.63, 3.79, 4.67, 5.68, 6.33, 7.81, 8.47, 9.52, 10.42,
+                   11.36, 12.32, 13.23, 14.29, 15.15]
+slow_velocities = [.000017, .00004, .000141, .00026, .00128, .00263, .00507, .0102, .0251,
+                   .0601, .173, .332, .498, .664, .996, 1.328] # the documentation says .0664 for stage 14
+full_steps = 200
+
+# Spindle pitch in um for the codes returned by the pitch query
+pitches = [20., 50., 100., 125., 175., 350., 400., 500., 1000., 2000., 297.]
+
+position_struct = struct.Struct('<f')
+group_struct = struct.Struct('<4B4f')
+status_struct = struct.Struct('<20B')
+
 
 def group_address(axes):
     all_axes = np.sum(2 ** (np.array(axes) - 1))
@@ -22,6 +68,19 @@ def group_address(axes):
     return struct.unpack('9B', address)
 
 
+def group_data(axes, x = None):
+    '''
+    Data field of group commands and queries (4 axes):
+    <A0><ucAdr1><ucAdr2><ucAdr3><ucAdr4>, followed by 4 positions if x is given.
+    '''
+    data = [0xA0, 0, 0, 0, 0]
+    data[1:1 + len(axes)] = axes
+    if x is not None:
+        data += [0., 0., 0., 0.]
+        data[5:5 + len(x)] = x
+    return data
+
+
 class LuigsNeumann_SM10(SerialDevice):
     def __init__(self, name = None):
         # Note that the port name is arbitrary, it should be set or found out
@@ -36,42 +95,52 @@ class LuigsNeumann_SM10(SerialDevice):
 
         self.port.open()
 
+        self.encoder = FrameEncoder(frame_formats)
+        self.encoder_lock = Lock()
+        # The queue thread now owns the port
+        self.queue = CommandQueue(self.port)
+
+        self.motion = MotionMonitor()
+        self.step_distance = dict()
+        self.pitches = dict()
+        # Positions read less than 50 ms ago are reused, unless the axis was moved
+        self.positions = PositionCache(max_age = .05)
+
+    def __del__(self):
+        self.queue.stop()
+        SerialDevice.__del__(self)
+
+    def send_command_async(self, ID, data, nbytes_answer):
+        '''
+        Send a command to the controller without waiting for the answer.
+
+        Parameters
+        ----------
+        ID : command ID as a hex string
+        data : values of the data field (see frame_formats), or a list of bytes
+        nbytes_answer : number of data bytes in the answer; -1 if there is no answer
+
+        Returns
+        -------
+        A Future for the data of the answer.
+        '''
+        # <syn><ID><byte number><data><CRC>
+        with self.encoder_lock:
+            frame = self.encoder.encode(ID, data).tobytes()
+        # Expected response: <ACK><ID><byte number><data><CRC>
+        return self.queue.submit(frame, nbytes_answer)
+
     def send_command(self, ID, data, nbytes_answer):
         '''
-        Send a command to the controller
-        '''
-        high, low = self.CRC_16(data, len(data))
-
-        # Create hex-string to be sent
-        # <syn><ID><byte number>
-        send = '16' + ID + '%0.2X' % len(data)
-
-        # <data>
-        # Loop over length of data to be sent
-        for i in range(len(data)):
-            send += '%0.2X' % data[i]
-        # <CRC>
-        send += '%0.2X%0.2X' % (high, low)
-        # Convert hex string to bytes
-        sendbytes = binascii.unhexlify(send)
-        self.port.write(sendbytes)
-
-        if nbytes_answer >= 0:
-            # Expected response: <ACK><ID><byte number><data><CRC>
-            # We just check the first two bytes
-            expected = binascii.unhexlify('06' + ID)
-
-            answer = self.port.read(nbytes_answer + 6)
-            if answer[:len(expected)] != expected:
-                msg = "Expected answer '%s', got '%s' " \
-                      "instead" % (binascii.hexlify(expected),
-                                   binascii.hexlify(answer[:len(expected)]))
-                raise serial.SerialException(msg)
-            # We should also check the CRC + the number of bytes
-            # Do several reads; 3 bytes, n bytes, CRC
-            return answer[4:4 + nbytes_answer]
-        else:
-            return None
+        Send a command to the controller and wait for the answer.
+
+        Parameters
+        ----------
+        ID : command ID as a hex string
+        data : values of the data field (see frame_formats), or a list of bytes
+        nbytes_answer : number of data bytes in the answer; -1 if there is no answer
+        '''
+        return self.send_command_async(ID, data, nbytes_answer).result()
 
     def position(self, axis):
         '''
@@ -85,8 +154,13 @@ class LuigsNeumann_SM10(SerialDevice):
         -------
         The current position of the device axis in um.
         '''
-        res = self.send_command('0101', [axis], 4)
-        return struct.unpack('f', res)[0]
+        x = self.positions.get([axis])[0]
+        if x is None:
+            token = self.positions.token()
+            res = self.send_command('0101', (axis,), 4)
+            x = position_struct.unpack(res)[0]
+            self.positions.update([axis], [x], token)
+        return x
 
     def position_second_counter(self, axis):
         '''
@@ -100,34 +174,66 @@ class LuigsNeumann_SM10(SerialDevice):
         -------
         The current position of the device axis in um.
         '''
-        res = self.send_command('0131', [axis], 4)
-        return struct.unpack('f', res)[0]
+        res = self.send_command('0131', (axis,), 4)
+        return position_struct.unpack(res)[0]
 
     def slow_speed(self, axis):
         '''
         Query the slow speed setting for a given axis
         '''
-        res = self.send_command('0190', [axis], 1)
+        res = self.send_command('0190', (axis,), 1)
         return struct.unpack('b', res)[0]
 
     def fast_speed(self, axis):
         '''
         Query the fast speed setting for a given axis
         '''
-        res = self.send_command('0143', [axis], 1)
+        res = self.send_command('0143', (axis,), 1)
         return struct.unpack('b', res)[0]
 
     def set_slow_speed(self, axis, speed):
         '''
         Query the slow speed setting for a given axis
         '''
-        self.send_command('018F', [axis, speed], 0)
+        self.send_command('018F', (axis, speed), 0)
 
     def set_fast_speed(self, axis, speed):
         '''
         Query the slow speed setting for a given axis
         '''
-        self.send_command('0144', [axis, speed], 0)
+        self.send_command('0144', (axis, speed), 0)
+        self.motion.speed.pop(axis, None)
+
+    def pitch(self, axis):
+        '''
+        Spindle pitch of an axis in um (displacement per motor revolution).
+        '''
+        if axis not in self.pitches:
+            code = struct.unpack('B', self.send_command('014D', (axis,), 1))[0]
+            self.pitches[axis] = pitches[code]
+        return self.pitches[axis]
+
+    def fast_velocity(self, axis):
+        '''
+        Velocity of fast moves in um/s, from the fast speed stage.
+        '''
+        return fast_velocities[self.fast_speed(axis) - 1] * self.pitch(axis)
+
+    def set_fast_velocity(self, axis, velocity):
+        '''
+        Sets the velocity of fast moves in um/s, in full steps per second
+        (replaces the fast speed stage).
+
+        Returns
+        -------
+        The velocity actually set, in um/s.
+        '''
+        pitch = self.pitch(axis)
+        steps = int(min(max(round(velocity * full_steps / pitch), 1), 2999))
+        self.send_command('003D', (axis, steps), 0)
+        velocity = steps * pitch / full_steps
+        self.motion.speed[axis] = velocity
+        return velocity
 
     def absolute_move(self, x, axis, fast=True):
         '''
@@ -164,12 +270,23 @@ class LuigsNeumann_SM10(SerialDevice):
         -------
         The current position of the device axis in um (vector).
         '''
-        # First fill in zeros to make 4 axes
-        axes4 = [0, 0, 0, 0]
-        axes4[:len(axes)] = axes
-        ret = struct.unpack('4b4f', self.send_command('A101', [0xA0] + axes4, 20))
-        assert all(r == a for r, a in zip(ret[:3], axes))
-        return np.array([ret[4:7]])
+        x = self.positions.get(axes)
+        missing = [axis for axis, xi in zip(axes, x) if xi is None]
+        if missing:
+            token = self.positions.token()
+            # One query per group of 4 axes. Answers only carry the ID, so the command queue
+            # holds each A101 query until the previous one is answered: one round trip per group
+            groups = [missing[i:i + 4] for i in range(0, len(missing), 4)]
+            futures = [self.send_command_async('A101', group_data(group), 20) for group in groups]
+            read = dict()
+            for group, future in zip(groups, futures):
+                ret = group_struct.unpack(future.result())
+                if list(ret[:len(group)]) != group:
+                    raise serial.SerialException('Wrong axes in answer to A101')
+                read.update(zip(group, ret[4:4 + len(group)]))
+            self.positions.update(read.keys(), read.values(), token)
+            x = [read[axis] if xi is None else xi for axis, xi in zip(axes, x)]
+        return np.array([x])
 
     def absolute_move_group(self, x, axes, fast=True):
         '''
@@ -177,20 +294,16 @@ class LuigsNeumann_SM10(SerialDevice):
 
         Parameters
         ----------
-        axes : list of axis numbers
+        axes : list of axis numbers (one frame per 4 axes)
         x : target position in um (vector or list)
         '''
         ID = 'A048' if fast else 'A049'
 
-        axes4 = [0, 0, 0, 0]
-        axes4[:len(axes)] = axes
-        pos4 = [0, 0, 0, 0]
-        pos4[:len(x)] = x
-
-        pos = [b for p in pos4 for b in bytearray(struct.pack('f', p))]
-
-        # Send move command
-        self.send_command(ID, [0xA0] + axes4 + pos, -1)
+        # Send move commands, 4 axes per frame, back-to-back
+        wait_all([self.send_command_async(ID, group_data(axes[i:i + 4], x[i:i + 4]), -1)
+                  for i in range(0, len(axes), 4)])
+        self.positions.invalidate(axes)
+        self.motion.moved(axes, x)
 
     def relative_move_group(self, x, axes, fast=True):
         '''
@@ -198,35 +311,27 @@ class LuigsNeumann_SM10(SerialDevice):
 
         Parameters
         ----------
-        axes : list of axis numbers
+        axes : list of axis numbers (one frame per 4 axes)
         x : position shift in um (vector or list).
         '''
         ID = 'A04A' if fast else 'A04B'
 
-        axes4 = [0, 0, 0, 0]
-        axes4[:len(axes)] = axes
-        pos4 = [0, 0, 0, 0]
-        pos4[:len(x)] = x
-
-        pos = [b for p in pos4 for b in bytearray(struct.pack('f', p))]
-
-        # Send move command
-        self.send_command(ID, [0xA0] + axes4 + pos, -1)
+        # Send move commands, 4 axes per frame, back-to-back
+        wait_all([self.send_command_async(ID, group_data(axes[i:i + 4], x[i:i + 4]), -1)
+                  for i in range(0, len(axes), 4)])
+        self.positions.invalidate(axes)
+        self.motion.moved(axes, x, relative = True)
 
     def single_step_trackball(self, axis, steps):
         '''
         '''
         ID = '01E8'
-        if steps < 0:
-            steps += 256
-        self.send_command(ID, [axis, steps], 0)
+        self.send_command(ID, (axis, steps), 0)
+        self.positions.invalidate([axis])
 
     def set_single_step_factor_trackball(self, axis, factor):
         ID = '019F'
-        if factor < 0:
-            factor += 256
-        data = (axis, factor)
-        self.send_command(ID, data, 0)
+        self.send_command(ID, (axis, factor), 0)
 
     def single_step(self, axis, steps):
         '''
@@ -235,13 +340,29 @@ class LuigsNeumann_SM10(SerialDevice):
         StepIncrement/StepDecrement commands.
         Uses distance and velocity set by `set_single_step_distance` resp.
         `set_single_step_velocity`.
+        axis can be a list of axes, which then step together.
         '''
         if steps > 0:
             ID = '0140'
         else:
             ID = '0141'
-        for _ in range(int(abs(steps))):
-            self.send_command(ID, [axis], 0)
+        if not isinstance(axis, list):
+            axis = [axis]
+        if all(i in self.step_distance for i in axis):
+            shift = [cmp(steps, 0) * self.step_distance[i] for i in axis]
+        else:
+            shift = None
+        for n in range(int(abs(steps))):
+            if self.compatible_timing:
+                if n > 0:
+                    time.sleep(0.02)
+            elif n > 0 and is_busy([(self, axis)]):
+                # The next step starts when the previous one is done
+                wait_motion([(self, axis)])
+            wait_all([self.send_command_async(ID, (i,), 0) for i in axis])
+            self.positions.invalidate(axis)
+            self.motion.moved(axis, shift, relative = True)
+        if self.compatible_timing:
             time.sleep(0.02)
 
     def set_single_step_distance(self, axis, distance):
@@ -252,8 +373,8 @@ class LuigsNeumann_SM10(SerialDevice):
             print('Step distance too long, setting distance at 255um')
             distance = 255
         ID = '044F'
-        data = [axis] + list(bytearray(struct.pack('f', distance)))
-        self.send_command(ID, data, 0)
+        self.send_command(ID, (axis, distance), 0)
+        self.step_distance[axis] = distance
 
     def set_single_step_velocity(self, axis, velocity):
         ID = '0158'
@@ -267,7 +388,8 @@ class LuigsNeumann_SM10(SerialDevice):
         # Note that the "collection command" STOP (A0FF) only stops
         # a move started with "Procedure + ucVelocity"
         ID = '00FF'
-        self.send_command(ID, [axis], 0)
+        self.send_command(ID, (axis,), 0)
+        self.positions.invalidate([axis])
 
     def set_to_zero(self, axes):
         """
@@ -280,8 +402,8 @@ class LuigsNeumann_SM10(SerialDevice):
         # address = group_address(axes)
         # self.send_command(ID, address, -1)
         ID = '00F0'
-        for axis in axes:
-            self.send_command(ID, [axis], 0)
+        wait_all([self.send_command_async(ID, (axis,), 0) for axis in axes])
+        self.positions.invalidate(axes)
 
     def set_to_zero_second_counter(self, axes):
         """
@@ -294,8 +416,7 @@ class LuigsNeumann_SM10(SerialDevice):
         # address = group_address(axes)
         # self.send_command(ID, address, -1)
         ID = '0132'
-        for axis in axes:
-            self.send_command(ID, [axis, 02], 0)
+        wait_all([self.send_command_async(ID, (axis, 2), 0) for axis in axes])
 
     def go_to_zero(self, axis):
         """
@@ -303,17 +424,46 @@ class LuigsNeumann_SM10(SerialDevice):
         :return:
         """
         ID = '0024'
-        for axes in axis:
-            self.send_command(ID, [axes], 0)
+        wait_all([self.send_command_async(ID, (axes,), 0) for axes in axis])
+        self.positions.invalidate(axis)
+        self.motion.moved(axis, [0.] * len(axis))
 
     def set_ramp_length(self, axis, length):
         """
         Set the ramp length for the chosen axis
-        :param axis: axis which ramp shall be changed
+        :param axis: axis which ramp shall be changed, or list of axes
         :param length: 0<length<=16 
         :return: 
         """
-        self.send_command('003A', [axis, length], 0)
+        if isinstance(axis, list):
+            wait_all([self.send_command_async('003A', (i, length), 0) for i in axis])
+        else:
+            self.send_command('003A', (axis, length), 0)
+            axis = [axis]
+        self.motion.set_ramp(axis, ramp_duration(length))
+
+    def is_moving(self, axes):
+        '''
+        Tells whether axes are moving, with one status query per group of 4 axes.
+        Answers only carry the ID, so the command queue holds each A120 query until
+        the previous one is answered: the cost is one round trip per group of 4 axes.
+
+        Parameters
+        ----------
+        axes : list of axis numbers
+
+        Returns
+        -------
+        A list of booleans.
+        '''
+        groups = [axes[i:i + 4] for i in range(0, len(axes), 4)]
+        futures = [self.send_command_async('A120', group_data(group), 20) for group in groups]
+        moving = []
+        for group, future in zip(groups, futures):
+            # 4 addresses, then 4 status bytes per axis: limit switch, power, motor, resolution
+            ret = status_struct.unpack(future.result())
+            moving.extend(ret[6 + i * 4] != 0 for i in range(len(group)))
+        return moving
 
     def wait_motor_stop(self, axes):
         """
@@ -322,19 +472,9 @@ class LuigsNeumann_SM10(SerialDevice):
         :param axes:
         :return:
         """
-
-        axes4 = [0, 0, 0, 0]
-        axes4[:len(axes)] = axes
-        data = [0xA0] + axes + [0]
-        time.sleep(0.1)  # right after a motor command the motors are not moving yet
-        ret = struct.unpack('20B', self.send_command('A120', data, 20))
-        moving = [ret[6 + i*4] for i in range(len(axes))]
-        is_moving = any(moving)
-        while is_moving:
-            time.sleep(0.05)
-            ret = struct.unpack('20B', self.send_command('A120', data, 20))
-            moving = [ret[6 + i * 4] for i in range(len(axes))]
-            is_moving = any(moving)
+        # Right after a motor command the motors are not moving yet:
+        # the first query waits for the expected end of the move
+        wait_motion([(self, axes)])
 
 
 if __name__ == '__main__':
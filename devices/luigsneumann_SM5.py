@@ -5,17 +5,45 @@ Adapted from Michael Graupner's LandNSM5 class.
 
 """
 from serialdevice import SerialDevice
+from luigsneumann_protocol import FrameEncoder, FrameParser
+from motion import MotionMonitor, wait_motion, ramp_duration
+from positioncache import PositionCache
 import serial
 import binascii
 import time
 import struct
 import warnings
+import weakref
+from threading import Thread, RLock
 from numpy import zeros
 
 __all__ = ['LuigsNeumann_SM5']
 
 verbose = True
 
+# Format of the data field of each command (see FrameEncoder)
+frame_formats = {'0400': '', # establish_connection
+                 '0101': 'B', # position
+                 '0131': 'B', # position_second_counter
+                 '0048': 'Bf', # absolute_move
+                 '004A': 'Bf', # relative_move
+                 '00FF': 'B', # stop
+                 '00f0': 'B', # set_to_zero
+                 '0132': 'BB', # set_to_zero_second_counter
+                 '0024': 'B', # go_to_zero
+                 '0140': 'B', # single_step
+                 '0141': 'B',
+                 '013a': 'Bf', # set_single_step_distance
+                 '003a': 'BB', # set_ramp_length
+                 '0120': 'B'} # wait_motor_stop
+
+# Commands without data in the answer that are safe to send twice.
+# Relative moves and steps (004A, 0140, 0141) are not: if only the acknowledgement
+# was lost, the controller has already executed them.
+repeatable_commands = set(['0400', '0048', '00FF', '00f0', '0132', '0024', '013a', '003a'])
+
+position_struct = struct.Struct('<f')
+
 class LuigsNeumann_SM5(SerialDevice):
     def __init__(self, name=None):
         # Note that the port name is arbitrary, it should be set or found out
@@ -29,56 +57,125 @@ class LuigsNeumann_SM5(SerialDevice):
         self.port.timeout=0.1 #None is blocking; 0 is non blocking
 
         self.port.open()
+        self.encoder = FrameEncoder(frame_formats)
+        self.parser = FrameParser()
+        self.max_retries = 3
+        self.lock = RLock() # commands can be sent from the keep-alive thread
+
+        # Link health
+        self.connection_timeout = 3. # the connection is lost after 3 s without command
+        self.handshake_time = None
+        self.handshake_latency = None
+        self.handshakes = 0
+
+        self.motion = MotionMonitor()
+        self.step_distance = dict()
+        # Positions read less than 50 ms ago are reused, unless the axis was moved
+        self.positions = PositionCache(max_age = .05)
+
         self.established_time = time.time()
         self.establish_connection()
+        self.keep_alive = KeepAlive(self)
+
+    def __del__(self):
+        self.keep_alive.stop()
+        SerialDevice.__del__(self)
 
     def send_command(self, ID, data, nbytes_answer, ack_ID=''):
         '''
         Send a command to the controller
         '''
+        with self.lock:
+            return self._send_command(ID, data, nbytes_answer, ack_ID)
+
+    def _send_command(self, ID, data, nbytes_answer, ack_ID):
         now = time.time()
-        if now - self.established_time > 3:
+        if now - self.established_time > self.connection_timeout:
+            # Normally done in advance by the keep-alive thread
             self.establish_connection()
         self.established_time = now
 
-        high, low = self.CRC_16(data,len(data))
-
-        # Create hex-string to be sent
-        # <syn><ID><byte number>
-        send = '16' + ID + '%0.2X' % len(data)
-
-        # <data>
-        # Loop over length of data to be sent
-        for i in range(len(data)):
-            send += '%0.2X' % data[i]
-
-        # <CRC>
-        send += '%0.2X%0.2X' % (high,low)
-
-        # Convert hex string to bytes
-        sendbytes = binascii.unhexlify(send)
-
-        expected = binascii.unhexlify('06' + ack_ID)
+        # Answers carry the ID of the command
+        expected = binascii.unhexlify(ack_ID or ID)
+        repeatable = nbytes_answer > 0 or ID in repeatable_commands
+
+        for _ in range(self.max_retries + 1):
+            # <syn><ID><byte number><data><CRC>
+            self.port.write(self.encoder.encode(ID, data))
+
+            answer, valid = self.read_answer(expected)
+            if answer is not None and (valid or nbytes_answer == 0):
+                # An acknowledgement with a wrong CRC still means that the command was executed
+                return answer[:nbytes_answer]
+
+            # Drop the remains of the bad answer
+            self.port.reset_input_buffer()
+            self.parser.reset()
+            if not repeatable:
+                raise serial.SerialException('No valid response for command with ID ' + ID +
+                                             ' ; not resent, as it may have been executed')
+            warnings.warn('Did not get expected response for command with ID ' + ID +' ; resending')
 
-        self.port.write(sendbytes)
+        raise serial.SerialException('No valid response for command with ID ' + ID)
 
-        answer = self.port.read(nbytes_answer+6)
+    def read_answer(self, expected=''):
+        '''
+        Reads an answer frame <ACK><ID><byte number><data><CRC>.
 
-        if answer[:len(expected)] != expected :
-            warnings.warn('Did not get expected response for command with ID ' + ID +' ; resending')
-            # Resend
-            return self.send_command(ID, data, nbytes_answer, ack_ID)
+        Parameters
+        ----------
+        expected : expected ID bytes of the answer; if empty, any ID is accepted
 
-        return answer[4:4+nbytes_answer]
+        Returns
+        -------
+        The data of the answer and whether its CRC is valid,
+        or (None, False) if no answer was received before the time out.
+        '''
+        while True:
+            received = self.port.read(self.parser.needed())
+            if not received: # time out
+                return None, False
+            for key, answer, valid in self.parser.feed(received):
+                if key.startswith(expected):
+                    return answer, valid
 
     def establish_connection(self):
         if verbose:
             print "establishing connection"
-        self.established_time = time.time()
-        self.send_command('0400', [], 0, ack_ID='040b')
+        self.handshake()
         if verbose:
             print "connection established"
 
+    def handshake(self):
+        '''
+        Sends the connection handshake and measures its latency.
+        '''
+        with self.lock:
+            t0 = time.time()
+            self.established_time = t0
+            self._send_command('0400', [], 0, '040b')
+            self.handshake_time = time.time()
+            self.handshake_latency = self.handshake_time - t0
+            self.handshakes += 1
+
+    def link_status(self):
+        '''
+        Health of the serial link.
+
+        Returns
+        -------
+        A dictionary with:
+        * last_handshake_age : time since the last handshake, in s
+        * handshake_latency : duration of the last handshake, in s
+        * handshakes : number of handshakes since the connection was opened
+        * idle_time : time since the last command, in s
+        '''
+        now = time.time()
+        return {'last_handshake_age': now - self.handshake_time,
+                'handshake_latency': self.handshake_latency,
+                'handshakes': self.handshakes,
+                'idle_time': now - self.established_time}
+
     def position(self, axis):
         '''
         Current position along an axis.
@@ -91,8 +188,13 @@ class LuigsNeumann_SM5(SerialDevice):
         -------
         The current position of the device axis in um.
         '''
-        res = self.send_command('0101', [axis], 4)
-        return struct.unpack('f', res)[0]
+        x = self.positions.get([axis])[0]
+        if x is None:
+            token = self.positions.token()
+            res = self.send_command('0101', (axis,), 4)
+            x = position_struct.unpack(res)[0]
+            self.positions.update([axis], [x], token)
+        return x
 
     def position_second_counter(self, axis):
         '''
@@ -106,8 +208,8 @@ class LuigsNeumann_SM5(SerialDevice):
         -------
         The current position of the device axis in um.
         '''
-        res = self.send_command('0131', [axis], 4)
-        return struct.unpack('f', res)[0]
+        res = self.send_command('0131', (axis,), 4)
+        return position_struct.unpack(res)[0]
 
     def absolute_move(self, x, axis):
         '''
@@ -120,10 +222,10 @@ class LuigsNeumann_SM5(SerialDevice):
         x : target position in um.
         speed : optional speed in um/s.
         '''
-        x_hex = binascii.hexlify(struct.pack('>f', x))
-        data = [axis, int(x_hex[6:], 16), int(x_hex[4:6], 16), int(x_hex[2:4], 16), int(x_hex[:2], 16)]
         # TODO: always goes fast (use 0049 for slow)
-        self.send_command('0048', data, 0)
+        self.send_command('0048', (axis, x), 0)
+        self.positions.invalidate([axis])
+        self.motion.moved([axis], [x])
 
     def absolute_move_group(self, x, axes):
         for i in range(len(x)):
@@ -140,15 +242,16 @@ class LuigsNeumann_SM5(SerialDevice):
         axis: axis number
         x : position shift in um.
         '''
-        x_hex = binascii.hexlify(struct.pack('>f', x))
-        data = [axis, int(x_hex[6:], 16), int(x_hex[4:6], 16), int(x_hex[2:4], 16), int(x_hex[:2], 16)]
-        self.send_command('004A', data, 0)
+        self.send_command('004A', (axis, x), 0)
+        self.positions.invalidate([axis])
+        self.motion.moved([axis], [x], relative = True)
 
     def stop(self, axis):
         """
         Stop current movements.
         """
-        self.send_command('00FF', [axis], 0)
+        self.send_command('00FF', (axis,), 0)
+        self.positions.invalidate([axis])
 
     def set_to_zero(self, axis):
         """
@@ -157,7 +260,8 @@ class LuigsNeumann_SM5(SerialDevice):
         :return: 
         """
         for axes in axis:
-            self.send_command('00f0', [axes], 0)
+            self.send_command('00f0', (axes,), 0)
+        self.positions.invalidate(axis)
 
     def set_to_zero_second_counter(self, axes):
         """
@@ -171,7 +275,7 @@ class LuigsNeumann_SM5(SerialDevice):
         # self.send_command(ID, address, -1)
         ID = '0132'
         for axis in axes:
-            self.send_command(ID, [axis, 02], 0)
+            self.send_command(ID, (axis, 2), 0)
 
     def go_to_zero(self, axis):
         """
@@ -180,7 +284,9 @@ class LuigsNeumann_SM5(SerialDevice):
         """
         ID = '0024'
         for axes in axis:
-            self.send_command(ID, [axes], 0)
+            self.send_command(ID, (axes,), 0)
+        self.positions.invalidate(axis)
+        self.motion.moved(axis, [0.] * len(axis))
 
     def single_step(self, axis, steps):
         '''
@@ -189,13 +295,20 @@ class LuigsNeumann_SM5(SerialDevice):
         StepIncrement/StepDecrement commands.
         Uses distance and velocity set by `set_single_step_distance` resp.
         `set_single_step_velocity`.
+        axis can be a list of axes.
         '''
+        if isinstance(axis, list):
+            for i in axis:
+                self.single_step(i, steps)
+            return
         if steps > 0:
             ID = '0140'
         else:
             ID = '0141'
         for _ in range(int(abs(steps))):
-            self.send_command(ID, [axis], 0)
+            self.send_command(ID, (axis,), 0)
+            self.positions.invalidate([axis])
+            self.motion.moved([axis], [self.step_distance.get(axis)], relative = True)
             self.wait_motor_stop([axis])
 
     def set_single_step_distance(self, axis, distance):
@@ -206,18 +319,36 @@ class LuigsNeumann_SM5(SerialDevice):
             print('Step distance too long, setting distance at 255um')
             distance = 255
         ID = '013a'
-        data = [axis] + list(bytearray(struct.pack('f', distance)))
-        self.send_command(ID, data, 0)
+        self.send_command(ID, (axis, distance), 0)
+        self.step_distance[axis] = distance
 
     def set_ramp_length(self, axis, length):
         """
         Set the ramp length for the chosen axis
-        :param axis: axis which ramp shall be changed
+        :param axis: axis which ramp shall be changed, or list of axes
         :param length: 0<length<=16 
         :return: 
         """
-        self.send_command('003a', [axis, length], 0)
-        pass
+        if isinstance(axis, list):
+            for i in axis:
+                self.set_ramp_length(i, length)
+        else:
+            self.send_command('003a', (axis, length), 0)
+            self.motion.set_ramp([axis], ramp_duration(length))
+
+    def is_moving(self, axes):
+        '''
+        Tells whether axes are moving.
+
+        Parameters
+        ----------
+        axes : list of axis numbers
+
+        Returns
+        -------
+        A list of booleans.
+        '''
+        return [ord(self.send_command('0120', (axis,), 7)[6]) & 0x0F != 0 for axis in axes]
 
     def wait_motor_stop(self, axis):
         """
@@ -225,10 +356,49 @@ class LuigsNeumann_SM5(SerialDevice):
         :param axis: 
         :return: 
         """
-        res = 1
-        while res:
-            res = self.send_command('0120', axis, 7)
-            res = int(binascii.hexlify(struct.unpack('s', res[6])[0])[1])
+        wait_motion([(self, axis)])
+
+
+class KeepAlive(Thread):
+    '''
+    Sends the connection handshake while the controller is idle,
+    so that commands never have to re-establish the connection.
+    '''
+    def __init__(self, dev, margin = 1.):
+        '''
+        Parameters
+        ----------
+        dev : the SM-5 device
+        margin : the handshake is sent this long (in s) before the connection times out
+        '''
+        Thread.__init__(self)
+        self.daemon = True
+        self.dev = weakref.ref(dev) # does not keep the device alive
+        self.margin = margin
+        self.running = True
+        self.start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        while self.running:
+            dev = self.dev()
+            if dev is None:
+                return
+            idle_limit = dev.connection_timeout - self.margin
+            wait = dev.established_time + idle_limit - time.time()
+            if wait <= 0:
+                with dev.lock:
+                    # A command may have been sent in the meantime
+                    if time.time() - dev.established_time >= idle_limit:
+                        try:
+                            dev.handshake()
+                        except serial.SerialException:
+                            warnings.warn('Keep-alive handshake failed')
+                wait = idle_limit
+            del dev
+            time.sleep(wait)
 
 
 if __name__ == '__main__':
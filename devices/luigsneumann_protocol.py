@@ -0,0 +1,223 @@
+"""
+Binary frames of the Luigs and Neumann serial protocol (SM-5 and SM-10).
+
+A command frame is:
+<syn><ID><byte number><data><CRC>
+where syn is 0x16, ID is two bytes (MSB first), CRC is the CRC-16 checksum of data (MSB first).
+Numbers in the data field are little-endian (floats in IEEE format).
+Answers have the same structure, starting with <ACK> (0x06) instead of <syn>.
+"""
+import binascii
+import struct
+from serialdevice import crc_16
+
+__all__ = ['FrameEncoder', 'FrameParser', 'encode_frame']
+
+# Longest data field: group moves, <A0><4 addresses><4 floats>
+max_data_length = 21
+
+SYN = 0x16
+ACK = 0x06
+
+
+class FrameEncoder(object):
+    '''
+    Builds command frames in a reusable buffer.
+    Each command ID has a precompiled struct format for its data field.
+    '''
+    def __init__(self, formats = None):
+        '''
+        Parameters
+        ----------
+        formats : dictionary of command ID (hex string) -> struct format of the data field
+        '''
+        self.buffer = bytearray(max_data_length + 6)
+        self.view = memoryview(self.buffer)
+        self.commands = dict()
+        if formats is not None:
+            for ID, fmt in formats.items():
+                self.register(ID, fmt)
+
+    def register(self, ID, fmt):
+        '''
+        Sets the struct format of the data field for a command.
+
+        Parameters
+        ----------
+        ID : command ID as a hex string, eg 'A048'
+        fmt : struct format of the data field, without byte order (always little-endian)
+        '''
+        packer = struct.Struct('<' + fmt)
+        if packer.size > max_data_length:
+            raise ValueError('Data field of command %s is too long' % ID)
+        header = bytearray(binascii.unhexlify('16' + ID)) + bytearray([packer.size])
+        self.commands[ID] = (header, packer)
+
+    def register_raw(self, ID, length):
+        '''
+        Sets a raw format (sequence of bytes) for a command with a given data length.
+        '''
+        self.commands[(ID, length)] = (bytearray(binascii.unhexlify('16' + ID)) + bytearray([length]),
+                                       struct.Struct('<%dB' % length))
+
+    def encode(self, ID, data):
+        '''
+        Builds the frame for a command.
+        The returned view is only valid until the next call.
+
+        Parameters
+        ----------
+        ID : command ID as a hex string
+        data : values of the data field, following the command format;
+               for commands without a registered format, a sequence of bytes
+
+        Returns
+        -------
+        A memoryview on the frame.
+        '''
+        try:
+            header, packer = self.commands[ID]
+        except KeyError:
+            # Raw bytes
+            key = (ID, len(data))
+            if key not in self.commands:
+                self.register_raw(ID, len(data))
+            header, packer = self.commands[key]
+        try:
+            packer.pack_into(self.buffer, 4, *data)
+        except struct.error as e:
+            raise ValueError('Invalid data for command %s: %s' % (ID, e))
+        buf = self.buffer
+        buf[:4] = header
+        n = packer.size + 4
+        crc = crc_16(buf[4:n])
+        buf[n] = crc >> 8
+        buf[n + 1] = crc & 0xFF
+        return self.view[:n + 2]
+
+
+def encode_frame(start_byte, ID, data):
+    '''
+    Builds a frame <start byte><ID><byte number><data><CRC>.
+
+    Parameters
+    ----------
+    start_byte : SYN for commands, ACK for answers
+    ID : the two ID bytes
+    data : the data field (bytes)
+    '''
+    data = bytearray(data)
+    crc = crc_16(data)
+    return bytes(bytearray([start_byte]) + bytearray(ID) + bytearray([len(data)]) + data +
+                 bytearray([crc >> 8, crc & 0xFF]))
+
+
+class FrameParser(object):
+    '''
+    Incremental parser of answer frames <ACK><ID><byte number><data><CRC>
+    (or of command frames, starting with <syn>).
+
+    Bytes are fed as they are read from the port. The parser resynchronizes on the
+    first byte, uses the byte number to find the end of the frame and checks the CRC.
+    A frame with a wrong CRC is reported only if it is followed by the start of a frame
+    (or by nothing) and was not found while resynchronizing: otherwise it may be
+    a start byte inside corrupted data, and it is skipped one byte at a time.
+    Framing errors are counted:
+    * discarded_bytes : bytes skipped to find the start of a frame
+    * length_errors : headers with an impossible byte number
+    * crc_errors : frames with a wrong CRC that are reported
+    '''
+    def __init__(self, start_byte = ACK):
+        '''
+        Parameters
+        ----------
+        start_byte : first byte of frames (ACK for answers, SYN for commands)
+        '''
+        self.start_byte = start_byte
+        self.start_char = chr(start_byte)
+        self.buffer = bytearray()
+        self.start = 0 # start of unparsed data in the buffer
+        self.resynchronizing = False # bytes were skipped since the last valid frame
+        self.frames = 0
+        self.discarded_bytes = 0
+        self.length_errors = 0
+        self.crc_errors = 0
+
+    def reset(self):
+        '''
+        Discards unparsed bytes.
+        '''
+        self.discarded_bytes += len(self.buffer) - self.start
+        del self.buffer[:]
+        self.start = 0
+        self.resynchronizing = False
+
+    def needed(self):
+        '''
+        Number of bytes needed to complete the current frame (at least 1).
+        '''
+        available = len(self.buffer) - self.start
+        if available < 4:
+            return 4 - available
+        return max(1, self.buffer[self.start + 3] + 6 - available)
+
+    def feed(self, data):
+        '''
+        Parses received bytes.
+
+        Parameters
+        ----------
+        data : received bytes
+
+        Returns
+        -------
+        A list of (ID, data, valid) for each complete frame, where ID is the two ID bytes
+        and valid is False if the CRC is wrong (see above for when such frames are reported).
+        '''
+        buf = self.buffer
+        buf += data
+        frames = []
+        i = self.start
+        end = len(buf)
+        while end - i >= 4:
+            if buf[i] != self.start_byte:
+                # Resynchronize on the next start byte
+                j = buf.find(self.start_char, i + 1)
+                if j < 0:
+                    j = end
+                self.discarded_bytes += j - i
+                self.resynchronizing = True
+                i = j
+                continue
+            n = buf[i + 3]
+            if n > max_data_length:
+                self.length_errors += 1
+                self.discarded_bytes += 1
+                self.resynchronizing = True
+                i += 1
+                continue
+            if end - i < n + 6:
+                break
+            frame_data = bytes(buf[i + 4:i + 4 + n])
+            crc = buf[i + 4 + n] << 8 | buf[i + 5 + n]
+            if crc_16(frame_data) == crc:
+                self.frames += 1
+                self.resynchronizing = False
+                frames.append((bytes(buf[i + 1:i + 3]), frame_data, True))
+                i += n + 6
+            elif not self.resynchronizing and (end == i + n + 6 or buf[i + n + 6] == self.start_byte):
+                # A corrupted frame, with consistent length
+                self.crc_errors += 1
+                frames.append((bytes(buf[i + 1:i + 3]), frame_data, False))
+                i += n + 6
+            else:
+                # Possibly a stray start byte: resynchronize
+                self.discarded_bytes += 1
+                self.resynchronizing = True
+                i += 1
+        # Compact the buffer once the parsed part is large
+        if i > 256 or i == end:
+            del buf[:i]
+            i = 0
+        self.start = i
+        return frames
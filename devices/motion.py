@@ -0,0 +1,274 @@
+"""
+Motion completion: waits for the end of moves with adaptive polling.
+
+Each device has a MotionMonitor that records the moves commanded on its axes.
+When waiting, the first status query is delayed by the expected duration of the move,
+estimated from the commanded distance, the ramp length and the speed observed on
+previous moves. Then the polling interval grows exponentially.
+Settle times are collected in a histogram, logged periodically (logger 'motion').
+
+A device supports this by implementing `is_moving(axes)`, which should query
+the status of all axes with as few commands as possible.
+"""
+import time
+import logging
+from numpy import array
+
+__all__ = ['MotionMonitor', 'wait_motion', 'is_busy', 'ramp_duration']
+
+logger = logging.getLogger(__name__)
+
+# Duration of the acceleration ramp of L&N controllers, in s, for stages 1-16
+ramp_durations = [.15, .18, .21, .24, .27, .30, .33, .36, .39, .42, .45, .48, .51, .53, .57, .60]
+
+# Bins of settle time histograms, in s
+settle_bins = array([0., .05, .1, .2, .5, 1., 2., 5., 1e9])
+
+
+def ramp_duration(stage):
+    '''
+    Duration in s of the acceleration ramp of L&N controllers for a ramp length stage (1-16).
+    '''
+    return ramp_durations[min(max(int(stage), 1), 16) - 1]
+
+
+class MotionMonitor(object):
+    '''
+    Records the moves of a device and estimates when they end.
+    '''
+    def __init__(self, speed = 2000., ramp = .15, start_delay = .1,
+                 min_interval = .01, max_interval = .1, backoff = 2., log_every = 100):
+        '''
+        Parameters
+        ----------
+        speed : initial estimate of the speed in um/s (learned from moves)
+        ramp : default duration of acceleration ramps in s
+        start_delay : time after a command before the motors are reported moving, in s
+        min_interval : first polling interval, in s
+        max_interval : longest polling interval, in s
+        backoff : growth factor of the polling interval
+        log_every : number of settles between two logs of the settle time histogram (0: never)
+        '''
+        self.default_speed = speed
+        self.default_ramp = ramp
+        self.start_delay = start_delay
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.log_every = log_every
+        self.speed = dict() # axis -> estimated speed
+        self.ramp = dict() # axis -> ramp duration
+        self.target = dict() # axis -> last commanded position
+        self.moves = dict() # axis -> (start time, distance)
+        self.previous = dict() # axis -> position at the previous query (see Device.is_moving)
+        self.settle_counts = [0] * (len(settle_bins) - 1)
+        self.settles = 0
+
+    def set_ramp(self, axes, duration):
+        '''
+        Sets the duration of the acceleration ramp of axes, in s.
+        '''
+        for axis in axes:
+            self.ramp[axis] = duration
+
+    def moved(self, axes, x = None, relative = False):
+        '''
+        Records moves commanded on axes.
+
+        Parameters
+        ----------
+        axes : list of axes
+        x : target positions, or shifts if relative is True; None if unknown
+        relative : True for relative moves
+        '''
+        now = time.time()
+        for i, axis in enumerate(axes):
+            distance = None
+            if x is not None and x[i] is not None:
+                if relative:
+                    distance = abs(x[i])
+                    if axis in self.target:
+                        self.target[axis] += x[i]
+                else:
+                    if axis in self.target:
+                        distance = abs(x[i] - self.target[axis])
+                    self.target[axis] = x[i]
+            else:
+                self.target.pop(axis, None)
+            self.moves[axis] = (now, distance)
+
+    def expected_end(self, axis):
+        '''
+        Expected end time of the last move of an axis, or None if there is no recorded move.
+        '''
+        if axis not in self.moves:
+            return None
+        start, distance = self.moves[axis]
+        duration = self.ramp.get(axis, self.default_ramp)
+        if distance is not None:
+            duration += distance / self.speed.get(axis, self.default_speed)
+        return start + max(duration, self.start_delay)
+
+    def first_poll(self, axes):
+        '''
+        Time of the first status query when waiting for axes.
+        '''
+        ends = [self.expected_end(axis) for axis in axes]
+        ends = [end for end in ends if end is not None]
+        if not ends:
+            return time.time()
+        return max(ends)
+
+    def settled(self, axes, t, seen_moving, early):
+        '''
+        Records that axes were found still at time t, updates speed estimates
+        and the settle time histogram, which is logged every `log_every` settles.
+
+        Parameters
+        ----------
+        axes : list of axes
+        t : time of the status query
+        seen_moving : True if the axes were moving at the previous query
+        early : True if the first query was at the expected end of the moves
+        '''
+        for axis in axes:
+            move = self.moves.pop(axis, None) # None if already settled in another wait
+            if move is None:
+                continue
+            start, distance = move
+            settle = t - start
+            self.settle_counts[settle_bins.searchsorted(settle, 'right') - 1] += 1
+            self.settles += 1
+            logger.debug('axis %s settled after %.3f s', axis, settle)
+            if self.log_every and self.settles % self.log_every == 0:
+                self.log_histogram()
+            if not distance:
+                continue
+            speed = self.speed.get(axis, self.default_speed)
+            moving_time = settle - self.ramp.get(axis, self.default_ramp)
+            if seen_moving:
+                # The end of the move is known within one polling interval
+                if moving_time > 0:
+                    self.speed[axis] = .7 * speed + .3 * distance / moving_time
+            elif early:
+                # Still at the first query: the move was faster than expected
+                self.speed[axis] = speed * 1.2
+
+    def settle_histogram(self):
+        '''
+        Histogram of settle times (time from the move command to the end of the wait).
+
+        Returns
+        -------
+        bins (s), counts
+        '''
+        return settle_bins, array(self.settle_counts)
+
+    def log_histogram(self):
+        '''
+        Logs the settle time histogram.
+        '''
+        lines = ['%g-%g s: %d' % (settle_bins[i], settle_bins[i + 1], n)
+                 for i, n in enumerate(self.settle_counts) if n]
+        logger.info('Settle times: ' + ', '.join(lines))
+
+
+def monitor(dev):
+    '''
+    The motion monitor of a device, created if necessary.
+    '''
+    try:
+        return dev.motion
+    except AttributeError:
+        dev.motion = MotionMonitor()
+        return dev.motion
+
+
+def resolve(groups):
+    '''
+    Resolves units to the underlying devices and merges the axes of each device.
+    Units define `motion_groups(axes)`, which returns a list of (device, axes).
+
+    Parameters
+    ----------
+    groups : list of (device or unit, list of axes); for units, None means all axes
+
+    Returns
+    -------
+    A list of (device, list of axes), with each device once.
+    '''
+    devices = []
+    merged = dict()
+    for dev, axes in groups:
+        if hasattr(dev, 'motion_groups'):
+            if axes is not None:
+                axes = list(axes)
+            subgroups = resolve(dev.motion_groups(axes))
+        else:
+            subgroups = [(dev, axes)]
+        for dev, axes in subgroups:
+            if id(dev) not in merged:
+                devices.append(dev)
+                merged[id(dev)] = []
+            merged[id(dev)].extend(axis for axis in axes if axis not in merged[id(dev)])
+    return [(dev, merged[id(dev)]) for dev in devices]
+
+
+def is_busy(groups):
+    '''
+    Tells whether any axis of several devices or units is moving.
+    Axes that were commanded to move less than `start_delay` ago are busy,
+    even if the device does not report them moving yet.
+
+    Parameters
+    ----------
+    groups : list of (device or unit, list of axes)
+    '''
+    now = time.time()
+    for dev, axes in resolve(groups):
+        if not axes:
+            continue
+        motion = monitor(dev)
+        if any(now - motion.moves[axis][0] < motion.start_delay for axis in axes if axis in motion.moves):
+            return True
+        motion.previous.clear()
+        if any(dev.is_moving(axes)):
+            return True
+    return False
+
+
+def wait_motion(groups):
+    '''
+    Waits until all axes of several devices or units are still.
+    Devices are polled independently, each with one `is_moving` call per query.
+
+    Parameters
+    ----------
+    groups : list of (device or unit, list of axes)
+    '''
+    # [device, monitor, remaining axes, next poll time, interval, first query is early]
+    waiting = []
+    start = time.time()
+    for dev, axes in resolve(groups):
+        if not axes:
+            continue
+        motion = monitor(dev)
+        motion.previous.clear()
+        first_poll = motion.first_poll(axes)
+        waiting.append([dev, motion, axes, first_poll, motion.min_interval, first_poll > start])
+    while waiting:
+        item = min(waiting, key = lambda item: item[3])
+        dev, motion, axes, next_poll, interval, early = item
+        delay = next_poll - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        moving = dev.is_moving(axes)
+        now = time.time()
+        seen_moving = interval > motion.min_interval # not the first query
+        motion.settled([axis for axis, m in zip(axes, moving) if not m], now, seen_moving, early)
+        item[2] = [axis for axis, m in zip(axes, moving) if m]
+        if not item[2]:
+            waiting.remove(item)
+        else:
+            item[3] = now + interval
+            item[4] = min(interval * motion.backoff, motion.max_interval)
@@ -0,0 +1,101 @@
+"""
+Position snapshots shared by the units of a controller.
+
+A controller keeps the last position read on each axis for a short time
+(the staleness window), so that several widgets or units reading the same axes
+within one tick only query the controller once. Any move of an axis invalidates
+its cached position.
+"""
+import time
+from threading import Lock
+from motion import resolve
+
+__all__ = ['PositionCache', 'prefetch_positions']
+
+
+class PositionCache(object):
+    '''
+    Last read positions of the axes of a device.
+    '''
+    def __init__(self, max_age = .05):
+        '''
+        Parameters
+        ----------
+        max_age : staleness window in s; 0 disables the cache
+        '''
+        self.max_age = max_age
+        self.lock = Lock()
+        self.positions = dict() # axis -> (time of the read, position)
+        self.invalidated = dict() # axis -> generation of the last invalidation
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, axes):
+        '''
+        Cached positions of axes, or None for axes with no fresh position.
+        '''
+        now = time.time()
+        values = []
+        with self.lock:
+            for axis in axes:
+                t, x = self.positions.get(axis, (None, None))
+                if t is None or now - t > self.max_age:
+                    values.append(None)
+                    self.misses += 1
+                else:
+                    values.append(x)
+                    self.hits += 1
+        return values
+
+    def token(self):
+        '''
+        Token to pass to `update` for a read starting now.
+        '''
+        with self.lock:
+            return self.generation
+
+    def update(self, axes, values, token):
+        '''
+        Stores positions read on axes, unless an axis moved since the read started.
+
+        Parameters
+        ----------
+        axes : list of axes
+        values : positions
+        token : value of `token()` before the read
+        '''
+        if self.max_age <= 0:
+            return
+        now = time.time()
+        with self.lock:
+            for axis, x in zip(axes, values):
+                if self.invalidated.get(axis, -1) <= token:
+                    self.positions[axis] = (now, x)
+
+    def invalidate(self, axes = None):
+        '''
+        Discards the positions of axes (all axes if None), eg after a move.
+        '''
+        with self.lock:
+            self.generation += 1
+            if axes is None:
+                axes = self.positions.keys()
+            for axis in axes:
+                self.positions.pop(axis, None)
+                self.invalidated[axis] = self.generation
+
+
+def prefetch_positions(units):
+    '''
+    Reads the positions of several units with as few queries as possible,
+    so that subsequent position reads within the staleness window use the cache.
+
+    Parameters
+    ----------
+    units : list of units; all their axes are read
+    '''
+    for dev, axes in resolve([(unit, None) for unit in units]):
+        # Only devices with a position cache
+        if hasattr(dev, 'positions'):
+            dev.position_group(axes)
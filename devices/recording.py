@@ -0,0 +1,215 @@
+"""
+Recording and replay of trajectories of units.
+
+A Trajectory stores timestamped positions of all axes of several units in
+columns (an array of times, an array of positions with one column per axis),
+saved in a compact binary file (numpy .npz).
+
+    recorder = TrajectoryRecorder([stage, manipulator])
+    recorder.start()
+    ...
+    trajectory = recorder.stop()
+    trajectory.save('protocol.npz')
+
+    replay([stage, manipulator], Trajectory.load('protocol.npz'), speed = None)
+
+Replay resamples the trajectory to the fewest waypoints within a tolerance
+(Ramer-Douglas-Peucker), and sends one coordinated group move per waypoint.
+"""
+from threading import Thread, Event
+import time
+from numpy import array, zeros, empty, concatenate, cumsum, load, savez
+from numpy.linalg import norm
+from positioncache import prefetch_positions
+from coordinator import coordinated_move
+from motion import wait_motion, resolve, monitor
+
+__all__ = ['Trajectory', 'TrajectoryRecorder', 'replay', 'simplify']
+
+
+class Trajectory(object):
+    '''
+    Timestamped positions of the axes of several units.
+    '''
+    def __init__(self, sizes, capacity = 1024):
+        '''
+        Parameters
+        ----------
+        sizes : number of axes of each unit
+        capacity : initial number of samples
+        '''
+        self.sizes = list(sizes)
+        self._times = empty(capacity)
+        self._positions = empty((capacity, sum(self.sizes)))
+        self.n = 0
+
+    @property
+    def times(self):
+        return self._times[:self.n]
+
+    @property
+    def positions(self):
+        return self._positions[:self.n]
+
+    def __len__(self):
+        return self.n
+
+    def append(self, t, x):
+        '''
+        Adds a sample: time t in s, and positions of all axes x.
+        '''
+        if self.n == len(self._times): # double the capacity
+            self._times = concatenate([self._times, empty(self.n)])
+            self._positions = concatenate([self._positions, empty(self._positions.shape)])
+        self._times[self.n] = t
+        self._positions[self.n] = x
+        self.n += 1
+
+    def unit_positions(self, positions):
+        '''
+        Splits rows of positions into the positions of each unit.
+        '''
+        bounds = cumsum([0] + self.sizes)
+        return [positions[..., bounds[i]:bounds[i + 1]] for i in range(len(self.sizes))]
+
+    def save(self, filename):
+        savez(filename, times = self.times, positions = self.positions, sizes = array(self.sizes))
+
+    @staticmethod
+    def load(filename):
+        data = load(filename)
+        trajectory = Trajectory(data['sizes'], capacity = max(len(data['times']), 1))
+        trajectory.n = len(data['times'])
+        trajectory._times[:trajectory.n] = data['times']
+        trajectory._positions[:trajectory.n] = data['positions']
+        return trajectory
+
+
+class TrajectoryRecorder(Thread):
+    '''
+    Records the positions of units at regular intervals.
+    Positions are read through the position caches of the devices (see `prefetch_positions`),
+    so recording adds at most one group query per 4 axes of each device and interval
+    (group queries of a device follow each other, one round trip each).
+    '''
+    def __init__(self, units, interval = .05):
+        '''
+        Parameters
+        ----------
+        units : list of units
+        interval : sampling interval in s
+        '''
+        Thread.__init__(self)
+        self.daemon = True
+        self.units = units
+        self.interval = interval
+        self.stopped = Event()
+        self.trajectory = None
+
+    def read(self):
+        prefetch_positions(self.units)
+        return concatenate([array(unit.position(), dtype = float).ravel() for unit in self.units])
+
+    def run(self):
+        start = time.time()
+        x = self.read()
+        sizes = [len(array(unit.position()).ravel()) for unit in self.units]
+        self.trajectory = Trajectory(sizes)
+        self.trajectory.append(0., x)
+        next_sample = start + self.interval
+        while not self.stopped.wait(max(next_sample - time.time(), 0)):
+            now = time.time()
+            self.trajectory.append(now - start, self.read())
+            next_sample = max(next_sample + self.interval, now)
+
+    def stop(self):
+        '''
+        Stops recording and returns the trajectory.
+        '''
+        self.stopped.set()
+        self.join()
+        return self.trajectory
+
+
+def simplify(positions, tolerance):
+    '''
+    Indexes of the positions to keep so that the polyline through them
+    stays within tolerance of all positions (Ramer-Douglas-Peucker).
+
+    Parameters
+    ----------
+    positions : N x d array
+    tolerance : maximum distance in um
+
+    Returns
+    -------
+    Sorted array of indexes, including the first and last.
+    '''
+    n = len(positions)
+    if n < 3:
+        return array(range(n), dtype = int)
+    keep = zeros(n, dtype = bool)
+    keep[0] = keep[-1] = True
+    segments = [(0, n - 1)]
+    while segments:
+        i, j = segments.pop()
+        if j - i < 2:
+            continue
+        # Distances of the intermediate points to the segment (vectorized)
+        a, b = positions[i], positions[j]
+        u = b - a
+        length2 = (u ** 2).sum()
+        d = positions[i + 1:j] - a
+        if length2 > 0:
+            s = (d.dot(u) / length2).clip(0, 1)
+            d = d - s[:, None] * u
+        distance = norm(d, axis = 1)
+        k = distance.argmax()
+        if distance[k] > tolerance:
+            k += i + 1
+            keep[k] = True
+            segments.extend([(i, k), (k, j)])
+    return keep.nonzero()[0]
+
+
+def replay(units, trajectory, speed = 1., tolerance = 1.):
+    '''
+    Replays a trajectory with the fewest group moves within tolerance.
+
+    Parameters
+    ----------
+    units : list of units, as recorded
+    trajectory : a Trajectory
+    speed : time scaling factor (2 = twice as fast); if None, at full controller speed,
+            each waypoint being sent when the previous one is expected to be reached
+            (within tolerance, given the speed of the axes)
+    tolerance : maximum deviation of the path of waypoints from the recorded positions, in um
+    '''
+    indexes = simplify(trajectory.positions, tolerance)
+    times, positions = trajectory.times[indexes], trajectory.positions[indexes]
+    start = time.time()
+    for t, x in zip(times, positions):
+        if speed is None:
+            delay = arrival(units, tolerance) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        else:
+            delay = start + (t - times[0]) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        coordinated_move(list(zip(units, trajectory.unit_positions(x))), relative = False)
+    wait_motion([(unit, None) for unit in units])
+
+
+def arrival(units, tolerance):
+    '''
+    Time when the axes of units are expected to be within tolerance of their targets.
+    '''
+    arrivals = [time.time()]
+    for dev, axes in resolve([(unit, None) for unit in units]):
+        motion = monitor(dev)
+        for axis in axes:
+            end = motion.expected_end(axis)
+            if end is not None:
+                arrivals.append(end - tolerance / motion.speed.get(axis, motion.default_speed))
+    return max(arrivals)
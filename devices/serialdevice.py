@@ -4,10 +4,47 @@ a device that communicates through the serial port.
 """
 from device import Device
 import serial
-import ctypes
 from serial.tools import list_ports
 
-__all__ = ['SerialDevice']
+__all__ = ['SerialDevice', 'crc_16']
+
+
+def make_crc_table(polynom=0x1021):
+    '''
+    Lookup table for the CRC-16 checksum (one entry per byte value).
+    '''
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = (crc << 1 ^ polynom) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+        table.append(crc)
+    return table
+
+crc_table = make_crc_table()
+
+
+def crc_16(data, crc=0):
+    '''
+    CRC-16 checksum (polynom 0x1021) of data.
+
+    Parameters
+    ----------
+    data : bytes, bytearray or list of integers
+    crc : checksum of the preceding data, to calculate the checksum incrementally
+
+    Returns
+    -------
+    The checksum as a 16-bit integer.
+    '''
+    table = crc_table
+    for byte in bytearray(data):
+        crc = (crc << 8 & 0xFF00) ^ table[crc >> 8 ^ byte]
+    return crc
+
 
 class SerialDevice(Device):
     '''
@@ -32,24 +69,48 @@ class SerialDevice(Device):
 
     def CRC_16(self, butter, length):
         # Calculate CRC-16 checksum based on the data sent
-        #
-        crc_polynom = 0x1021
+        crc = crc_16(butter[:length])
+        return (crc >> 8, crc & 0xFF)
+
+    def check_CRC(self, data, crc):
+        '''
+        Checks the CRC-16 checksum of received data.
+
+        Parameters
+        ----------
+        data : received data bytes
+        crc : the two checksum bytes (MSB first) that followed the data
+
+        Returns
+        -------
+        True if the checksum is correct.
+        '''
+        crc = bytearray(crc)
+        return len(crc) == 2 and crc_16(data) == (crc[0] << 8 | crc[1])
+
+if __name__ == '__main__':
+    import timeit
+
+    def bitwise_CRC_16(butter, length):
+        # Previous implementation, as in the controller documentation
         crc = 0
-        n = 0
-        lll = length
-        while (lll > 0):
+        for n in range(length):
             crc = crc ^ butter[n] << 8
             for _ in range(8):
                 if (crc & 0x8000):
-                    crc = crc << 1 ^ crc_polynom
+                    crc = crc << 1 ^ 0x1021
                 else:
                     crc = crc << 1
-            lll -= 1
-            n += 1
-        crc_high = ctypes.c_ubyte(crc >> 8)
-        crc_low = ctypes.c_ubyte(crc)
-        return (crc_high.value, crc_low.value)
+        return ((crc >> 8) & 0xFF, crc & 0xFF)
+
+    # A 21-byte group move (A048) and a 5-byte status query (A120)
+    for data in [[0xA0, 1, 2, 3, 0] + range(16), [0xA0, 7, 8, 9, 0]]:
+        crc = crc_16(data)
+        assert (crc >> 8, crc & 0xFF) == bitwise_CRC_16(data, len(data))
+        n = 10000
+        t_bitwise = timeit.timeit(lambda: bitwise_CRC_16(data, len(data)), number=n)
+        t_table = timeit.timeit(lambda: crc_16(data), number=n)
+        print('%d bytes: bitwise %.2f us, table %.2f us' % (len(data), t_bitwise / n * 1e6, t_table / n * 1e6))
 
-if __name__ == '__main__':
     for port in list_ports.comports():
         print(port)
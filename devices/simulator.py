@@ -0,0 +1,384 @@
+"""
+A software simulator of the Luigs and Neumann SM-10 and SM-5 controllers.
+
+The simulator runs in a thread and speaks the binary protocol on the master side
+of a pseudo-terminal (Unix only). The devices connect to the slave side unmodified:
+
+    sim = ControllerSimulator()
+    sm10 = LuigsNeumann_SM10(sim.port_name)
+
+Each axis has a position, a velocity (fast and slow stages), a ramp length and
+a step distance, and moves with a trapezoidal velocity profile (a new target
+while moving in the same direction is reached without stopping). Answers are sent
+after a configurable latency plus the transmission time at the baud rate.
+"""
+from threading import Thread
+import os
+import pty
+import tty
+import select
+import struct
+import heapq
+import time
+from luigsneumann_protocol import FrameParser, encode_frame, SYN, ACK
+from motion import ramp_duration
+from luigsneumann_SM10 import fast_velocities, slow_velocities, full_steps, pitches
+
+__all__ = ['ControllerSimulator', 'SimulatedAxis']
+
+float_struct = struct.Struct('<f')
+group_struct = struct.Struct('<5B4f')
+
+
+class SimulatedAxis(object):
+    '''
+    An axis moving with a trapezoidal velocity profile.
+    Positions are in um; the acceleration ramp lasts `ramp` s.
+    '''
+    def __init__(self, pitch = 1000., fast_stage = 4, slow_stage = 10, ramp_stage = 1):
+        '''
+        Parameters
+        ----------
+        pitch : displacement in um per motor revolution
+        fast_stage, slow_stage : velocity stages (1-16)
+        ramp_stage : ramp length stage (1-16)
+        '''
+        self.pitch = pitch
+        self.fast_stage = fast_stage
+        self.fast_steps = None # fast velocity in full steps per second, replaces the stage
+        self.slow_stage = slow_stage
+        self.step_stage = slow_stage
+        self.ramp = ramp_duration(ramp_stage)
+        self.step_distance = 1.
+        self.zero = 0. # position of the zero
+        self.second_zero = 0. # position of the zero of the second counter
+        # Current move: list of phases (start time, start position, start velocity, acceleration)
+        self.phases = [(0., 0., 0., 0.)]
+        self.t_end, self.x1 = 0., 0.
+
+    def velocity_of(self, fast):
+        if fast:
+            if self.fast_steps is not None:
+                return self.fast_steps * self.pitch / full_steps
+            return fast_velocities[self.fast_stage - 1] * self.pitch
+        else:
+            return slow_velocities[self.slow_stage - 1] * self.pitch
+
+    def state(self, t):
+        '''
+        Position (relative to the power-on position) and velocity at time t.
+        '''
+        if t >= self.t_end:
+            return self.x1, 0.
+        for t0, x0, v0, a in reversed(self.phases):
+            if t >= t0:
+                break
+        tau = t - t0
+        return x0 + v0 * tau + .5 * a * tau ** 2, v0 + a * tau
+
+    def raw_position(self, t):
+        return self.state(t)[0]
+
+    def position(self, t):
+        return self.raw_position(t) - self.zero
+
+    def second_position(self, t):
+        return self.raw_position(t) - self.second_zero
+
+    def moving(self, t):
+        return t < self.t_end
+
+    def move_raw(self, target, velocity, t):
+        '''
+        Starts a move to a raw position; a new move replaces the current one.
+        The axis keeps its current velocity if the direction is the same,
+        and accelerates or decelerates in one ramp between 0 and the velocity.
+        '''
+        x0, v0 = self.state(t)
+        distance = abs(target - x0)
+        self.x1 = target
+        if distance == 0:
+            self.phases, self.t_end = [(t, x0, 0., 0.)], t
+            return
+        direction = 1. if target > x0 else -1.
+        v0 = max(v0 * direction, 0.) # speed in the direction of the move
+        a = velocity / self.ramp
+        # Acceleration (or deceleration) to the velocity, then deceleration to 0
+        d1 = abs(velocity ** 2 - v0 ** 2) / (2 * a)
+        d3 = velocity ** 2 / (2 * a)
+        if d1 + d3 <= distance:
+            vmax = velocity
+        elif v0 ** 2 / (2 * a) < distance: # the velocity is not reached
+            vmax = ((2 * a * distance + v0 ** 2) / 2) ** .5
+        else: # too close to stop with this acceleration: decelerate harder
+            vmax = v0
+            a = v0 ** 2 / (2 * distance)
+        t1 = abs(vmax - v0) / a
+        d1 = (vmax + v0) / 2 * t1
+        t3 = vmax / a
+        t2 = max(distance - d1 - vmax ** 2 / (2 * a), 0.) / vmax
+        a1 = direction * a if vmax >= v0 else -direction * a
+        self.phases = [(t, x0, direction * v0, a1),
+                       (t + t1, x0 + direction * d1, direction * vmax, 0.),
+                       (t + t1 + t2, x0 + direction * (d1 + vmax * t2), direction * vmax, -direction * a)]
+        self.t_end = t + t1 + t2 + t3
+
+    def absolute_move(self, x, t, fast = True):
+        self.move_raw(x + self.zero, self.velocity_of(fast), t)
+
+    def relative_move(self, x, t, fast = True):
+        self.move_raw(self.x1 + x, self.velocity_of(fast), t)
+
+    def step(self, direction, t):
+        self.move_raw(self.raw_position(t) + direction * self.step_distance,
+                      slow_velocities[self.step_stage - 1] * self.pitch, t)
+
+    def stop(self, t):
+        # The motor decelerates in one ramp
+        x, v = self.state(t)
+        a = abs(v) / self.ramp
+        self.x1 = x + v * self.ramp / 2
+        self.phases = [(t, x, v, -a if v > 0 else a)]
+        self.t_end = t + self.ramp
+
+
+class ControllerSimulator(Thread):
+    '''
+    Simulated controller on a pseudo-terminal.
+    '''
+    def __init__(self, model = 'SM10', naxes = 9, latency = .002, baudrate = None,
+                 connection_timeout = 3., **axis_parameters):
+        '''
+        Parameters
+        ----------
+        model : 'SM10' or 'SM5'
+        naxes : number of axes (numbered from 1)
+        latency : processing time of a command before the answer, in s
+        baudrate : baud rate for the transmission time (default: 115200 for SM10, 38400 for SM5)
+        connection_timeout : for the SM-5, commands are ignored if the last command was
+                             longer ago than this, until a new handshake (0400)
+        axis_parameters : parameters of the axes (see SimulatedAxis)
+        '''
+        Thread.__init__(self)
+        self.daemon = True
+        self.model = model
+        self.axes = [None] + [SimulatedAxis(**axis_parameters) for _ in range(naxes)]
+        self.latency = latency
+        if baudrate is None:
+            baudrate = 115200 if model == 'SM10' else 38400
+        self.byte_time = 10. / baudrate
+        self.connection_timeout = connection_timeout
+        self.last_command = None # time of the last command (SM-5 connection)
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port_name = os.ttyname(self.slave)
+
+        self.parser = FrameParser(start_byte = SYN)
+        self.answers = [] # heap of (time, frame)
+        self.line_free = 0. # end of the current transmission
+        self.commands = 0
+        self.running = True
+
+        self.handlers = {'0101': self.query_position,
+                         '0131': self.query_second_position,
+                         '0190': self.query_slow_speed,
+                         '0143': self.query_fast_speed,
+                         '018F': self.set_slow_speed,
+                         '0144': self.set_fast_speed,
+                         '003D': self.set_fast_velocity,
+                         '014D': self.query_pitch,
+                         'A048': self.group_move,
+                         'A049': self.group_move,
+                         'A04A': self.group_move,
+                         'A04B': self.group_move,
+                         'A101': self.query_group_position,
+                         'A120': self.query_group_status,
+                         '0120': self.query_status,
+                         '0140': self.step,
+                         '0141': self.step,
+                         '044F': self.set_step_distance,
+                         '013A': self.set_step_distance,
+                         '0158': self.set_step_velocity,
+                         '00FF': self.stop_axis,
+                         '00F0': self.set_to_zero,
+                         '0132': self.set_to_zero_second_counter,
+                         '0024': self.go_to_zero,
+                         '003A': self.set_ramp_length,
+                         '0048': self.move,
+                         '0049': self.move,
+                         '004A': self.move,
+                         '004B': self.move,
+                         '0400': self.handshake}
+        self.start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        while self.running:
+            timeout = .05
+            if self.answers:
+                timeout = max(0., min(timeout, self.answers[0][0] - time.time()))
+            readable, _, _ = select.select([self.master], [], [], timeout)
+            if readable:
+                try:
+                    data = os.read(self.master, 1024)
+                except OSError: # the port was closed
+                    continue
+                now = time.time()
+                for ID, frame_data, valid in self.parser.feed(data):
+                    if valid: # faulty commands are not answered
+                        self.execute(ID, frame_data, now)
+            now = time.time()
+            while self.answers and self.answers[0][0] <= now:
+                os.write(self.master, heapq.heappop(self.answers)[1])
+
+    def execute(self, ID, data, t):
+        '''
+        Executes a command and schedules its answer.
+        '''
+        ID = ID.encode('hex').upper()
+        if self.model == 'SM5' and ID != '0400':
+            if self.last_command is None or t - self.last_command > self.connection_timeout:
+                return # connection lost
+        self.last_command = t
+        if ID not in self.handlers:
+            return # unknown commands are not answered
+        self.commands += 1
+        answer = self.handlers[ID](ID, bytearray(data), t)
+        if answer is not None:
+            answer_ID, answer_data = answer
+            frame = encode_frame(ACK, answer_ID.decode('hex'), answer_data)
+            # Answers are sent in order, after the latency and the transmission time
+            start = max(t + self.latency, self.line_free)
+            self.line_free = start + len(frame) * self.byte_time
+            heapq.heappush(self.answers, (self.line_free, frame))
+
+    # Commands: each returns the answer (ID, data), or None for group commands
+
+    def query_position(self, ID, data, t):
+        return ID, float_struct.pack(self.axes[data[0]].position(t))
+
+    def query_second_position(self, ID, data, t):
+        return ID, float_struct.pack(self.axes[data[0]].second_position(t))
+
+    def query_slow_speed(self, ID, data, t):
+        return ID, chr(self.axes[data[0]].slow_stage)
+
+    def query_fast_speed(self, ID, data, t):
+        return ID, chr(self.axes[data[0]].fast_stage)
+
+    def set_slow_speed(self, ID, data, t):
+        self.axes[data[0]].slow_stage = data[1]
+        return ID, ''
+
+    def set_fast_speed(self, ID, data, t):
+        self.axes[data[0]].fast_stage = data[1]
+        self.axes[data[0]].fast_steps = None
+        return ID, ''
+
+    def set_fast_velocity(self, ID, data, t):
+        self.axes[data[0]].fast_steps = data[1] + 256 * data[2]
+        return ID, ''
+
+    def query_pitch(self, ID, data, t):
+        pitch = self.axes[data[0]].pitch
+        return ID, chr(pitches.index(pitch) if pitch in pitches else 8)
+
+    def group_move(self, ID, data, t):
+        values = group_struct.unpack(bytes(data))
+        fast = ID in ('A048', 'A04A')
+        relative = ID in ('A04A', 'A04B')
+        for axis, x in zip(values[1:5], values[5:]):
+            if axis:
+                if relative:
+                    self.axes[axis].relative_move(x, t, fast)
+                else:
+                    self.axes[axis].absolute_move(x, t, fast)
+        return None
+
+    def move(self, ID, data, t):
+        # Single moves (SM-5): 0048/0049 absolute, 004A/004B relative
+        x = float_struct.unpack(bytes(data[1:5]))[0]
+        axis = self.axes[data[0]]
+        fast = ID in ('0048', '004A')
+        if ID in ('004A', '004B'):
+            axis.relative_move(x, t, fast)
+        else:
+            axis.absolute_move(x, t, fast)
+        return ID, ''
+
+    def query_group_position(self, ID, data, t):
+        addresses = list(data[1:5])
+        positions = [self.axes[axis].position(t) if axis else 0. for axis in addresses]
+        return ID, struct.pack('<4B4f', *(addresses + positions))
+
+    def axis_status(self, axis, t):
+        # limit switch, power, motor, resolution
+        return [0, 1, int(self.axes[axis].moving(t)), 1]
+
+    def query_group_status(self, ID, data, t):
+        addresses = list(data[1:5])
+        status = []
+        for axis in addresses:
+            status += self.axis_status(axis, t) if axis else [0, 0, 0, 0]
+        return ID, bytearray(addresses + status)
+
+    def query_status(self, ID, data, t):
+        moving = int(self.axes[data[0]].moving(t))
+        # limit switch, power, home, reserved, resolution, motor status, reserved
+        return ID, bytearray([0, 1, 0, 0, 1, moving, moving])
+
+    def step(self, ID, data, t):
+        self.axes[data[0]].step(1 if ID == '0140' else -1, t)
+        return ID, ''
+
+    def set_step_distance(self, ID, data, t):
+        self.axes[data[0]].step_distance = float_struct.unpack(bytes(data[1:5]))[0]
+        return ID, ''
+
+    def set_step_velocity(self, ID, data, t):
+        self.axes[data[0]].step_stage = data[1]
+        return ID, ''
+
+    def stop_axis(self, ID, data, t):
+        self.axes[data[0]].stop(t)
+        return ID, ''
+
+    def set_to_zero(self, ID, data, t):
+        axis = self.axes[data[0]]
+        axis.zero = axis.raw_position(t)
+        return ID, ''
+
+    def set_to_zero_second_counter(self, ID, data, t):
+        axis = self.axes[data[0]]
+        axis.second_zero = axis.raw_position(t)
+        return ID, ''
+
+    def go_to_zero(self, ID, data, t):
+        self.axes[data[0]].absolute_move(0., t)
+        return ID, ''
+
+    def set_ramp_length(self, ID, data, t):
+        self.axes[data[0]].ramp = ramp_duration(data[1])
+        return ID, ''
+
+    def handshake(self, ID, data, t):
+        return '040B', ''
+
+
+if __name__ == '__main__':
+    from luigsneumann_SM10 import LuigsNeumann_SM10
+    from xyzunit import XYZUnit, benchmark_sequence
+
+    sim = ControllerSimulator()
+    sm10 = LuigsNeumann_SM10(sim.port_name)
+    for compatible_timing in [True, False]:
+        unit = XYZUnit(sm10, [1, 2, 3], compatible_timing = compatible_timing)
+        t1 = time.time()
+        for _ in range(5):
+            benchmark_sequence(unit)
+        t2 = time.time()
+        print 'Simulated SM-10, compatible timing: %s, %.1f ms per sequence' % (compatible_timing, (t2 - t1) * 200)
+    print 'Position:', unit.position()
@@ -0,0 +1,180 @@
+"""
+Straight-line trajectories of XYZ units.
+
+Instead of many short moves, the path is run as a few coordinated segments:
+the fast velocity of each axis is set proportionally to its displacement, so that
+all axes accelerate, cruise and decelerate together and arrive at the same time.
+In streaming mode, the next waypoint is sent while the current segment runs,
+before the axes start decelerating, so the motion does not stop at waypoints
+(a new absolute move replaces the current one on L&N controllers).
+
+Devices without velocity control (no `set_fast_velocity`) run the path as short
+segments, waiting for the end of each one.
+"""
+import time
+from numpy import array, ceil, linspace, absolute, sqrt
+from motion import monitor
+
+__all__ = ['LinearTrajectory']
+
+
+class LinearTrajectory(object):
+    '''
+    Moves a unit in straight line.
+    '''
+    def __init__(self, unit, velocity = None, tolerance = 1., lookahead = .05,
+                 streaming = True, max_segment = 15.):
+        '''
+        Parameters
+        ----------
+        unit : an XYZ unit (with `dev` and `axes`)
+        velocity : velocity along the dominant axis in um/s (default: current fast velocity)
+        tolerance : maximum deviation from the line in um, due to the velocity resolution
+        lookahead : time before the start of the deceleration at which the next waypoint is sent, in s
+        streaming : if False, waits for the end of each segment
+        max_segment : length of segments in um, for devices without velocity control
+        '''
+        self.unit = unit
+        self.velocity = velocity
+        self.tolerance = tolerance
+        self.lookahead = lookahead
+        self.streaming = streaming
+        self.max_segment = max_segment
+
+    def move(self, start, end):
+        '''
+        Moves from start to end in straight line.
+        The unit is assumed to be still at start.
+
+        Parameters
+        ----------
+        start, end : positions of the unit in um (3 coordinates)
+        '''
+        start, end = array(start, dtype = float).ravel(), array(end, dtype = float).ravel()
+        d = end - start
+        if not any(d):
+            return
+        dev, axes = self.unit.dev, list(self.unit.axes)
+        if not hasattr(dev, 'set_fast_velocity'):
+            n = int(ceil(sqrt((d ** 2).sum()) / self.max_segment))
+            for x in linspace(0., 1., n + 1)[1:]:
+                self.unit.absolute_move(start + x * d)
+                self.unit.wait_until_still()
+            return
+
+        dominant = absolute(d).argmax()
+        stages = [dev.fast_speed(axis) for axis in axes]
+        try:
+            velocity = self.velocity
+            if velocity is None:
+                velocity = dev.fast_velocity(axes[dominant])
+            # Velocities proportional to displacements
+            ideal = velocity * absolute(d) / absolute(d[dominant])
+            actual = array([dev.set_fast_velocity(axis, v) if v > 0 else 0.
+                            for axis, v in zip(axes, ideal)])
+            velocity = actual[dominant]
+            # Time of the move, and deviation due to the velocity resolution
+            distance = absolute(d[dominant])
+            ramp = max(monitor(dev).ramp.get(axis, monitor(dev).default_ramp) for axis in axes)
+            duration = distance / velocity + ramp
+            deviation = (absolute(actual - ideal * velocity / ideal[dominant]) * duration).max()
+            n = max(int(ceil(deviation / self.tolerance)), 1)
+            waypoints = [start + x * d for x in linspace(0., 1., n + 1)[1:]]
+            if self.streaming:
+                self.stream(waypoints, distance, velocity, ramp)
+            else:
+                for x in waypoints:
+                    self.unit.absolute_move(x)
+                    self.unit.wait_until_still()
+        finally:
+            for axis, stage in zip(axes, stages):
+                dev.set_fast_speed(axis, stage)
+
+    def stream(self, waypoints, distance, velocity, ramp):
+        '''
+        Sends each waypoint before the axes start decelerating towards the previous one.
+        The times are those of an uninterrupted trapezoidal move along the dominant axis.
+        '''
+        acceleration = velocity / ramp
+        n = len(waypoints)
+        t0 = time.time()
+        for k, x in enumerate(waypoints):
+            if k > 0:
+                # Distance where the next waypoint must be sent
+                s = max(distance * k / n - velocity * (ramp / 2 + self.lookahead), 0.)
+                delay = t0 + trapezoid_time(s, distance, velocity, acceleration) - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            self.unit.absolute_move(x)
+        self.unit.wait_until_still()
+
+
+def trapezoid_time(s, distance, velocity, acceleration):
+    '''
+    Time at which a trapezoidal move over distance reaches s.
+    '''
+    ramp_distance = velocity ** 2 / (2 * acceleration)
+    if 2 * ramp_distance > distance: # triangular profile
+        ramp_distance = distance / 2
+        velocity = sqrt(acceleration * distance)
+    if s <= ramp_distance:
+        return sqrt(2 * s / acceleration)
+    elif s <= distance - ramp_distance:
+        return velocity / acceleration + (s - ramp_distance) / velocity
+    else:
+        return 2 * velocity / acceleration + (distance - 2 * ramp_distance) / velocity - \
+               sqrt(2 * (distance - s) / acceleration)
+
+
+if __name__ == '__main__':
+    # Benchmark on the simulator: ~1 mm diagonal move, wall time and deviation from the line
+    from threading import Thread
+    from numpy import cross
+    from numpy.linalg import norm
+    from simulator import ControllerSimulator
+    import luigsneumann_SM10
+    from xyzunit import XYZUnit
+
+    sim = ControllerSimulator()
+    dev = luigsneumann_SM10.LuigsNeumann_SM10(sim.port_name)
+    unit = XYZUnit(dev, [1, 2, 3])
+    start, end = array([0., 0., 0.]), array([800., -450., 300.])
+
+    def chunked(start, end):
+        # Earlier implementation of PatchClampRobot.linear_move
+        step_vector = 15 * (end - start) / norm(end - start)
+        for step in range(1, int(norm(end - start) / 15.) + 1):
+            unit.absolute_move(start + step * step_vector)
+            time.sleep(0.1)
+        unit.absolute_move(end)
+        unit.wait_until_still()
+
+    def measure(name, method):
+        unit.absolute_move(start)
+        unit.wait_until_still()
+        samples = []
+        running = [True]
+
+        def sample():
+            while running[0]:
+                samples.append([sim.axes[axis].position(time.time()) for axis in [1, 2, 3]])
+                time.sleep(.005)
+        sampler = Thread(target = sample)
+        sampler.start()
+        t1 = time.time()
+        method(start, end)
+        t2 = time.time()
+        running[0] = False
+        sampler.join()
+        u = (end - start) / norm(end - start)
+        deviation = max(norm(cross(array(x) - start, u)) for x in samples)
+        error = norm(array([sim.axes[axis].position(time.time()) for axis in [1, 2, 3]]) - end)
+        print '%s: %.2f s, max deviation %.1f um, final error %.2f um' % \
+              (name, t2 - t1, deviation, error)
+
+    measure('Chunked loop', chunked)
+    for tolerance in [1., .05]:
+        measure('Segments, tolerance %g um' % tolerance,
+                LinearTrajectory(unit, tolerance = tolerance, streaming = False).move)
+        measure('Streaming, tolerance %g um' % tolerance,
+                LinearTrajectory(unit, tolerance = tolerance).move)
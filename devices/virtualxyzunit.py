@@ -7,13 +7,30 @@ from numpy import array, ones, zeros, eye, dot
 from numpy.linalg import inv
 from xyzunit import XYZUnit
 from time import sleep
+import warnings
+from threading import Thread, Lock
+from motion import wait_motion
+from commandqueue import Future
+from geometry.transforms import AffineTransform
+from geometry.workspace import Workspace, WorkspaceError
 
-__all__ = ['VirtualXYZUnit','CalibrationError']
+__all__ = ['VirtualXYZUnit','CalibrationError','MotorRangeError']
 
 class CalibrationError(Exception):
     def __init__(self, msg):
         self.msg = msg
 
+class MotorRangeError(WorkspaceError):
+    pass
+
+def warn_on_failure(future):
+    '''
+    Warns if the final leg of a safe move failed: the pipette is left at the intermediate position.
+    '''
+    if future.exception() is not None:
+        warnings.warn('Safe move failed, the pipette may be at the intermediate position: ' +
+                      str(future.exception()))
+
 class VirtualXYZUnit(XYZUnit): # could be a device
     def __init__(self, dev, stage):
         '''
@@ -25,10 +42,36 @@ class VirtualXYZUnit(XYZUnit): # could be a device
         self.dev = dev
         self.stage = stage
         self.memory = dict()
-        self.M = eye(3) # Matrix transform
-        self.Minv = eye(3) # Inverse of M
-        self.x0 = zeros(3) # Offset
+        self.transform = AffineTransform(eye(3), zeros(3)) # From manipulator to stage coordinates
         self.axes=[0,1,2]
+        self.lock = Lock()
+        self.moves = 0 # number of commanded moves; a safe move is cancelled by any later move
+        self.workspace = None # if None, the motor range of the manipulator (see `get_workspace`)
+
+    # Matrix transform M, its inverse and the offset x0 (stage = M.manipulator + x0)
+    @property
+    def M(self):
+        return self.transform.matrix
+
+    @M.setter
+    def M(self, M):
+        self.transform = AffineTransform(M, self.transform.offset)
+
+    @property
+    def Minv(self):
+        return self.transform.inverse().matrix
+
+    @Minv.setter
+    def Minv(self, Minv):
+        self.M = inv(Minv)
+
+    @property
+    def x0(self):
+        return self.transform.offset
+
+    @x0.setter
+    def x0(self, x0):
+        self.transform = AffineTransform(self.transform.matrix, x0)
 
     def position(self, axis = None):
         '''
@@ -42,8 +85,7 @@ class VirtualXYZUnit(XYZUnit): # could be a device
         -------
         The current position of the device axis in um.
         '''
-        y = self.dev.position()
-        x = dot(self.M, y) + self.x0
+        x = self.transform(self.dev.position().ravel()) # unit positions are row vectors
         if axis is None:
             return x
         else:
@@ -63,7 +105,8 @@ class VirtualXYZUnit(XYZUnit): # could be a device
             x_target = x
             x = self.position()
             x[axis] = x_target
-        self.dev.absolute_move(dot(self.Minv, x - self.x0))
+        self.new_move()
+        self.dev.absolute_move(self.transform.inverse()(x))
 
     def relative_move(self, x, axis = None):
         '''
@@ -78,51 +121,156 @@ class VirtualXYZUnit(XYZUnit): # could be a device
             x_target = x
             x = zeros(3)
             x[axis] = x_target
-        self.dev.relative_move(dot(self.Minv, x))
+        self.new_move()
+        self.dev.relative_move(self.transform.inverse().linear(x))
 
-    def safe_move(self, x, withdraw = 0.):
+    def stop(self, axis = None):
+        self.new_move()
+        self.dev.stop()
+
+    def new_move(self):
         '''
-        Moves the device to position x (an XYZ vector) in a way that minimizes
-        interaction with tissue. The manipulator is first moved horizontally,
-        then along the pipette axis.
+        Records a new move, which cancels the final leg of a pending safe move.
+
+        Returns
+        -------
+        The number of the move.
+        '''
+        with self.lock:
+            self.moves += 1
+            return self.moves
+
+    def get_workspace(self):
+        '''
+        The workspace of the manipulator: `self.workspace` if set, otherwise
+        the motor range stored in the memory of the manipulator (memory['min'] and memory['max']).
+        '''
+        if self.workspace is not None:
+            self.workspace.transform = self.transform
+            return self.workspace
+        memory = getattr(self.dev, 'memory', {})
+        return Workspace(self.transform, memory.get('min'), memory.get('max'))
+
+    def plan_safe_move(self, x, withdraw = 0.):
+        '''
+        Computes the two legs of a safe move (see `safe_move`), in manipulator coordinates,
+        and checks the path against the workspace (see `get_workspace`).
 
         Parameters
         ----------
         x : target position in um, an (X,Y,Z) vector
         withdraw : in um; if not 0, the pipette is withdrawn by this value from the target position x
+
+        Returns
+        -------
+        intermediate, final : positions in manipulator coordinates
         '''
         # First, we determine the intersection between the line going through x
         # with direction corresponding to the manipulator first axis.
-        #n = array([0,0,1.]) # vector normal the focal plane (we are in stage coordinates)
-        #u = dot(self.M, array([1.,0.,0.]))
+        x = array(x, dtype = float).ravel()
         u = self.M[:,0] # this is the vector for the first manipulator axis
-        xprime = self.position()
-        #alpha = dot(n,xprime-x)/dot(n,u)
-        #alpha = (self.position()-x)[2] / u[2]
-
+        y = self.dev.position().ravel()
+        xprime = self.transform(y)
         alpha = (xprime - x)[2] / self.M[2,0]
-        # TODO: check whether the intermediate move is accessible
+
+        # Both legs in one conversion
+        intermediate, final = self.transform.inverse()(array([x + alpha * u, x - withdraw * u]))
+
+        # The whole path in one check
+        valid = self.get_workspace().check(array([y, intermediate, final]))
+        for name, i in [('Intermediate', 1), ('Final', 2)]:
+            if not valid[i]:
+                raise MotorRangeError('{} position {} is out of the workspace'.format(name, (intermediate, final)[i - 1]))
+        return intermediate, final
+
+    def safe_move(self, x, withdraw = 0.):
+        '''
+        Moves the device to position x (an XYZ vector) in a way that minimizes
+        interaction with tissue. The manipulator is first moved horizontally,
+        then along the pipette axis.
+
+        Both legs only differ on the first manipulator axis (the pipette axis).
+        Once the two other axes have arrived, the tip is on the pipette axis going
+        through the target, so the final leg is sent then, without waiting for the
+        first axis to reach the intermediate position.
+        The move is cancelled by any later move of the unit.
+
+        Parameters
+        ----------
+        x : target position in um, an (X,Y,Z) vector
+        withdraw : in um; if not 0, the pipette is withdrawn by this value from the target position x
+
+        Returns
+        -------
+        A Future that is done when the final leg is sent (its result is False if the move was cancelled).
+        If the final leg fails, a warning is issued, even if nobody waits for the Future.
+        Raises MotorRangeError (without moving) if a leg is out of the workspace.
+        '''
+        intermediate, final = self.plan_safe_move(x, withdraw)
+        move = self.new_move()
+        future = Future()
 
         # Intermediate move
-        self.absolute_move(x + alpha * u)
-        # We need to wait here!
-        self.wait_until_still()
-        # Final move
-        self.absolute_move(x - withdraw * u) # Or relative move in manipulator coordinates, first axis (faster)
-        #self.dev.relative_move(..., axis = 0)
+        self.dev.absolute_move(intermediate)
+
+        def final_leg():
+            try:
+                wait_motion([(self.dev, [1, 2])])
+                with self.lock:
+                    if self.moves != move: # cancelled
+                        future.set_result(False)
+                        return
+                    # Final move
+                    self.dev.absolute_move(final[0], 0)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(True)
+        future.add_done_callback(warn_on_failure)
+        thread = Thread(target = final_leg)
+        thread.daemon = True
+        thread.start()
+        return future
+
+    def group_moves(self, x, axis = None, relative = False):
+        '''
+        Moves of the underlying unit for a move of the virtual unit (see `coordinated_move`).
+        Called when the move is sent: it cancels the final leg of a pending safe move.
+        '''
+        if axis is not None:
+            x_target = x
+            x = zeros(3) if relative else self.position()
+            x[axis] = x_target
+        self.new_move()
+        if relative:
+            y = self.transform.inverse().linear(x)
+        else:
+            y = self.transform.inverse()(x)
+        return self.dev.group_moves(y, None, relative)
+
+    def motion_groups(self, axes = None):
+        '''
+        Devices and axes to query for motion (see `wait_motion`).
+        All axes of the underlying unit contribute to each virtual axis.
+        '''
+        return [(self.dev, [0, 1, 2])]
 
     def secondary_calibration(self):
         '''
         Adjusts reference coordinate system assuming is centered on microscope view.
         '''
-        self.x0 = self.stage.position() - dot(self.M, self.dev.position())
+        self.x0 = self.stage.position().ravel() - self.transform.linear(self.dev.position().ravel())
 
     def go(self):
         '''
         Go to current stage position.
+
+        Returns
+        -------
+        The Future of the safe move.
         '''
         #self.absolute_move(self.stage.position())
-        self.safe_move(self.stage.position())
+        return self.safe_move(self.stage.position())
 
     def primary_calibration(self, x, y):
         '''
@@ -133,9 +281,8 @@ class VirtualXYZUnit(XYZUnit): # could be a device
         dx = dx[:,1:] - dx[:,0:-1] # we calculate shifts relative to first position
         dy = array(y).T
         dy = dy[:, 1:] - dy[:, 0:-1]
-        self.M = dot(dx, inv(dy))
-        self.Minv=inv(self.M)
-        self.x0 = x[0]-dot(self.M, y[0])
+        M = dot(dx, inv(dy))
+        self.transform = AffineTransform(M, x[0]-dot(M, y[0]))
 
     def calibration_precision(self):
         '''
@@ -2,6 +2,7 @@
 An XYZ unit made of an XY stage and another device representing the microscope Z axis
 """
 from device import *
+from motion import wait_motion, is_busy
 from numpy import array, sign, ndarray
 from time import sleep
 
@@ -9,15 +10,17 @@ __all__ = ['XYMicUnit']
 
 
 class XYMicUnit(Device):
-    def __init__(self, dev, dev_mic, axes):
+    def __init__(self, dev, dev_mic, axes, compatible_timing = False):
         '''
         Parameters
         ----------
         dev : underlying device for the XY stage
         dev_mic : underlying device for the Z axis
         axes : list of 2 axis indexes
+        compatible_timing : if True, waits 50 ms after each command, as in earlier versions
         '''
         Device.__init__(self)
+        self.compatible_timing = compatible_timing
         self.dev = dev
         self.dev_mic = dev_mic
         self.axes = axes
@@ -36,7 +39,9 @@ class XYMicUnit(Device):
         The current position of the device axis in um.
         '''
         if axis is None: # all positions in a vector
-            return array([[self.position(i) for i in range(len(self.axes) + 1)]])
+            # One group read for the stage (cached by the device)
+            xy = self.dev.position_group(self.axes).ravel()
+            return array([list(xy) + [self.dev_mic.position()]])
         else:
             if axis == 2: # Z
                 return self.dev_mic.position()
@@ -67,7 +72,7 @@ class XYMicUnit(Device):
                 self.dev_mic.absolute_move(x)
             else:
                 self.dev.absolute_move(x, self.axes[axis])
-        sleep(.05)
+        self.settle()
 
     def absolute_move_group(self, x, axes):
         if isinstance(x, ndarray):
@@ -105,7 +110,7 @@ class XYMicUnit(Device):
                 self.dev_mic.relative_move(x)
             else:
                 self.dev.relative_move(x, self.axes[axis])
-        sleep(.05)
+        self.settle()
 
     def save(self, name):
         self.memory[name] = self.position()
@@ -142,7 +147,7 @@ class XYMicUnit(Device):
                 self.dev_mic.set_to_zero()
             else:
                 self.dev.set_to_zero([self.axes[axis]])
-        sleep(.05)
+        self.settle()
 
     def set_to_zero_second_counter(self, axis):
         """
@@ -158,7 +163,7 @@ class XYMicUnit(Device):
                 self.dev_mic.set_to_zero()
             else:
                 self.dev.set_to_zero_second_counter([self.axes[axis]])
-        sleep(.05)
+        self.settle()
 
     def go_to_zero(self, axis):
         """
@@ -173,7 +178,7 @@ class XYMicUnit(Device):
                 self.dev_mic.go_to_zero()
             else:
                 self.dev.go_to_zero([self.axes[axis]])
-        sleep(.05)
+        self.settle()
 
     def single_step(self, axis, step):
         if isinstance(axis, list):
@@ -184,7 +189,7 @@ class XYMicUnit(Device):
                 self.dev_mic.relative_move(step*self.dev_mic.step_distance)
             else:
                 self.dev.single_step(self.axes[axis], step)
-        sleep(.05)
+        self.settle()
 
     def set_single_step_distance(self, axis, distance):
         if isinstance(axis, list):
@@ -195,7 +200,7 @@ class XYMicUnit(Device):
                 self.dev_mic.step_distance = distance
             else:
                 self.dev.set_single_step_distance(self.axes[axis], distance)
-        sleep(.05)
+        self.settle()
 
     def step_move(self, distance, axis):
         if isinstance(distance, ndarray):
@@ -219,6 +224,9 @@ class XYMicUnit(Device):
                     self.set_single_step_distance(axis, 255)
                     self.single_step(axis, number_step*sign(distance))
                 if last_step:
+                    if number_step:
+                        # Changing the step distance requires the previous steps to be done
+                        self.wait_if_busy(axis)
                     self.set_single_step_distance(axis, last_step)
                     self.single_step(axis, sign(distance))
 
@@ -229,7 +237,7 @@ class XYMicUnit(Device):
         else:
             if axis != 2:
                 self.dev.set_ramp_length(self.axes[axis], length)
-        sleep(.05)
+        self.settle()
 
     def wait_motor_stop(self, axis):
         """
@@ -237,15 +245,69 @@ class XYMicUnit(Device):
         :param axis: 
         :return: 
         """
-        if isinstance(axis, list):
-            for i in axis:
-                self.wait_motor_stop(i)
-        else:
-            if axis == 2:
-                self.dev_mic.wait_motor_stop()
-            else:
-                self.dev.wait_motor_stop([self.axes[axis]])
-        sleep(.05)
+        if not isinstance(axis, list):
+            axis = [axis]
+        # Stage and microscope are waited for together
+        wait_motion([(self, axis)])
+        self.settle()
+
+    def wait_if_busy(self, axis):
+        """
+        Waits for the motors to stop only if they are moving.
+
+        Parameters
+        ----------
+        axis : axis number or list of axis numbers
+        """
+        if not isinstance(axis, list):
+            axis = [axis]
+        if is_busy([(self, axis)]):
+            self.wait_motor_stop(axis)
+
+    def settle(self):
+        '''
+        Fixed delay after commands, only with compatible timing.
+        Otherwise commands do not wait: the unit only waits when motors are
+        busy and the order of commands requires it (see `wait_if_busy`).
+        '''
+        if self.compatible_timing:
+            sleep(.05)
+
+    def wait_until_still(self, axis = None):
+        """
+        Waits until motors have stopped.
+
+        Parameters
+        ----------
+        axis : axis number or list of axis numbers; if None, all XYZ axes
+        """
+        if axis is None:
+            axis = range(len(self.axes) + 1)
+        self.wait_motor_stop(list(axis))
+
+    def group_moves(self, x, axis = None, relative = False):
+        '''
+        Device moves for a move of the unit (see `coordinated_move`).
+        The focus drive has no axis number (None).
+        '''
+        if axis is None:
+            x = list(array(x, dtype = float).ravel())
+            return [(self.dev, list(self.axes), x[:2]), (self.dev_mic, [None], x[2:])]
+        elif axis == 2:
+            return [(self.dev_mic, [None], [x])]
+        return [(self.dev, [self.axes[axis]], [x])]
+
+    def motion_groups(self, axes = None):
+        '''
+        Devices and axes to query for motion (see `wait_motion`).
+        axes : list of axes, or None for all axes
+        '''
+        if axes is None:
+            axes = range(len(self.axes) + 1)
+        groups = [(self.dev, [self.axes[i] for i in axes if i != 2])]
+        if 2 in axes:
+            groups.append((self.dev_mic, [None]))
+        return groups
 
 if __name__ == '__main__':
     from luigsneumann_SM5 import *
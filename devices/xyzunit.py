@@ -4,21 +4,24 @@ A class for access to a particular XYZ unit managed by a device
 TODO: group queries, based on array or list
 """
 from device import *
-from numpy import ndarray, sign
+from motion import wait_motion, is_busy
+from numpy import ndarray, sign, array
 from time import sleep
 
 __all__ = ['XYZUnit']
 
 
 class XYZUnit(Device):
-    def __init__(self, dev, axes):
+    def __init__(self, dev, axes, compatible_timing = False):
         '''
         Parameters
         ----------
         dev : underlying device
         axes : list of 3 axis indexes
+        compatible_timing : if True, waits 50 ms after each command, as in earlier versions
         '''
         Device.__init__(self)
+        self.compatible_timing = compatible_timing
         self.dev = dev
         self.axes = axes
         self.memory = dict() # A dictionary of positions
@@ -60,7 +63,7 @@ class XYZUnit(Device):
             self.dev.absolute_move_group(x, self.axes)
         else:
             self.dev.absolute_move(x, self.axes[axis])
-        sleep(.05)
+        self.settle()
 
     def absolute_move_group(self, x, axes):
         if isinstance(x, ndarray):
@@ -75,7 +78,7 @@ class XYZUnit(Device):
             raise ValueError('Length of arrays do not match.')
 
         self.dev.absolute_move_group(pos, [self.axes[i] for i in axes])
-        sleep(.05)
+        self.settle()
 
     def relative_move(self, x, axis = None):
         '''
@@ -93,7 +96,7 @@ class XYZUnit(Device):
             self.dev.relative_move_group(x, self.axes)
         else:
             self.dev.relative_move(x, self.axes[axis])
-        sleep(.05)
+        self.settle()
 
     def save(self, name):
         self.memory[name] = self.position()
@@ -119,11 +122,10 @@ class XYZUnit(Device):
         :return: 
         """
         if isinstance(axis, list):
-            for i in axis:
-                self.set_to_zero(i)
+            self.dev.set_to_zero([self.axes[i] for i in axis])
         else:
             self.dev.set_to_zero([self.axes[axis]])
-        sleep(.05)
+        self.settle()
 
     def set_to_zero_second_counter(self, axis):
         """
@@ -132,11 +134,10 @@ class XYZUnit(Device):
         :return: 
         """
         if isinstance(axis, list):
-            for i in axis:
-                self.set_to_zero_second_counter(i)
+            self.dev.set_to_zero_second_counter([self.axes[i] for i in axis])
         else:
             self.dev.set_to_zero_second_counter([self.axes[axis]])
-        sleep(.05)
+        self.settle()
 
     def go_to_zero(self, axis):
         """
@@ -144,19 +145,17 @@ class XYZUnit(Device):
         :return: 
         """
         if isinstance(axis, list):
-            for i in axis:
-                self.go_to_zero(i)
+            self.dev.go_to_zero([self.axes[i] for i in axis])
         else:
             self.dev.go_to_zero([self.axes[axis]])
-        sleep(.05)
+        self.settle()
 
     def single_step(self, axis, step):
         if isinstance(axis, list):
-            for i in axis:
-                self.single_step(i, step)
+            self.dev.single_step([self.axes[i] for i in axis], step)
         else:
             self.dev.single_step(self.axes[axis], step)
-        sleep(.05)
+        self.settle()
 
     def set_single_step_distance(self, axis, distance):
         if isinstance(axis, list):
@@ -164,7 +163,7 @@ class XYZUnit(Device):
                 self.set_single_step_distance(i, distance)
         else:
             self.dev.set_single_step_distance(self.axes[axis], distance)
-        sleep(.05)
+        self.settle()
 
     def step_move(self, distance, axis):
         if isinstance(distance, ndarray):
@@ -185,17 +184,19 @@ class XYZUnit(Device):
                 self.set_single_step_distance(axis, 255)
                 self.single_step(axis, number_step*sign(distance))
             if last_step:
+                if number_step:
+                    # Changing the step distance requires the previous steps to be done
+                    self.wait_if_busy(axis)
                 self.set_single_step_distance(axis, last_step)
                 self.single_step(axis, sign(distance))
 
 
     def set_ramp_length(self, axis, length):
         if isinstance(axis, list):
-            for i in axis:
-                self.set_ramp_length(i, length)
+            self.dev.set_ramp_length([self.axes[i] for i in axis], length)
         else:
             self.dev.set_ramp_length(self.axes[axis], length)
-        sleep(.05)
+        self.settle()
 
     def wait_motor_stop(self, axis):
         """
@@ -203,9 +204,95 @@ class XYZUnit(Device):
         :param axis: 
         :return: 
         """
-        if isinstance(axis, list):
-            for i in axis:
-                self.wait_motor_stop(i)
-        else:
-            self.dev.wait_motor_stop([self.axes[axis]])
-        sleep(.05)
+        if not isinstance(axis, list):
+            axis = [axis]
+        wait_motion([(self, axis)])
+        self.settle()
+
+    def wait_if_busy(self, axis):
+        """
+        Waits for the motors to stop only if they are moving.
+
+        Parameters
+        ----------
+        axis : axis number or list of axis numbers
+        """
+        if not isinstance(axis, list):
+            axis = [axis]
+        if is_busy([(self, axis)]):
+            self.wait_motor_stop(axis)
+
+    def settle(self):
+        '''
+        Fixed delay after commands, only with compatible timing.
+        Otherwise commands do not wait: the unit only waits when motors are
+        busy and the order of commands requires it (see `wait_if_busy`).
+        '''
+        if self.compatible_timing:
+            sleep(.05)
+
+    def wait_until_still(self, axis = None):
+        """
+        Waits until motors have stopped.
+
+        Parameters
+        ----------
+        axis : axis number or list of axis numbers; if None, all XYZ axes
+        """
+        if axis is None:
+            axis = range(len(self.axes))
+        self.wait_motor_stop(list(axis))
+
+    def group_moves(self, x, axis = None, relative = False):
+        '''
+        Device moves for a move of the unit (see `coordinated_move`).
+
+        Parameters
+        ----------
+        x : target position or shift in um (a vector, or a value if axis is given)
+        axis : axis number starting at 0; if None, all XYZ axes
+        relative : True for a relative move
+
+        Returns
+        -------
+        A list of (device, axes, values).
+        '''
+        if axis is None:
+            return [(self.dev, list(self.axes), list(array(x, dtype = float).ravel()))]
+        return [(self.dev, [self.axes[axis]], [x])]
+
+    def motion_groups(self, axes = None):
+        '''
+        Devices and axes to query for motion (see `wait_motion`).
+        axes : list of axes, or None for all axes
+        '''
+        if axes is None:
+            return [(self.dev, list(self.axes))]
+        return [(self.dev, [self.axes[i] for i in axes])]
+
+
+def benchmark_sequence(unit):
+    '''
+    A typical 3-axis move sequence.
+    '''
+    unit.absolute_move(array([100., 200., 300.]))
+    unit.wait_motor_stop([0, 1, 2])
+    for axis in range(3):
+        unit.relative_move(10., axis)
+    unit.wait_motor_stop([0, 1, 2])
+    unit.absolute_move(0., 0)
+    unit.wait_until_still()
+
+
+if __name__ == '__main__':
+    from fakedevice import FakeDevice
+    import time
+
+    dev = FakeDevice()
+    for compatible_timing in [True, False]:
+        unit = XYZUnit(dev, [1, 2, 3], compatible_timing = compatible_timing)
+        t1 = time.time()
+        for _ in range(10):
+            benchmark_sequence(unit)
+        t2 = time.time()
+        print 'Compatible timing: %s, %.1f ms per sequence' % (compatible_timing, (t2 - t1) * 100)
@@ -2,12 +2,14 @@
 import os
 import threading
 import time
+import Queue
 from Tkinter import *
 
 import inputs
 import numpy as np
 
 from devices.luigsneumann_SM10 import LuigsNeumann_SM10
+from devices.jog import JogEngine
 
 revolutions = [0.000017,
                0.000040,
@@ -26,20 +28,113 @@ revolutions = [0.000017,
                0.996000,
                1.328000]
 
+# Gamepad axes: event code -> (index in the state, normalization)
+gamepad_axes = {'ABS_X': (0, 32768.0),
+                'ABS_Y': (1, 32768.0),
+                'ABS_Z': (2, 255.),
+                'ABS_RZ': (3, 255.)}
+
+class GamepadState(object):
+    '''
+    Latest state of the gamepad axes (x, y, left z, right z), with a sequence counter.
+    There is a single writer (the reader thread) and no lock: the counter is odd while
+    the state is written, and readers retry if it changed during their copy.
+    '''
+    def __init__(self):
+        self.values = np.zeros(len(gamepad_axes))
+        self.sequence = 0
+
+    def update(self, index, value):
+        self.sequence += 1
+        self.values[index] = value
+        self.sequence += 1
+
+    def read(self):
+        '''
+        Returns
+        -------
+        sequence number, copy of the values
+        '''
+        while True:
+            sequence = self.sequence
+            values = self.values.copy()
+            if sequence % 2 == 0 and sequence == self.sequence:
+                return sequence, values
+
 class GamepadReader(threading.Thread):
-    def __init__(self, event_container, gamepad):
-        self.event_container = event_container
+    def __init__(self, state, gamepad):
+        self.state = state
         self.gamepad = gamepad
         super(GamepadReader, self).__init__()
+        self.daemon = True
 
     def run(self):
         while True:
-            event = self.gamepad.read()[0]
-            if event.code in ['ABS_X', 'ABS_Y', 'ABS_Z', 'ABS_RZ']:
-                self.event_container.append(event)
+            for event in self.gamepad.read():
+                if event.code in gamepad_axes:
+                    index, scale = gamepad_axes[event.code]
+                    self.state.update(index, event.state / scale)
+
+class RecordWriter(threading.Thread):
+    '''
+    Writes records to a file in the background, in batches.
+    '''
+    def __init__(self, record_file, interval=1.):
+        '''
+        Parameters
+        ----------
+        record_file : an open file
+        interval : time between writes, in s
+        '''
+        super(RecordWriter, self).__init__()
+        self.daemon = True
+        self.record_file = record_file
+        self.interval = interval
+        self.records = Queue.Queue()
+        self.closed = threading.Event()
+        self.start()
+
+    def write(self, record):
+        '''
+        Queues a record (time, force, angle, z).
+        '''
+        self.records.put(record)
+
+    def close(self):
+        '''
+        Writes the remaining records and closes the file.
+        '''
+        self.closed.set()
+        self.join()
+
+    def flush(self):
+        lines = []
+        while True:
+            try:
+                lines.append('%f,%d,%d,%d\n' % self.records.get(False))
+            except Queue.Empty:
+                break
+        if lines:
+            self.record_file.write(''.join(lines))
+
+    def run(self):
+        while not self.closed.wait(self.interval):
+            self.flush()
+        self.flush()
+        self.record_file.close()
 
 class GamepadControl(Frame):
-    def __init__(self, controller, axes, scale=(1, 1), master=None):
+    def __init__(self, controller, axes, scale=(1, 1), master=None, max_velocity=(500., 100.), dead_zone=.1):
+        '''
+        Parameters
+        ----------
+        controller : the device
+        axes : X, Y, Z axes of the device
+        scale : sign (or gain) of the X and Y axes
+        master : parent window
+        max_velocity : velocities in um/s at full deflection of the stick (XY) and of a trigger (Z)
+        dead_zone : deflection of the stick below which there is no movement
+        '''
         Frame.__init__(self, master)
         self.master = master
         self.controller = controller
@@ -53,7 +148,6 @@ class GamepadControl(Frame):
         self.right_z = 0
         self.force = 0
         self.angle = 0
-        self.previous_speed = 0
         self.angle_label = Label(self, text='angle: -')
         self.angle_label.pack()
         self.file_entry = Entry(self)
@@ -61,23 +155,27 @@ class GamepadControl(Frame):
         self.record_button = Button(self, text='Start recording', command=self.record)
         self.record_button.pack()
         self.recording = False
-        self.record_file = None
+        self.record_writer = None
         self.start_time = None
-        self.speed_setting = [1, 3, 5]
-        # Z axis uses slowest speed
-        self.controller.set_single_step_factor_trackball(self.axes[2], self.speed_setting[1])
+        self.max_velocity = max_velocity
+        self.dead_zone = dead_zone
+        self.z = 0
+        # Continuous velocity control, on its own thread
+        self.jog = JogEngine(self.controller, self.axes[:3])
+        self.jog.start()
         gamepad = inputs.devices.gamepads[0]
-        self.event_container = []
-        reader = GamepadReader(self.event_container, gamepad)
+        self.state = GamepadState()
+        self.sequence = -1 # sequence number of the last processed state
+        reader = GamepadReader(self.state, gamepad)
         reader.start()
         self.after(10, self.update_labels)
-        self.after(50, self.update_speed)
+        self.after(50, self.update_record)
 
     def record(self):
         if self.recording:
             # stop recording
-            self.record_file.close()
-            self.record_file = None
+            self.record_writer.close()
+            self.record_writer = None
             self.record_button['text'] = 'Start recording'
             self.recording = False
         else:
@@ -85,70 +183,63 @@ class GamepadControl(Frame):
             filename = self.file_entry.get()
             if os.path.isfile(filename):
                 print('File %s already exists, appending to the existing file' % filename)
-                self.record_file = open(filename, 'a')
+                record_file = open(filename, 'a')
             else:
-                self.record_file = open(filename, 'w')
-                self.record_file.write('time,force,angle,z\n')
+                record_file = open(filename, 'w')
+                record_file.write('time,force,angle,z\n')
+            self.record_writer = RecordWriter(record_file)
             self.start_time = time.time()
             self.record_button['text'] = 'Stop recording'
             self.recording = True
 
     def update_labels(self):
-        for event in self.event_container:
-            if event.code == 'ABS_X':
-                self.x = event.state / 32768.0
-            elif event.code == 'ABS_Y':
-                self.y = event.state / 32768.0
-            elif event.code == 'ABS_Z':
-                self.left_z = event.state / 255.
-            elif event.code == 'ABS_RZ':
-                self.right_z = event.state / 255.
+        # Only the latest state, once per tick
+        sequence, values = self.state.read()
+        if sequence != self.sequence:
+            self.sequence = sequence
+            self.x, self.y, self.left_z, self.right_z = values
             # Classify deviation from center (i.e. movement speed) into four classes
             # No movement, slow movement, medium movement, fast movement
-            self.force = np.clip(int(np.sqrt(self.x**2 + self.y**2) * 4), 0, 3)
+            self.force = np.clip(int(np.hypot(self.x, self.y) * 4), 0, 3)
             # Bin direction into 45° steps
             self.angle = np.round(np.arctan2(self.x, self.y) / (np.pi/4)) * np.pi/4
+            self.update_velocity()
             self.force_label['text'] = 'force: {}'.format(self.force)
             if self.force > 0:
                 self.angle_label['text'] = 'angle: {:.0f}'.format(self.angle * 180 / np.pi)
             else:
                 self.angle_label['text'] = 'angle: -'
-        self.event_container[:] = []
         self.after(10, self.update_labels)
 
-    def update_speed(self):
-        if self.force > 0:
-            speed = self.speed_setting[self.force - 1]
-            if self.previous_speed != speed:
-                self.controller.set_single_step_factor_trackball(self.axes[0], speed)
-                self.controller.set_single_step_factor_trackball(self.axes[1], speed)
-                self.previous_speed = speed
-            x = np.sin(self.angle) * self.scale[0]
-            y = np.cos(self.angle) * self.scale[1]
-            if abs(x) > .01:
-                if x> 0:
-                    self.controller.single_step_trackball(self.axes[0], 1)
-                else:
-                    self.controller.single_step_trackball(self.axes[0], -2)
-            if abs(y) > .01:
-                if y> 0:
-                    self.controller.single_step_trackball(self.axes[1], 1)
-                else:
-                    self.controller.single_step_trackball(self.axes[1], -2)
-
+    def update_velocity(self):
+        '''
+        Maps the stick deflection to a velocity, proportional to the square
+        of the deflection beyond the dead zone (for fine control at low speed).
+        '''
+        deflection = np.sqrt(self.x**2 + self.y**2)
+        if deflection > self.dead_zone:
+            gain = ((min(deflection, 1.) - self.dead_zone) / (1 - self.dead_zone)) ** 2 / deflection
+            vx = self.x * gain * self.max_velocity[0] * self.scale[0]
+            vy = self.y * gain * self.max_velocity[0] * self.scale[1]
+        else:
+            vx, vy = 0., 0.
         z = self.left_z - self.right_z
         if abs(z) > 0.25:
-            z_step = 1 if z > 0 else -2
-            self.controller.single_step_trackball(self.axes[2], z_step)
+            # Recorded as the trackball step count of earlier versions (1 or -2)
+            self.z = 1 if z > 0 else -2
+            vz = (abs(z) - .25) / .75 * self.max_velocity[1] * np.sign(z)
         else:
-            z_step = 0
+            self.z = 0
+            vz = 0.
+        # Only the latest state is used by the jog engine
+        self.jog.set_velocity([vx, vy, vz])
 
+    def update_record(self):
         if self.recording:
             now = time.time() - self.start_time
             angle = ((int(round(self.angle / (np.pi/4))) + 4 )% 8) -4
-            self.record_file.write('%f,%d,%d,%d\n' % (now, self.force, angle, z_step))
-        self.z = 0
-        self.after(50, self.update_speed)
+            self.record_writer.write((now, self.force, angle, self.z))
+        self.after(50, self.update_record)
 
 if __name__ == '__main__':
     root = Tk()
@@ -1 +1,4 @@
 from planes import *
+from transforms import *
+from workspace import *
+from focusmap import *
@@ -0,0 +1,126 @@
+'''
+Focus map: the focus height of the microscope as a function of the stage XY position.
+
+Samples (x, y, z) are added after each successful focus on the preparation.
+The map is a least-squares plane, updated incrementally, plus (with enough samples)
+a thin-plate spline of the residuals for warped coverslips. It predicts the focus height anywhere,
+so that stage moves land close to focus and autofocus only has to refine.
+'''
+from numpy import array, asarray, zeros, empty, concatenate, log, dot, eye, vstack, hstack, ones
+from numpy.linalg import solve, lstsq, LinAlgError
+
+__all__ = ['FocusMap']
+
+class FocusMap(object):
+    '''
+    Focus height as a function of XY.
+    '''
+    def __init__(self, method = 'plane', smoothing = 1., min_spline_samples = 6):
+        '''
+        Parameters
+        ----------
+        method : 'plane', or 'thin-plate' (plane plus thin-plate spline of the residuals)
+        smoothing : regularization of the spline, in um^2 (0 interpolates the samples exactly)
+        min_spline_samples : number of samples below which only the plane is used
+        '''
+        self.method = method
+        self.smoothing = smoothing
+        self.min_spline_samples = min_spline_samples
+        self.samples = empty((0, 3))
+        # Normal equations of the plane z = c0 + c1.x + c2.y, updated with each sample
+        self.AtA = zeros((3, 3))
+        self.Atz = zeros(3)
+        self.plane = None # coefficients, None until computed
+        self.spline = None # (weights, centers), None until computed
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, x, y, z):
+        '''
+        Adds a focus sample: stage position x, y and focus height z, in um.
+        '''
+        self.samples = concatenate([self.samples, [[x, y, z]]])
+        row = array([1., x, y])
+        self.AtA += row[:, None] * row
+        self.Atz += row * z
+        self.plane = None
+        self.spline = None
+
+    def clear(self):
+        self.__init__(self.method, self.smoothing, self.min_spline_samples)
+
+    def plane_coefficients(self):
+        '''
+        Coefficients (c0, c1, c2) of the plane z = c0 + c1.x + c2.y.
+        With fewer than 3 samples (or aligned samples), the plane is horizontal at the mean height.
+        '''
+        if self.plane is None:
+            try:
+                if len(self) < 3:
+                    raise LinAlgError
+                self.plane = solve(self.AtA, self.Atz)
+            except LinAlgError:
+                self.plane = array([self.samples[:, 2].mean(), 0., 0.])
+        return self.plane
+
+    def spline_weights(self):
+        '''
+        Thin-plate spline of the residuals from the plane.
+        '''
+        if self.spline is None:
+            xy = self.samples[:, :2]
+            residuals = self.samples[:, 2] - self.plane_height(xy)
+            n = len(xy)
+            K = kernel(xy, xy) + self.smoothing * eye(n)
+            P = hstack([ones((n, 1)), xy])
+            A = vstack([hstack([K, P]), hstack([P.T, zeros((3, 3))])])
+            b = concatenate([residuals, zeros(3)])
+            weights = lstsq(A, b, rcond = None)[0]
+            self.spline = (weights, xy)
+        return self.spline
+
+    def plane_height(self, xy):
+        c = self.plane_coefficients()
+        return c[0] + dot(xy, c[1:])
+
+    def predict(self, x, y = None):
+        '''
+        Predicted focus height at x, y (numbers or arrays), or at points xy (N x 2 array) if y is None.
+        Returns None if there are no samples.
+        '''
+        if len(self) == 0:
+            return None
+        if y is None:
+            xy = asarray(x, dtype = float)
+        else:
+            xy = array([x, y], dtype = float).T
+        z = self.plane_height(xy)
+        if self.method == 'thin-plate' and len(self) >= self.min_spline_samples:
+            weights, centers = self.spline_weights()
+            n = len(centers)
+            z = z + dot(kernel(xy.reshape(-1, 2), centers), weights[:n]).reshape(z.shape) + \
+                weights[n] + dot(xy, weights[n + 1:])
+        return z
+
+def kernel(a, b):
+    '''
+    Thin-plate spline kernel r^2 log(r) between points a (N x 2) and b (M x 2).
+    '''
+    r2 = ((a[:, None, :] - b[None, :, :]) ** 2).sum(axis = -1)
+    r2[r2 == 0] = 1. # r^2 log r = 0 at r = 0
+    return .5 * r2 * log(r2)
+
+if __name__ == '__main__':
+    from numpy import random, sin, abs
+    random.seed(0)
+    def surface(x, y): # tilted and warped coverslip
+        return 5. + .02 * x - .01 * y + 3 * sin(x / 500.) * sin(y / 700.)
+    xy = random.rand(40, 2) * 2000
+    test = random.rand(1000, 2) * 2000
+    for method in ['plane', 'thin-plate']:
+        focus_map = FocusMap(method)
+        for x, y in xy:
+            focus_map.add(x, y, surface(x, y) + random.randn() * .2)
+        error = abs(focus_map.predict(test) - surface(test[:, 0], test[:, 1]))
+        print '{}: mean error {:.2f} um, max {:.2f} um'.format(method, error.mean(), error.max())
@@ -1,7 +1,11 @@
 '''
 Calculation related to planes (intersections, etc)
+
+Points and vectors can be single vectors or arrays of N points (one per row),
+so that many points are handled in one call.
 '''
-from numpy import cross, dot
+from numpy import cross, dot, asarray, einsum, errstate, where, isfinite
+from numpy.linalg import svd, norm
 
 __all__ = ['Plane']
 
@@ -23,12 +27,35 @@ class Plane(object):
         a = -dot(n, x1)
         return Plane(n,a)
 
+    @staticmethod
+    def fit(points):
+        '''
+        Returns the plane that best fits N points (N x 3 array, N >= 3),
+        in the least-squares sense (orthogonal distances).
+        The normal vector has unit norm and positive z.
+        '''
+        points = asarray(points, dtype = float)
+        center = points.mean(axis = 0)
+        # The normal is the direction of least variance
+        n = svd(points - center, full_matrices = False)[2][-1]
+        if n[2] < 0:
+            n = -n
+        return Plane(n, -dot(n, center))
+
     def signed_distance(self, x, u):
         '''
         Signed distance of x from the plane along vector u.
         That is, returns k such that x + k.u is in the plane.
+        x and u can be arrays of N points and vectors (N x 3).
+        '''
+        return -(dot(x, self.n) + self.a)/dot(u, self.n)
+
+    def distance(self, x):
+        '''
+        Signed orthogonal distance of points x (vector or N x 3 array) from the plane,
+        positive on the side of the normal vector.
         '''
-        return -(dot(self.n, x) + self.a)/dot(self.n, u)
+        return (dot(x, self.n) + self.a)/norm(self.n)
 
     def project(self, x, u = None):
         '''
@@ -38,7 +65,26 @@ class Plane(object):
         '''
         if u is None:
             u = self.n
-        return x+self.signed_distance(x, u)*u
+        x, u = asarray(x), asarray(u)
+        k = self.signed_distance(x, u)
+        return x + (k[..., None] if x.ndim > 1 or u.ndim > 1 else k)*u
+
+    def intersect(self, x, u):
+        '''
+        Intersections of rays x + k.u (k >= 0) with the plane,
+        e.g. pipette axes from tip positions. x and u can be N x 3 arrays.
+
+        Returns
+        -------
+        points, and a boolean array telling which rays hit the plane
+        (parallel rays or rays pointing away give nan points).
+        '''
+        x, u = asarray(x, dtype = float), asarray(u, dtype = float)
+        with errstate(divide = 'ignore', invalid = 'ignore'):
+            k = -(dot(x, self.n) + self.a)/einsum('...i,i->...', u, self.n)
+            hit = isfinite(k) & (k >= 0) # parallel rays give infinite k
+            k = where(hit, k, float('nan'))
+            return x + k[..., None]*u, hit
 
     def parallel_plane(self, x):
         '''
@@ -0,0 +1,159 @@
+'''
+Affine transforms between coordinate systems (stage, manipulator, camera pixels).
+
+Points are vectors, or arrays of N points with one point per row, so that
+a whole path or set of detections is converted in one call.
+A TransformGraph holds the transforms between named frames and caches
+the composed transforms (e.g. pixel -> manipulator).
+'''
+from numpy import array, asarray, dot, eye, zeros
+from numpy.linalg import inv
+
+__all__ = ['AffineTransform', 'TransformGraph']
+
+class AffineTransform(object):
+    '''
+    The transform y = M.x + x0. Transforms are not modified once created,
+    so that their inverse and compositions can be cached.
+    '''
+    def __init__(self, matrix, offset = None):
+        '''
+        Parameters
+        ----------
+        matrix : n x n matrix M
+        offset : offset x0 (default: zero)
+        '''
+        self.matrix = array(matrix, dtype = float)
+        if offset is None:
+            self.offset = zeros(len(self.matrix))
+        else:
+            self.offset = array(offset, dtype = float).ravel()
+        self._inverse = None
+
+    @staticmethod
+    def identity(n = 3):
+        return AffineTransform(eye(n))
+
+    @staticmethod
+    def translation(offset):
+        offset = asarray(offset, dtype = float).ravel()
+        return AffineTransform(eye(len(offset)), offset)
+
+    def __call__(self, x):
+        '''
+        Transforms a point, or N points given as the rows of an array.
+        '''
+        return dot(asarray(x), self.matrix.T) + self.offset
+
+    def linear(self, x):
+        '''
+        Transforms a displacement (or N displacements), i.e., without the offset.
+        '''
+        return dot(asarray(x), self.matrix.T)
+
+    def inverse(self):
+        '''
+        The inverse transform (computed once).
+        '''
+        if self._inverse is None:
+            matrix = inv(self.matrix)
+            self._inverse = AffineTransform(matrix, -dot(matrix, self.offset))
+            self._inverse._inverse = self
+        return self._inverse
+
+    def compose(self, other):
+        '''
+        The transform x -> self(other(x)).
+        '''
+        return AffineTransform(dot(self.matrix, other.matrix),
+                               dot(self.matrix, other.offset) + self.offset)
+
+class TransformGraph(object):
+    '''
+    Transforms between named frames. Frames are connected by the transforms
+    set with `set`, in either direction; composed transforms are cached until
+    one of the transforms they use is changed.
+    '''
+    def __init__(self):
+        self.transforms = dict() # (source, target) -> transform
+        self.versions = dict() # (source, target) -> number of changes
+        self.cache = dict() # (source, target) -> (versions of the path, composed transform)
+
+    def set(self, source, target, transform):
+        '''
+        Sets the transform from frame source to frame target.
+        '''
+        self.transforms.pop((target, source), None)
+        self.transforms[(source, target)] = transform
+        key = tuple(sorted((source, target)))
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def edge(self, source, target):
+        if (source, target) in self.transforms:
+            return self.transforms[(source, target)]
+        return self.transforms[(target, source)].inverse()
+
+    def path(self, source, target):
+        '''
+        Frames from source to target (breadth-first search).
+        '''
+        previous = {source : None}
+        frontier = [source]
+        while frontier and target not in previous:
+            next_frontier = []
+            for frame in frontier:
+                for a, b in self.transforms:
+                    for neighbor in [b] if a == frame else [a] if b == frame else []:
+                        if neighbor not in previous:
+                            previous[neighbor] = frame
+                            next_frontier.append(neighbor)
+            frontier = next_frontier
+        if target not in previous:
+            raise KeyError('No transform from {} to {}'.format(source, target))
+        path = [target]
+        while path[-1] != source:
+            path.append(previous[path[-1]])
+        return path[::-1]
+
+    def get(self, source, target):
+        '''
+        The transform from frame source to frame target.
+        '''
+        if (source, target) in self.cache:
+            versions, transform = self.cache[(source, target)]
+            if all(self.versions.get(key) == version for key, version in versions):
+                return transform
+        path = self.path(source, target)
+        transform = AffineTransform.identity(len(self.transforms.values()[0].matrix))
+        for a, b in zip(path[:-1], path[1:]):
+            transform = self.edge(a, b).compose(transform)
+        versions = [(key, self.versions[key]) for key in
+                    [tuple(sorted(pair)) for pair in zip(path[:-1], path[1:])]]
+        self.cache[(source, target)] = (versions, transform)
+        return transform
+
+    def convert(self, x, source, target):
+        '''
+        Converts points (a vector or one point per row) from frame source to frame target.
+        '''
+        return self.get(source, target)(x)
+
+if __name__ == '__main__':
+    from numpy import *
+    import time
+    graph = TransformGraph()
+    graph.set('manipulator', 'stage', AffineTransform(array([[1., .1, 0], [0, 1., .2], [.3, 0, 1.]]), [10., 20., 30.]))
+    graph.set('pixel', 'stage', AffineTransform(diag([.5, .5, 1.]), [-100., -50., 0.]))
+    print graph.convert(array([200., 100., 0.]), 'pixel', 'manipulator')
+    points = random.rand(10000, 3) * 1000
+    back = graph.convert(graph.convert(points, 'pixel', 'manipulator'), 'manipulator', 'pixel')
+    print 'Round trip error:', abs(back - points).max()
+
+    M = matrix(graph.get('pixel', 'manipulator').matrix)
+    t1 = time.time()
+    for x in points:
+        y = M * matrix(x).T
+    t2 = time.time()
+    graph.convert(points, 'pixel', 'manipulator')
+    t3 = time.time()
+    print 'Per point with matrix: {:.1f} ms, batched: {:.1f} ms'.format((t2 - t1) * 1000, (t3 - t2) * 1000)
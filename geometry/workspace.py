@@ -0,0 +1,162 @@
+'''
+Workspace of a manipulator: the motor range box, the objective and the recording chamber.
+
+Paths are arrays of waypoints (one per row) in manipulator coordinates; they
+are checked in one vectorized pass, including the segments between waypoints,
+so that every move can be validated before it is sent.
+'''
+from numpy import array, asarray, ones, minimum, maximum, clip, where, vstack
+from transforms import AffineTransform
+
+__all__ = ['Workspace', 'Objective', 'WorkspaceError']
+
+class WorkspaceError(ValueError):
+    pass
+
+class Objective(object):
+    '''
+    The objective, as a vertical cylinder in stage coordinates: points within radius
+    of the optical axis and above the bottom of the objective are forbidden.
+    '''
+    def __init__(self, center, bottom, radius):
+        '''
+        Parameters
+        ----------
+        center : (x, y) position of the optical axis
+        bottom : z of the front of the objective (focal plane + working distance)
+        radius : radius of the objective, including a safety margin
+        '''
+        self.center = array(center, dtype = float)[:2]
+        self.bottom = float(bottom)
+        self.radius = float(radius)
+
+    def inside(self, x):
+        '''
+        Tells whether points (one per row) are inside the objective.
+        '''
+        x = asarray(x)
+        return (x[..., 2] > self.bottom) & (((x[..., :2] - self.center) ** 2).sum(axis = -1) < self.radius ** 2)
+
+    def crossed(self, a, b):
+        '''
+        Tells whether segments from points a to points b (one per row) go through the objective.
+        '''
+        a, b = asarray(a, dtype = float), asarray(b, dtype = float)
+        d = b - a
+        # Part of each segment above the bottom: s in [s0, s1]
+        dz = d[..., 2]
+        flat = dz == 0
+        s_bottom = (self.bottom - a[..., 2]) / where(flat, 1., dz)
+        s0 = where(flat, where(a[..., 2] > self.bottom, 0., 1.), where(dz > 0, maximum(s_bottom, 0.), 0.))
+        s1 = where(flat, where(a[..., 2] > self.bottom, 1., 0.), where(dz > 0, 1., minimum(s_bottom, 1.)))
+        # Closest point to the axis (horizontally) in that part
+        p, u = a[..., :2] - self.center, d[..., :2]
+        uu = (u ** 2).sum(axis = -1)
+        s = clip(-(p * u).sum(axis = -1) / where(uu == 0, 1., uu), s0, s1)
+        closest = p + s[..., None] * u
+        return (s0 < s1) & ((closest ** 2).sum(axis = -1) < self.radius ** 2)
+
+class Workspace(object):
+    '''
+    Allowed positions of a manipulator.
+    '''
+    def __init__(self, transform = None, lower = None, upper = None,
+                 objective = None, chamber = None, margin = 0.):
+        '''
+        Parameters
+        ----------
+        transform : AffineTransform from manipulator to stage coordinates (default: identity)
+        lower, upper : motor range in manipulator coordinates (e.g. memory['min'] and memory['max'])
+        objective : an Objective, in stage coordinates
+        chamber : a Plane in stage coordinates; allowed points have n.x + a >= margin
+                  (the normal points towards the allowed side)
+        margin : distance to keep from the chamber plane, in units of |n|
+        '''
+        if transform is None:
+            transform = AffineTransform.identity()
+        self.transform = transform
+        self.lower = None if lower is None else array(lower, dtype = float).ravel()
+        self.upper = None if upper is None else array(upper, dtype = float).ravel()
+        self.objective = objective
+        self.chamber = chamber
+        self.margin = margin
+
+    def check(self, path):
+        '''
+        Checks a path (waypoints as rows, in manipulator coordinates).
+
+        Returns
+        -------
+        A boolean array: True for waypoints that are allowed and reached
+        from the previous one by an allowed segment.
+        '''
+        path = asarray(path, dtype = float).reshape(-1, 3)
+        valid = ones(len(path), dtype = bool)
+        # The box and the chamber half-space are convex: checking the waypoints is enough
+        if self.lower is not None:
+            valid &= (path >= self.lower).all(axis = 1)
+        if self.upper is not None:
+            valid &= (path <= self.upper).all(axis = 1)
+        if self.objective is None and self.chamber is None:
+            return valid
+        x = self.transform(path) # stage coordinates, all waypoints at once
+        if self.chamber is not None:
+            valid &= x.dot(self.chamber.n) + self.chamber.a >= self.margin
+        if self.objective is not None:
+            valid &= ~self.objective.inside(x)
+            valid[1:] &= ~self.objective.crossed(x[:-1], x[1:])
+        return valid
+
+    def is_valid(self, path):
+        '''
+        Tells whether the whole path is allowed.
+        '''
+        return bool(self.check(path).all())
+
+    def clip(self, x):
+        '''
+        The closest allowed position to x (in manipulator coordinates):
+        x is clipped to the motor range, moved above the chamber plane (along the normal)
+        and below the objective.
+        '''
+        x = array(x, dtype = float).ravel()
+        if self.lower is not None:
+            x = maximum(x, self.lower)
+        if self.upper is not None:
+            x = minimum(x, self.upper)
+        if self.chamber is None and self.objective is None:
+            return x
+        y = self.transform(x)
+        if self.chamber is not None:
+            n, a = asarray(self.chamber.n, dtype = float), self.chamber.a
+            value = y.dot(n) + a
+            if value < self.margin:
+                y = y + (self.margin - value) / n.dot(n) * n
+        if self.objective is not None and self.objective.inside(y):
+            y[2] = self.objective.bottom
+        x = self.transform.inverse()(y)
+        if not self.is_valid(x):
+            raise WorkspaceError('No allowed position near {}'.format(x))
+        return x
+
+    def plan(self, start, end):
+        '''
+        An allowed path from start to end (manipulator coordinates): the straight line if allowed,
+        otherwise a horizontal then vertical move, or a vertical then horizontal move
+        (in stage coordinates).
+
+        Returns
+        -------
+        Waypoints after start, as rows.
+        '''
+        start, end = array(start, dtype = float).ravel(), array(end, dtype = float).ravel()
+        if not self.is_valid(end):
+            raise WorkspaceError('Target {} is outside the workspace'.format(end))
+        a, b = self.transform(vstack([start, end]))
+        candidates = [array([end])]
+        for corner in [array([b[0], b[1], a[2]]), array([a[0], a[1], b[2]])]:
+            candidates.append(vstack([self.transform.inverse()(corner), end]))
+        for path in candidates:
+            if self.check(vstack([start, path]))[1:].all():
+                return path
+        raise WorkspaceError('No allowed path from {} to {}'.format(start, end))
@@ -69,23 +69,17 @@ class CameraFrame(Toplevel):
     def autofocus(self):
         '''
         Autofocus algorithm.
-        Ideally, use Xu et al. 2011, Robust Automatic Focus Algorithm for Low Contrast Images Using a New Contrast Measure
-
-        Here we simply use normalized standard deviation of the image as focus function, and global search
-        (or Fibonacci search or other; eg from scipy.optimize).
+        Maximizes the normalized variance of the center of the image (see vision.focusmetrics),
+        with a golden-section search within 10 um of the current focus.
         '''
-        print "Autofocus (in development)"
-        timeout = 30. # Time out
-        # Do this in show_frame()?
-        # Capture 20 images
-        img = []
-        self.microscope.unit.relative_move(-10., axis=2)  # 1 um
-        for i in range(20):
-            _, frame = self.cap.read()
-            img.append(frame)
-            self.microscope.unit.relative_move(1., axis = 2) # 1 um
-            self.microscope.unit.wait_until_still(axis = 2 )
-        pickle.dump(img, open('pipette_stack.img', "wb"))
+        unit = self.microscope.unit
+        z0 = unit.position(axis = 2)
+        def move(z):
+            unit.absolute_move(z, axis = 2)
+            unit.wait_until_still(axis = 2)
+        curve = FocusCurve('variance', roi = (self.width / 4, self.height / 4, self.width / 2, self.height / 2))
+        z = autofocus(move, curve, z0 - 10., z0 + 10., tolerance = .5, grab = lambda: self.cap.read()[1])
+        print "Focus at", z
 
     def destroy(self):
         self.cap.release()
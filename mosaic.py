@@ -44,21 +44,23 @@ print "Device initialized"
 
 frames = []
 
+moves = [] # (shift, axis)
 for j in range(5):
-    for i in range(10):
-        microscope.relative_move(200., axis = 0)
-        microscope.wait_motor_stop(axis = 0)
-        mmc.snapImage()
-        frames.append(mmc.getImage())
-    microscope.relative_move(200., axis = 1)
-    microscope.wait_motor_stop(axis=1)
+    moves += [(200., 0)]*10 + [(200., 1)] + [(-200., 0)]*10
+
+stage = AsyncUnit(microscope)
+stage.move_by(*moves[0])
+moving = stage.wait_still(moves[0][1])
+for i in range(len(moves)):
+    moving.result()
     mmc.snapImage()
+    # The next move starts as soon as the image is taken, while it is transferred
+    if i + 1 < len(moves):
+        shift, axis = moves[i + 1]
+        stage.move_by(shift, axis)
+        moving = stage.wait_still(axis)
     frames.append(mmc.getImage())
-    for i in range(10):
-        microscope.relative_move(-200., axis = 0)
-        microscope.wait_motor_stop(axis = 0)
-        mmc.snapImage()
-        frames.append(mmc.getImage())
+stage.close()
 
 camera_unload(mmc)
 
@@ -4,6 +4,7 @@ A special GUI for Paramecium experiments
 from simple_manipulator import *
 from Tkinter import *
 from devices import *
+from numpy import array
 import pickle
 from serial import SerialException
 
@@ -33,6 +34,7 @@ class ManipulatorApplication(ManipulatorApplication):
             frame.grid(row=0, column=i + 1, padx=5, pady=5)
             self.frame_manipulator.append(frame)
             i += 1
+        self.units = units
 
         Button(self, text='Go', command=self.go).grid(row = 1, column = 0, padx=5, pady=5)
         Button(self, text='Grip', command=self.grip).grid(row = 2, column = 0, padx=5, pady=5)
@@ -65,22 +67,18 @@ class ManipulatorApplication(ManipulatorApplication):
             print "pressed", event.keycode, event.keysym
 
     def synchronous_move(self, dx=0, dy=0, dz=0):
-        for frame in self.frame_manipulator:
-            frame.unit.relative_move(dx, axis=0)
-            frame.unit.relative_move(dy, axis=1)
-            frame.unit.relative_move(dz, axis=2)
+        # All manipulators move together (merged group commands)
+        coordinated_move([(unit, array([dx, dy, dz])) for unit in self.units])
 
-    def go(self): # synchronous go (not truly necessary)
-        for frame in self.frame_manipulator:
-            frame.unit.go()
+    def go(self): # both safe moves run in parallel
+        for unit in self.units:
+            unit.go()
 
     def grip(self): # 5 um grip
-        for frame in self.frame_manipulator:
-            frame.unit.dev.relative_move(-5., axis=0)
+        coordinated_move([(unit.dev, -5., 0) for unit in self.units])
 
     def ungrip(self):
-        for frame in self.frame_manipulator:
-            frame.unit.dev.relative_move(5., axis=0)
+        coordinated_move([(unit.dev, 5., 0) for unit in self.units])
 
 
 if __name__ == '__main__':
@@ -1,2 +1,4 @@
 from tipdetection import *
 from templatematch import *
+from focusmetrics import *
+from autofocus import *
@@ -1,16 +1,118 @@
 '''
 Autofocus algorithms
+
+The focus position is searched with a golden-section search of the maximum of
+a focus metric (see focusmetrics), one focus position at a time: each step asks for
+the next position, given the metric measured at the previous ones.
 '''
 import cv2
 import numpy as np
 from tipdetection import *
 from templatematch import *
-from scipy.optimize import minimize_scalar
+from focusmetrics import *
 import pickle
 
-__all__ = ['tip_autofocus']
+__all__ = ['tip_autofocus', 'autofocus', 'GoldenSectionSearch']
+
+golden_ratio = (np.sqrt(5) - 1) / 2
+
+class GoldenSectionSearch(object):
+    '''
+    Golden-section search of the maximum of a function on an interval, one evaluation at a time:
+
+        search = GoldenSectionSearch(-10, 10, .5)
+        z = search.next()
+        while z is not None:
+            search.tell(z, f(z))
+            z = search.next()
+        z = search.best()
+    '''
+    def __init__(self, low, high, tolerance):
+        '''
+        Parameters
+        ----------
+        low, high : interval
+        tolerance : size of the interval at which the search stops
+        '''
+        self.a, self.b = float(low), float(high)
+        self.tolerance = tolerance
+        self.c = self.b - golden_ratio * (self.b - self.a)
+        self.d = self.a + golden_ratio * (self.b - self.a)
+        self.values = dict()
+
+    def tell(self, z, value):
+        '''
+        Gives the value of the function at z.
+        '''
+        self.values[z] = value
+
+    def next(self):
+        '''
+        Next position to evaluate, None when the search is finished.
+        '''
+        while self.b - self.a > self.tolerance:
+            for z in (self.c, self.d):
+                if z not in self.values:
+                    return z
+            # Keep the part of the interval around the highest value; one new point is needed
+            if self.values[self.c] >= self.values[self.d]:
+                self.b, self.d = self.d, self.c
+                self.c = self.b - golden_ratio * (self.b - self.a)
+            else:
+                self.a, self.c = self.c, self.d
+                self.d = self.a + golden_ratio * (self.b - self.a)
+        return None
+
+    def best(self):
+        '''
+        Position of the maximum: vertex of the parabola through the best evaluation and its neighbours,
+        or the best evaluation.
+        '''
+        z = np.array(sorted(self.values))
+        values = np.array([self.values[x] for x in z])
+        i = values.argmax()
+        if 0 < i < len(z) - 1:
+            (z0, z1, z2), (f0, f1, f2) = z[i - 1:i + 2], values[i - 1:i + 2]
+            denominator = (z1 - z0) * (f1 - f2) - (z1 - z2) * (f1 - f0)
+            if denominator != 0:
+                vertex = z1 - .5 * ((z1 - z0) ** 2 * (f1 - f2) - (z1 - z2) ** 2 * (f1 - f0)) / denominator
+                if z0 < vertex < z2:
+                    return vertex
+        return z[i]
 
-def tip_autofocus(focus, min = None, max = None):
+def autofocus(move, curve, low, high, tolerance = .5, grab = None, timeout = 5.):
+    '''
+    Focuses by maximizing a focus metric, with a golden-section search.
+
+    Parameters
+    ----------
+    move : function that moves the focus to z and waits until still
+    curve : a FocusCurve, fed with frames by the camera thread (unless grab is given)
+    low, high : search interval
+    tolerance : precision of the focus position
+    grab : function that returns a new frame; if None, frames are given to the curve by the camera thread
+    timeout : maximum time to wait for frames at each focus position, in s
+
+    Returns
+    -------
+    The focus position, where the focus is left.
+    '''
+    search = GoldenSectionSearch(low, high, tolerance)
+    z = search.next()
+    while z is not None:
+        move(z)
+        if grab is None:
+            curve.start(z)
+            value = curve.wait(timeout)
+        else:
+            value = curve.add(z, grab())
+        search.tell(z, value)
+        z = search.next()
+    z = search.best()
+    move(z)
+    return z
+
+def tip_autofocus(focus, min = None, max = None, tolerance = .5):
     '''
     Focus on the tip.
 
@@ -19,10 +121,19 @@ def tip_autofocus(focus, min = None, max = None):
     focus : focus function, argument = z, current position being z = 0, returns image
     min : minimum z
     max : maximum z
+    tolerance : precision of the focus position
+
+    Returns
+    -------
+    The focus position.
     '''
     # Uses corner detection
-    res = minimize_scalar(lambda x : -tip_detection(focus(x))[2], bounds = (min, max),
-                          method = 'Bounded') # uses Brent method
+    search = GoldenSectionSearch(min, max, tolerance)
+    z = search.next()
+    while z is not None:
+        search.tell(z, tip_detection(focus(z))[2])
+        z = search.next()
+    return search.best()
 
 if __name__ == '__main__': # test
     img = pickle.load(open('../pipette_stack.img', "rb"))
@@ -36,10 +147,12 @@ if __name__ == '__main__': # test
         little_one = gray[y-20:y+20,x-20:x+20]
 
         print c, np.var(little_one/np.mean(little_one))
+        # Focus metrics around the tip
+        roi = (x - 20, y - 20, 40, 40)
+        print ' '.join('{}: {:.3g}'.format(name, metric(img[i], roi)) for name, metric in sorted(focus_metrics.items()))
 
         image = img[i]
         cv2.circle(image, (x, y), 2, (155, 0, 25))
         cv2.imshow('Camera',image)
         key = cv2.waitKey()
     cv2.destroyAllWindows()
-
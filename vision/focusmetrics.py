@@ -0,0 +1,168 @@
+'''
+Focus metrics: sharpness of an image, maximal at focus.
+
+All metrics take an image (gray or BGR) and an optional region of interest
+roi = (x, y, width, height), and return a number.
+
+A FocusCurve evaluates a metric on frames as they arrive (e.g. from the camera thread),
+averaged over a few frames at each focus position.
+'''
+import cv2
+import numpy as np
+from threading import Lock, Event
+
+__all__ = ['normalized_variance', 'tenengrad', 'laplacian_energy', 'wu_contrast', 'focus_metrics',
+           'FocusCurve']
+
+def region(img, roi = None):
+    '''
+    The region of interest (x, y, width, height) of the image, as a gray image in floating point.
+    '''
+    if roi is not None:
+        x, y, width, height = roi
+        img = img[y:y + height, x:x + width]
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return np.asarray(img, dtype = np.float32)
+
+def normalized_variance(img, roi = None):
+    '''
+    Variance of the intensity normalized by the mean intensity.
+    '''
+    img = region(img, roi)
+    mean = img.mean()
+    if mean == 0:
+        return 0.
+    return float(img.var() / mean)
+
+def tenengrad(img, roi = None, threshold = 0.):
+    '''
+    Mean squared gradient magnitude (Sobel), counting only gradients above threshold.
+    '''
+    img = region(img, roi)
+    gradient = cv2.Sobel(img, cv2.CV_32F, 1, 0) ** 2 + cv2.Sobel(img, cv2.CV_32F, 0, 1) ** 2
+    if threshold > 0:
+        gradient[gradient < threshold ** 2] = 0
+    return float(gradient.mean())
+
+def laplacian_energy(img, roi = None):
+    '''
+    Mean squared Laplacian.
+    '''
+    img = region(img, roi)
+    return float((cv2.Laplacian(img, cv2.CV_32F) ** 2).mean())
+
+def wu_contrast(img, roi = None):
+    '''
+    Local contrast measure for low contrast images, after Wu et al. (2011), Robust Automatic Focus
+    Algorithm for Low Contrast Images Using a New Contrast Measure: mean over pixels of the
+    absolute differences with the 8 neighbours, relative to the local (3x3) mean intensity.
+    '''
+    img = region(img, roi)
+    center = img[1:-1, 1:-1]
+    differences = np.zeros_like(center)
+    height, width = img.shape
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dx or dy:
+                differences += np.abs(center - img[1 + dy:height - 1 + dy, 1 + dx:width - 1 + dx])
+    mean = cv2.blur(img, (3, 3))[1:-1, 1:-1]
+    return float((differences / (8 * np.maximum(mean, 1.))).mean())
+
+focus_metrics = {'variance': normalized_variance,
+                 'tenengrad': tenengrad,
+                 'laplacian': laplacian_energy,
+                 'contrast': wu_contrast}
+
+class FocusCurve(object):
+    '''
+    Focus metric as a function of focus position, measured on frames as they arrive.
+
+        camera.listeners.append(curve.add_frame) # AutomaticPatch camera thread
+        curve.start(z)       # after moving the focus to z
+        curve.add_frame(img) # for each new frame, from any thread
+        value = curve.wait() # when enough frames at z have been measured
+    '''
+    def __init__(self, metric = normalized_variance, roi = None, frames = 1, skip = 0):
+        '''
+        Parameters
+        ----------
+        metric : focus metric, or its name in focus_metrics
+        roi : region of interest (x, y, width, height)
+        frames : number of frames averaged at each focus position
+        skip : number of frames ignored after each start (e.g. exposed during the move)
+        '''
+        if not callable(metric):
+            metric = focus_metrics[metric]
+        self.metric = metric
+        self.roi = roi
+        self.frames = frames
+        self.skip = skip
+        self.lock = Lock()
+        self.ready = Event()
+        self.z = []
+        self.values = []
+        self.current = None # focus position being measured, None if none
+        self.measurement = 0 # number of measurements started
+        self.count = 0
+        self.total = 0.
+
+    def start(self, z):
+        '''
+        Starts measuring the metric at focus position z, on the next frames.
+        '''
+        with self.lock:
+            self.current = z
+            self.measurement += 1
+            self.count = -self.skip
+            self.total = 0.
+            self.ready.clear()
+
+    def add_frame(self, img):
+        '''
+        Measures the metric on a new frame, if a measurement is in progress.
+        '''
+        with self.lock:
+            if self.current is None:
+                return
+            if self.count < 0:
+                self.count += 1
+                return
+            measurement = self.measurement
+        value = self.metric(img, self.roi)
+        with self.lock:
+            if measurement != self.measurement or self.current is None: # started again meanwhile
+                return
+            self.total += value
+            self.count += 1
+            if self.count >= self.frames:
+                self.z.append(self.current)
+                self.values.append(self.total / self.count)
+                self.current = None
+                self.ready.set()
+
+    def wait(self, timeout = None):
+        '''
+        Waits for the end of the measurement, and returns the metric.
+        '''
+        if not self.ready.wait(timeout):
+            raise RuntimeError('No frame received in {} s'.format(timeout))
+        return self.values[-1]
+
+    def add(self, z, img):
+        '''
+        Measures the metric on an image taken at focus position z.
+        '''
+        value = self.metric(img, self.roi)
+        with self.lock:
+            self.z.append(z)
+            self.values.append(value)
+        return value
+
+    def best(self):
+        '''
+        Focus position with the highest metric, None if nothing has been measured.
+        '''
+        if not self.values:
+            return None
+        return self.z[int(np.argmax(self.values))]
@@ -1,38 +1,335 @@
 '''
 Finding an image in another image.
 Typically used to locate a pipette in an image, using a previous photo.
+
+Matching is coarse-to-fine: the template is first searched in a downsampled
+image (4x to 8x smaller in each dimension, depending on the template size),
+then the best candidate is refined at full resolution in a small window,
+with sub-pixel interpolation of the correlation peak.
+
+A TemplateStack matches a stack of templates of the same size (e.g. images of
+the tip at different heights) in one pass: the stack is located once in the
+downsampled image, then all templates are correlated with the same full resolution
+window through FFTs, with the spectra of the templates computed once.
+A TemplateTracker only searches a window around the position predicted
+from the previous match and the known moves, and the whole image if the match fails.
 '''
 import cv2
 import time
 import numpy as np
 
-__all__ = ['find_template']
+__all__ = ['find_template', 'match_template', 'TemplateStack', 'TemplateTracker']
 
-def find_template(img, template):
+def find_template(img, template, pyramid = True, subpixel = True):
     '''
     Finds the template in the image.
 
+    Parameters
+    ----------
+    pyramid : if False, the template is searched at full resolution over the whole image
+    subpixel : if True, the position is interpolated between pixels
+
     Returns
     -------
     x,y : position in pixels
     max_val : match performance
     '''
+    return match_template(img, template, factor = None if pyramid else 1, subpixel = subpixel)
+
+def match_template(img, template, factor = None, min_size = 12, margin = 2, subpixel = True):
+    '''
+    Finds the template in the image, with normalized correlation, coarse-to-fine.
+
+    Parameters
+    ----------
+    factor : downsampling factor of the coarse search (1 = full resolution search);
+             by default the largest power of 2 up to 8 that keeps the template at least min_size pixels
+    min_size : minimum size of the downsampled template, in pixels
+    margin : extra margin of the refinement window, in full resolution pixels
+    subpixel : if True, the position is interpolated between pixels (parabolic fit of the peak)
+
+    Returns
+    -------
+    x,y : position in pixels of the top left corner of the template
+    max_val : match performance
+    '''
+    height, width = template.shape[:2]
+    if factor is None:
+        factor = 8
+        while factor > 1 and min(height, width) < factor * min_size:
+            factor /= 2
+    if factor > 1:
+        # Coarse search
+        small_img = cv2.resize(img, (img.shape[1] / factor, img.shape[0] / factor), interpolation = cv2.INTER_AREA)
+        small_template = cv2.resize(template, (width / factor, height / factor), interpolation = cv2.INTER_AREA)
+        res = cv2.matchTemplate(small_img, small_template, cv2.TM_CCOEFF_NORMED)
+        _, _, _, (x, y) = cv2.minMaxLoc(res)
+        # Refinement window at full resolution
+        radius = factor + margin
+        x0, y0 = max(x * factor - radius, 0), max(y * factor - radius, 0)
+        x1 = min(x * factor + radius + width, img.shape[1])
+        y1 = min(y * factor + radius + height, img.shape[0])
+        img = img[y0:y1, x0:x1]
+    else:
+        x0, y0 = 0, 0
     res = cv2.matchTemplate(img, template, cv2.TM_CCOEFF_NORMED)
-    _, max_val, _, max_loc = cv2.minMaxLoc(res)
-    x, y = max_loc
-    return x, y, max_val
+    _, max_val, _, (x, y) = cv2.minMaxLoc(res)
+    if subpixel:
+        dx, dy = peak_offset(res, x, y)
+        return x0 + x + dx, y0 + y + dy, max_val
+    else:
+        return x0 + x, y0 + y, max_val
+
+class TemplateStack(object):
+    '''
+    A stack of templates of the same size, matched together.
+    '''
+    def __init__(self, templates, factor = None, radius = None, min_size = 12, margin = 2):
+        '''
+        Parameters
+        ----------
+        templates : list of images of the same size
+        factor : downsampling factor of the coarse search (see `match_template`)
+        radius : half-size of the full resolution search window, in pixels
+                 (by default twice the downsampling factor, plus margin)
+        min_size : minimum size of the downsampled templates, in pixels
+        margin : extra margin of the search window, in pixels
+        '''
+        self.templates = np.array([np.asarray(template, dtype = np.float64) for template in templates])
+        if self.templates.ndim != 3:
+            raise ValueError('Templates must be grayscale images of the same size')
+        self.height, self.width = self.templates.shape[1:]
+        if factor is None:
+            factor = 8
+            while factor > 1 and min(self.height, self.width) < factor * min_size:
+                factor /= 2
+        self.factor = factor
+        self.radius = 2 * factor + margin if radius is None else radius
+        # Zero-mean templates and their norms
+        self.centered = self.templates - self.templates.mean(axis = (1, 2), keepdims = True)
+        self.norms = np.sqrt((self.centered ** 2).sum(axis = (1, 2)))
+        # The stack is located with the mean template in the downsampled image
+        reference = self.templates.mean(axis = 0).astype(np.float32)
+        self.reference = cv2.resize(reference, (self.width / factor, self.height / factor), interpolation = cv2.INTER_AREA)
+        self.spectra = dict() # spectra of the templates for each window shape
+        self.window_spectra((cv2.getOptimalDFTSize(self.height + 2 * self.radius),
+                             cv2.getOptimalDFTSize(self.width + 2 * self.radius)))
+
+    def __len__(self):
+        return len(self.templates)
+
+    def window_spectra(self, shape):
+        '''
+        Spectra of the zero-mean templates, padded to shape (packed format of cv2.dft).
+        '''
+        if shape not in self.spectra:
+            self.spectra[shape] = [cv2.dft(pad(template, shape)) for template in self.centered]
+        return self.spectra[shape]
+
+    def locate(self, img):
+        '''
+        Position (x, y) of the stack in the image, coarse.
+        '''
+        if self.factor == 1:
+            return 0, 0
+        small = cv2.resize(img, (img.shape[1] / self.factor, img.shape[0] / self.factor),
+                           interpolation = cv2.INTER_AREA).astype(np.float32)
+        res = cv2.matchTemplate(small, self.reference, cv2.TM_CCOEFF_NORMED)
+        _, _, _, (x, y) = cv2.minMaxLoc(res)
+        return x * self.factor, y * self.factor
+
+    def match(self, img, subpixel = True, around = None, radius = None):
+        '''
+        Matches all templates in the image (normalized correlation).
+
+        Parameters
+        ----------
+        around : expected position (x, y) of the templates; if given, the templates are only
+                 searched in a window around it, otherwise the whole image is searched (coarse-to-fine)
+        radius : half-size of the search window, in pixels (default: self.radius)
+
+        Returns
+        -------
+        index : index of the best template
+        x,y : position in pixels of the top left corner of the best template
+        scores : best match performance of each template
+        '''
+        if radius is None:
+            radius = self.radius
+        if around is None:
+            x, y = self.locate(img)
+        else:
+            x, y = int(round(around[0])), int(round(around[1]))
+        # Full resolution window, of constant size when possible
+        if self.factor == 1 and around is None:
+            window_height, window_width = img.shape[:2]
+        else:
+            window_height = min(self.height + 2 * radius, img.shape[0])
+            window_width = min(self.width + 2 * radius, img.shape[1])
+        x0 = min(max(x - radius, 0), img.shape[1] - window_width)
+        y0 = min(max(y - radius, 0), img.shape[0] - window_height)
+        window = np.asarray(img[y0:y0 + window_height, x0:x0 + window_width], dtype = np.float64)
+        shape = window.shape
+
+        # Correlation of all templates with the window (padded to a fast FFT size)
+        n_y, n_x = shape[0] - self.height + 1, shape[1] - self.width + 1
+        shape = (cv2.getOptimalDFTSize(shape[0]), cv2.getOptimalDFTSize(shape[1]))
+        spectrum = cv2.dft(pad(window, shape))
+        correlation = np.array([cv2.idft(cv2.mulSpectrums(spectrum, template_spectrum, 0, conjB = True),
+                                         flags = cv2.DFT_REAL_OUTPUT | cv2.DFT_SCALE)[:n_y, :n_x]
+                                for template_spectrum in self.window_spectra(shape)])
+        # Standard deviation of the window under the templates, with integral images
+        total, squares = cv2.integral2(window, sdepth = cv2.CV_64F)
+        h, w = self.height, self.width
+        sums = total[h:, w:] - total[:-h, w:] - total[h:, :-w] + total[:-h, :-w]
+        sums2 = squares[h:, w:] - squares[:-h, w:] - squares[h:, :-w] + squares[:-h, :-w]
+        deviation = np.sqrt(np.maximum(sums2 - sums ** 2 / (h * w), 1e-9))
+        res = correlation / (deviation[None, :, :] * np.maximum(self.norms, 1e-9)[:, None, None])
+
+        best = res.reshape(len(self), -1).argmax(axis = 1)
+        scores = res.reshape(len(self), -1)[np.arange(len(self)), best]
+        index = scores.argmax()
+        y, x = np.unravel_index(best[index], (n_y, n_x))
+        if subpixel:
+            dx, dy = peak_offset(res[index], x, y)
+            return index, (x0 + x + dx, y0 + y + dy), scores
+        else:
+            return index, (x0 + x, y0 + y), scores
+
+class TemplateTracker(object):
+    '''
+    Tracks a template stack between frames: the templates are searched in a window
+    around the position predicted from the previous match and the known moves,
+    and in the whole image if the prediction fails.
+    '''
+    def __init__(self, stack, threshold = 0.75, radius = 24):
+        '''
+        Parameters
+        ----------
+        stack : a TemplateStack
+        threshold : match performance below which the templates are searched in the whole image
+        radius : half-size of the search window around the predicted position, in pixels
+        '''
+        self.stack = stack
+        self.threshold = threshold
+        self.radius = radius
+        self.position = None # predicted position, None if unknown
+        self.tracked = 0 # number of matches found around the prediction
+        self.searched = 0 # number of whole image searches
+
+    def reset(self, position = None):
+        '''
+        Sets the position of the templates (None if unknown).
+        '''
+        self.position = None if position is None else np.array(position, dtype = float)
+
+    def predict(self, shift):
+        '''
+        Shifts the predicted position by shift (x, y), in pixels (e.g. after a move).
+        '''
+        if self.position is not None:
+            self.position = self.position + np.asarray(shift, dtype = float)[:2]
+
+    def match(self, img, subpixel = True):
+        '''
+        Matches the templates in the image, around the predicted position if known.
+
+        Returns
+        -------
+        index : index of the best template
+        x,y : position in pixels of the top left corner of the best template
+        scores : best match performance of each template
+        '''
+        if self.position is not None:
+            index, position, scores = self.stack.match(img, subpixel, around = self.position, radius = self.radius)
+            if scores[index] >= self.threshold:
+                self.tracked += 1
+                self.position = np.array(position)
+                return index, position, scores
+        index, position, scores = self.stack.match(img, subpixel)
+        self.searched += 1
+        self.reset(position if scores[index] >= self.threshold else None)
+        return index, position, scores
+
+def pad(img, shape):
+    '''
+    Image padded with zeros to shape.
+    '''
+    padded = np.zeros(shape)
+    padded[:img.shape[0], :img.shape[1]] = img
+    return padded
+
+def peak_offset(res, x, y):
+    '''
+    Sub-pixel offset of the peak of res at (x, y), by fitting a parabola along each axis.
+    '''
+    offset = [0., 0.]
+    if 0 < x < res.shape[1] - 1:
+        offset[0] = parabola_peak(*res[y, x - 1:x + 2])
+    if 0 < y < res.shape[0] - 1:
+        offset[1] = parabola_peak(*res[y - 1:y + 2, x])
+    return offset
+
+def parabola_peak(a, b, c):
+    '''
+    Position of the extremum of the parabola through (-1, a), (0, b), (1, c).
+    '''
+    curvature = a - 2 * b + c
+    if curvature >= 0: # not a maximum
+        return 0.
+    return .5 * (a - c) / curvature
+
+if __name__ == '__main__': # benchmark
+    import sys
+    from os import path
+    root = path.join(path.dirname(path.abspath(__file__)), '..')
+    if len(sys.argv) > 1:
+        # Recorded images or stacks (.npy, frames along the first axis)
+        files = sys.argv[1:]
+    else:
+        files = [path.join(root, 'pipette2.jpg'), path.join(root, 'pipette3.jpg')]
+    images = []
+    for name in files:
+        if name.endswith('.npy'):
+            images.extend(list(np.load(name)))
+        else:
+            images.append(cv2.imread(name, 0))
 
-if __name__ == '__main__': # test
-    img = cv2.imread('pipette1.jpg', 0)
-    height, width = img.shape
-    cv2.imshow('Pipette',img)
+    # Each image is matched against the central quarter of the first one (as in automated_calibration)
+    # and against templates cut from itself at known sub-pixel shifts
+    height, width = images[0].shape[:2]
+    template = images[0][height*3/8:height*5/8, width*3/8:width*5/8]
+    def timed(f, *args, **kwds):
+        n = 20
+        t1 = time.time()
+        for _ in range(n):
+            result = f(*args, **kwds)
+        return result, (time.time() - t1) / n * 1000
 
-    img2 = img[height*3/8:height*5/8,width*3/8:width*5/8]
-    cv2.imshow('Template',img2)
-    #img2 = np.zeros(img.shape)
-    #img2[200:,300:] = img[:-200,:-300]
+    for img in images:
+        (x, y, val), t_full = timed(find_template, img, template, pyramid = False, subpixel = False)
+        (xp, yp, valp), t_pyramid = timed(find_template, img, template)
+        print 'Full resolution: ({}, {}) score {:.3f}, {:.1f} ms'.format(x, y, val, t_full)
+        print 'Pyramid:         ({:.2f}, {:.2f}) score {:.3f}, {:.1f} ms'.format(xp, yp, valp, t_pyramid)
 
-    print find_template(img, img2)
+    errors = []
+    random = np.random.RandomState(0)
+    for img in images:
+        for _ in range(20):
+            shift = random.rand(2) * 2 - 1
+            shifted = cv2.warpAffine(img, np.float32([[1, 0, shift[0]], [0, 1, shift[1]]]), (img.shape[1], img.shape[0]),
+                                     flags = cv2.INTER_CUBIC)
+            x, y, _ = find_template(shifted, template if img is images[0] else
+                                    img[height*3/8:height*5/8, width*3/8:width*5/8])
+            errors.append(np.hypot(x - width*3/8 - shift[0], y - height*3/8 - shift[1]))
+    print 'Sub-pixel error on shifted images: mean {:.2f} px, max {:.2f} px'.format(np.mean(errors), np.max(errors))
 
-    key = cv2.waitKey(0)
-    cv2.destroyAllWindows()
+    # Template stack: 11 templates blurred as out of focus images, in an upscaled frame
+    frame = cv2.resize(images[0], (2048, 2048))
+    crop = frame[900:1200, 800:1100]
+    stack = [cv2.GaussianBlur(crop, (0, 0), abs(k - 5) * 1.5 + .5) for k in range(11)]
+    frame[600:1500, 500:1400] = cv2.GaussianBlur(frame[600:1500, 500:1400], (0, 0), 3.5)
+    _, t_loop = timed(lambda: [find_template(frame, template) for template in stack])
+    (index, (x, y), scores), t_stack = timed(TemplateStack(stack).match, frame)
+    print 'Stack of {} templates: best {} at ({:.2f}, {:.2f}), {:.1f} ms ({:.1f} ms with find_template)'.format(
+        len(stack), index, x, y, t_stack, t_loop)
@@ -9,8 +9,6 @@ and denoise
 '''
 import cv2
 import numpy as np
-import copy
-import math
 
 __all__ = ['tip_detection','genericFourtyXPipetteDetection']
 
@@ -35,111 +33,93 @@ def tip_detection(img):
     return x,y,criterion
 
 ### From Autopatcher_IG
-## Really slow!
-def genericFourtyXPipetteDetection(img):
+def genericFourtyXPipetteDetection(img, max_lines = 10, minimum_length = 15):
     '''
+    Detects the tip of a pipette as the edge pixel closest to the main lines of the image
+    (smallest sum of distances to the Hough lines).
+
+    Parameters
+    ----------
+    max_lines : maximum number of lines; the vote threshold of the lines is raised until there are no more
+    minimum_length : initial vote threshold of the lines (minimum number of edge pixels)
+
     Returns
     -------
-    y, x : tip position in pixels
+    y, x : tip position in pixels (column, row)
     distance : minimum distance of tip to detected lines
     '''
-    #height, width = img.shape
     edges = cv2.Canny(img, 30, 100)
-    minimum_length = 15;
-
-    while 1:
-        linecount = 0;
-        lines_unsorted = cv2.HoughLines(edges, 1, np.pi / 180, minimum_length)[0]
-
-        # count lines
-        for rho, theta in lines_unsorted:
-            linecount = linecount + 1;
-        # print rho, theta
-
-        if linecount > 10:
-            minimum_length = minimum_length + 1;
-            continue
-
-        # create cartesian matrix for each line
-        # ax + by + c = 0    b is set to 1 and not being recorded
-        cartesian_line = copy.deepcopy(lines_unsorted)
-        for index, [rho, theta] in enumerate(lines_unsorted):
-            a = np.cos(theta)
-            b = np.sin(theta)
-            x0 = a * rho
-            y0 = b * rho
-            x1 = int(x0 + 1000 * (-b))
-            y1 = int(y0 + 1000 * (a))
-            x2 = int(x0 - 1000 * (-b))
-            y2 = int(y0 - 1000 * (a))
-            a = y1 - y2;
-            b = x2 - x1;
-            c = x1 * y2 - x2 * y1;
-            a = a / b;
-            c = c / b;
-            cartesian_line[index] = [a, c]
-
-        # cv2.imshow('edges', edges)
-        # cv2.waitKey(0)
-        # cv2.destroyAllWindows()
-
-        lines = lines_unsorted
-
-        black_board = np.zeros((img.shape[0], img.shape[1]), np.uint8)
-        for index, [rho, theta] in enumerate(lines):
-            a = np.cos(theta)
-            b = np.sin(theta)
-            x0 = a * rho
-            y0 = b * rho
-            x1 = int(x0 + 1000 * (-b))
-            y1 = int(y0 + 1000 * (a))
-            x2 = int(x0 - 1000 * (-b))
-            y2 = int(y0 - 1000 * (a))
-            temp = np.zeros((img.shape[0], img.shape[1]), np.uint8)
-            black_board = black_board + temp;
-        # aftermath = aftermath + 1
-
-        # cv2.imshow('black_board with lines', black_board)
-        # cv2.waitKey(0)
-        # cv2.destroyAllWindows()
-
-        tip_x = 0;
-        tip_y = 0;
-        minimum_distance = 99999999999;  # has to be big
-        current_distance = 0;
-        cumulative_distance = 0;
-
-        # calculate the distance to each line
-        for x, col in enumerate(edges):
-            for y, val in enumerate(col):
-                cumulative_distance = 0
-                if val != 0:
-                    for index, [a, c] in enumerate(cartesian_line):
-                        distance = abs(a * y + x + c) / (math.sqrt(a * a + 1))
-                        cumulative_distance = cumulative_distance + distance
-                    if cumulative_distance < minimum_distance:
-                        tip_x = x;
-                        tip_y = y;
-                        minimum_distance = cumulative_distance;
-            # print "the minimum distance is ", minimum_distance
-            coordinate = (tip_y, tip_x);
-        #cv2.circle(edges, coordinate, 2, (255, 255, 255), 2)
-
-        #cv2.imshow('edges', edges)
-        #cv2.waitKey(0)
-        #cv2.destroyAllWindows()
-
-        return [tip_y, tip_x, minimum_distance]
-        break
-
-    pass
+    rows, columns = edges.nonzero()
+    if len(rows) == 0:
+        return [0, 0, 0.]
+
+    # Lines with more than minimum_length votes, then the smallest threshold that leaves at most max_lines
+    rho, theta, votes = hough_lines(rows, columns, edges.shape, minimum_length)
+    if len(votes) > max_lines:
+        threshold = votes[max_lines]
+        rho, theta = rho[votes > threshold], theta[votes > threshold]
+
+    # Sum of the distances of each edge pixel to all lines, as an edge pixels x lines matrix
+    distance = np.abs(columns[:, None] * np.cos(theta) + rows[:, None] * np.sin(theta) - rho).sum(axis = 1)
+    i = distance.argmin()
+    return [columns[i], rows[i], distance[i]]
+
+def hough_lines(rows, columns, shape, threshold):
+    '''
+    Standard Hough transform of edge pixels, as cv2.HoughLines with a resolution of 1 pixel and 1 degree,
+    but returning the votes of the lines.
+
+    Returns
+    -------
+    rho, theta, votes : lines with more than threshold votes, sorted by decreasing votes
+    '''
+    height, width = shape
+    numangle = 180
+    numrho = int(round(((width + height) * 2 + 1)))
+    # Same rounding as OpenCV (angles accumulated and tables in single precision)
+    angles = np.cumsum(np.full(numangle, np.float32(np.pi / 180), dtype = np.float32), dtype = np.float32) - np.float32(np.pi / 180)
+    cos, sin = np.cos(angles.astype(float)).astype(np.float32), np.sin(angles.astype(float)).astype(np.float32)
+    r = columns[:, None].astype(np.float32) * cos
+    r += rows[:, None].astype(np.float32) * sin
+    index = np.rint(r, out = r).astype(np.intp)
+    # Accumulator with a border of zeros, flattened
+    index += (np.arange(numangle) + 1) * (numrho + 2) + (numrho - 1) // 2 + 1
+    accumulator = np.bincount(index.ravel(), minlength = (numangle + 2) * (numrho + 2)).reshape(numangle + 2, numrho + 2)
+    center = accumulator[1:-1, 1:-1]
+    # Local maxima
+    peaks = (center > threshold) & \
+            (center > accumulator[1:-1, :-2]) & (center >= accumulator[1:-1, 2:]) & \
+            (center > accumulator[:-2, 1:-1]) & (center >= accumulator[2:, 1:-1])
+    n, r = peaks.nonzero()
+    votes = center[n, r]
+    order = np.argsort(-votes, kind = 'mergesort')
+    n, r, votes = n[order], r[order], votes[order]
+    return (r - (numrho - 1) * .5), angles[n], votes
 
 
 if __name__ == '__main__': # test
-    img = cv2.imread('pipette.jpg', 0)
-    x,y,_ = tip_detection(img)
-    #genericFourtyXPipetteDetection(img)
-    cv2.circle(img, (x, y), 2, (155, 0, 25))
-    cv2.imshow('dst', img)
-    cv2.waitKey(0)
-    cv2.destroyAllWindows()
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        # python tipdetection.py benchmark [images]
+        import time
+        from os import path
+        root = path.join(path.dirname(path.abspath(__file__)), '..')
+        files = sys.argv[2:] or [path.join(root, name) for name in
+                                 ['vision/pipette.jpg', 'vision/pipette1.jpg', 'pipette2.jpg', 'pipette3.jpg']]
+        for name in files:
+            img = cv2.imread(name, 0)
+            n = 20
+            t1 = time.time()
+            for _ in range(n):
+                x, y, distance = genericFourtyXPipetteDetection(img)
+            t = (time.time() - t1) / n
+            print '{} {}x{}: tip at ({}, {}), {:.1f} ms ({:.0f} images/s)'.format(path.basename(name), img.shape[1],
+                                                                              img.shape[0], x, y, t * 1000, 1 / t)
+    else:
+        img = cv2.imread('pipette.jpg', 0)
+        x,y,_ = tip_detection(img)
+        #genericFourtyXPipetteDetection(img)
+        cv2.circle(img, (x, y), 2, (155, 0, 25))
+        cv2.imshow('dst', img)
+        cv2.waitKey(0)
+        cv2.destroyAllWindows()